@@ -1,13 +1,25 @@
 import dateutil
 import platform
-import isoweek
 import datetime
+import functools
+import glob
+import argparse
 import math
 import re
+import collections
+import collections.abc
+import concurrent.futures
+import multiprocessing.shared_memory
+import hashlib
+import inspect
+import io
+import itertools
 import numpy
 import scipy.optimize
 import scipy.interpolate
 import scipy.integrate
+import scipy.sparse
+import scipy.linalg
 import pandas
 import matplotlib.pyplot as plt
 import matplotlib.dates
@@ -63,7 +75,6 @@ BASELINE_CUTOFF_DATE = datetime.date(2021, 1, 1)
 BASELINE_INTERVAL = datetime.timedelta(days=365*3)
 T0_DATE = datetime.date(2021, 1, 1)
 T0_DATETIME64 = numpy.datetime64("2021-01-01")
-YEAR_WEEK_RE = re.compile(r'"(\d\d\d\d)W(\d\d)\*?"')
 PAPER_WIDTH_PT = 483.7
 PAPER_WIDTH_IN = PAPER_WIDTH_PT / 72.27
 COLUMN_WIDTH_PT = 234.0
@@ -79,9 +90,100 @@ ACM_CUSTOM_YLIM = (800, 1320)
 ESTIMATION_PAST_YEARS=10
 BASELINE_PLOT_START_DATE = BASELINE_START_DATE
 BASELINE_PLOT_END_DATE = datetime.date(2022, 12, 31)
+BASELINE_ANCHOR_WINDOW = datetime.timedelta(days=365*3)
+BASELINE_SMOOTHING_WEEKS = 7
+
+# Settings of the baseline methods, passed to them explicitly. The weeks from
+# *start_date* to *cutoff_date* are fitted. Method 1 averages windows of
+# *interval* for its trend points and method 2 windows of *anchor_window*
+# around its anchor points. *smoothing_weeks* is the moving average window of
+# the smoothed deaths. If *estimation_past_years* is not None, method 2
+# extrapolates its trend with the slope of that many years before the cutoff.
+# If *robust_loss* is not None, method 2 downweights outlier weeks with that
+# loss of ROBUST_WEIGHT_FUNCTIONS. Method 2 has trend knots at the first and
+# the last fitted week, and if *knot_spacing* is not None, also every
+# *knot_spacing* from the first fitted week on.
+BaselineConfig = collections.namedtuple("BaselineConfig", ["start_date", "cutoff_date", "interval", "anchor_window",
+                                                           "smoothing_weeks", "estimation_past_years", "robust_loss", "knot_spacing"])
+DEFAULT_BASELINE_CONFIG = BaselineConfig(BASELINE_START_DATE, BASELINE_CUTOFF_DATE, BASELINE_INTERVAL, BASELINE_ANCHOR_WINDOW,
+                                         BASELINE_SMOOTHING_WEEKS, None, None, None)
+
+ISO_WEEK_TABLE_FIRST_YEAR = 1900
+ISO_WEEK_TABLE_LAST_YEAR = 2100
+
+def build_iso_week_table(first_year, last_year):
+    """
+    Thursday of ISO week 1 and the number of ISO weeks for each year in
+    [first_year, last_year]. Week 1 is the week containing January 4th.
+    """
+    years = numpy.arange(first_year, last_year+2)
+    jan4 = (years - 1970).astype("datetime64[Y]").astype("datetime64[D]") + 3
+    # 1970-01-01 was a Thursday, which makes Monday weekday 0 with this offset
+    jan4_weekday = (jan4.astype(numpy.int64) + 3) % 7
+    week1_thursday = jan4 - jan4_weekday + 3
+    weeks_in_year = ((week1_thursday[1:] - week1_thursday[:-1]) // 7).astype(numpy.int64)
+    return week1_thursday[:-1], weeks_in_year
+
+ISO_WEEK1_THURSDAY, ISO_WEEKS_IN_YEAR = build_iso_week_table(ISO_WEEK_TABLE_FIRST_YEAR, ISO_WEEK_TABLE_LAST_YEAR)
+
+def get_datetime64_from_isoweek(year, week):
+    """
+    Thursday of ISO week (*year*, *week*) as datetime64[D]. Accepts scalars or
+    arrays. Week 53 of a 52-week year rolls over to week 1 of the next year.
+    """
+    year = numpy.asarray(year, dtype=numpy.int64)
+    week = numpy.asarray(week, dtype=numpy.int64)
+    if numpy.any(year < ISO_WEEK_TABLE_FIRST_YEAR) or numpy.any(year > ISO_WEEK_TABLE_LAST_YEAR):
+        raise ValueError("Year out of range %d-%d: %s" % (ISO_WEEK_TABLE_FIRST_YEAR, ISO_WEEK_TABLE_LAST_YEAR, year))
+    if numpy.any(week < 1) or numpy.any(week > 53):
+        raise ValueError("Week out of range 1-53: %s" % (week,))
+    return ISO_WEEK1_THURSDAY[year - ISO_WEEK_TABLE_FIRST_YEAR] + 7 * (week - 1)
 
 def get_date_from_isoweek(year, week):
-    return isoweek.Week(year, week).thursday()
+    return get_datetime64_from_isoweek(year, week).item()
+
+def test_get_datetime64_from_isoweek():
+    years = [1900, 1990, 2015, 2020, 2021, 2021, 2100]
+    weeks = [1,    1,    53,   53,   1,    53,   52]
+    result = [str(d) for d in get_datetime64_from_isoweek(years, weeks)]
+    expected = ["1900-01-04", "1990-01-04", "2015-12-31", "2020-12-31", "2021-01-07", "2022-01-06", "2100-12-30"]
+    assert result == expected, "Invalid result: %s, expected %s" % (repr(result), repr(expected))
+    assert get_date_from_isoweek(2022, 52) == datetime.date(2022, 12, 29)
+    assert list(ISO_WEEKS_IN_YEAR[[2015-1900, 2019-1900, 2020-1900]]) == [53, 52, 53]
+test_get_datetime64_from_isoweek()
+
+class WeekIndex:
+    """
+    Index of ISO weeks, each week represented by its Thursday as datetime64[D].
+    The day offsets from T0_DATE (*x*) and the datetime.date objects (*dates*)
+    are computed once and shared by everything that uses the index.
+    """
+    def __init__(self, x_date):
+        self.x_date = numpy.asarray(x_date, dtype="datetime64[D]")
+        self._x = None
+        self._dates = None
+
+    @classmethod
+    def from_isoweeks(cls, years, weeks):
+        return cls(get_datetime64_from_isoweek(years, weeks))
+
+    def __len__(self):
+        return len(self.x_date)
+
+    def __getitem__(self, key):
+        return WeekIndex(self.x_date[key])
+
+    @property
+    def x(self):
+        if self._x is None:
+            self._x = (self.x_date - T0_DATETIME64).astype(numpy.int64)
+        return self._x
+
+    @property
+    def dates(self):
+        if self._dates is None:
+            self._dates = self.x_date.astype(object)
+        return self._dates
 
 def set_size(width, fraction=1, subplots=(1, 1), height_in_override=None):
     """Set figure dimensions to avoid scaling in LaTeX.
@@ -168,6 +270,254 @@ class WeekNumberFormatter(matplotlib.dates.DateFormatter):
     def __call__(self, x, pos=0):
         return matplotlib.dates.DateFormatter.__call__(self, x, pos).lstrip("0")
 
+# Age bands of the weekly ACM table, with the meta categories each band is summed into
+FINLAND_ACM_AGE_CATEGORIES = ((0, 4, []),
+                              (5, 9, ["5-19"]),
+                              (10, 14, ["5-19"]),
+                              (15, 19, ["5-19"]),
+                              (20, 24, ["20-39", "20-64"]),
+                              (25, 29, ["20-39", "20-64"]),
+                              (30, 34, ["20-39", "20-64"]),
+                              (35, 39, ["20-39", "20-64"]),
+                              (40, 44, ["40-64", "20-64"]),
+                              (45, 49, ["40-64", "20-64"]),
+                              (50, 54, ["40-64", "20-64"]),
+                              (55, 59, ["40-64", "20-64"]),
+                              (60, 64, ["40-64", "20-64"]),
+                              (65, 69, ["65-"]),
+                              (70, 74, ["65-"]),
+                              (75, 79, ["65-"]),
+                              (80, 84, ["65-"]),
+                              (85, 89, ["65-"]),
+                              (90, None, ["65-"]))
+SEX_SUFFIXES = ("", "_male", "_female")
+
+def get_age_category_key(age_start, age_end):
+    category_key = str(age_start) + "-"
+    if age_end:
+        category_key += str(age_end)
+    return category_key
+
+VALIDATION_STRICT = "strict"
+VALIDATION_FAST = "fast"
+
+class Validator:
+    """
+    Collects the results of whole-array checks on parsed data, and raises a
+    ValueError listing every failed check with all of its violating rows.
+    Checks marked strict compare columns against each other and are skipped
+    in VALIDATION_FAST mode, which is meant for trusted inputs. Unlike
+    asserts, the checks also run under python -O.
+    """
+    def __init__(self, source, row_labels, mode=VALIDATION_STRICT):
+        if mode not in (VALIDATION_STRICT, VALIDATION_FAST):
+            raise ValueError("Unknown validation mode: %s" % (mode,))
+        self.source = source
+        self.row_labels = row_labels
+        self.mode = mode
+        self.failures = []
+
+    def check(self, valid, description, strict=False, row_labels=None):
+        """
+        *valid* is a boolean array with one row per data row; a row violates
+        the check if any of its values is False. *row_labels* is an array or a
+        tuple of arrays which identify the rows in the report.
+        """
+        if strict and self.mode == VALIDATION_FAST:
+            return
+        valid = numpy.asarray(valid)
+        invalid_rows = numpy.flatnonzero(~valid.reshape((len(valid), -1)).all(axis=1))
+        if len(invalid_rows) == 0:
+            return
+        row_labels = self.row_labels if row_labels is None else row_labels
+        if not isinstance(row_labels, tuple):
+            row_labels = (row_labels,)
+        labels = [" ".join((str(labels[row]) for labels in row_labels)) for row in invalid_rows.tolist()]
+        self.failures.append("%s (%d rows): %s" % (description, len(labels), ", ".join(labels)))
+
+    def validate(self):
+        if self.failures:
+            raise ValueError("Invalid data in %s:\n  %s" % (self.source, "\n  ".join(self.failures)))
+
+# Statistics Finland PX-Web tables are downloaded as semicolon separated CSV
+# files with a title line, an empty line and a heading line. A table layout is
+# declared as a sequence of PxWebColumn items, which give the output key, the
+# expected heading text and the kind of the cells:
+#   "label"  quoted text, read into a str array
+#   "int"    integer, read into an int64 array
+#   "int?"   integer or "." when missing, read into a masked int64 array
+PxWebColumn = collections.namedtuple("PxWebColumn", ["key", "heading", "kind"])
+PXWEB_TITLE_LINES = 2
+PXWEB_MISSING_VALUE = "."
+PXWEB_CHUNK_ROWS = 4096
+PXWEB_SEX_HEADINGS = ("Yhteensä", "Miehet", "Naiset")
+PXWEB_MONTH_HEADINGS = ("Tammikuu", "Helmikuu", "Maaliskuu", "Huhtikuu", "Toukokuu", "Kesäkuu",
+                        "Heinäkuu", "Elokuu", "Syyskuu", "Lokakuu", "Marraskuu", "Joulukuu")
+
+def get_pxweb_age_heading(age_start, age_end):
+    age_heading = str(age_start) + " -"
+    if age_end:
+        age_heading += " " + str(age_end)
+    return age_heading
+
+def check_pxweb_heading(heading_line, columns):
+    heading_cells = heading_line.strip().split(";")
+    if len(heading_cells) != len(columns):
+        raise ValueError("Expected %d columns, got %d" % (len(columns), len(heading_cells)))
+    for heading_cell, column in zip(heading_cells, columns):
+        if heading_cell != '"%s"' % (column.heading,):
+            raise ValueError("Unexpected heading: %s, expected \"%s\"" % (heading_cell, column.heading))
+
+def parse_pxweb_rows(data_lines, columns):
+    field_dtypes = {"label": "U64", "int": numpy.int64, "int?": "U16"}
+    rows = numpy.loadtxt(data_lines, delimiter=";", quotechar='"', ndmin=1,
+                         dtype=[(column.key, field_dtypes[column.kind]) for column in columns])
+    table = {}
+    for column in columns:
+        if column.kind == "int?":
+            missing = rows[column.key] == PXWEB_MISSING_VALUE
+            table[column.key] = numpy.ma.masked_array(numpy.where(missing, "0", rows[column.key]).astype(numpy.int64), mask=missing)
+        else:
+            table[column.key] = rows[column.key]
+    return table
+
+def read_pxweb_csv(csv_file, columns):
+    """
+    Read the data rows of a PX-Web CSV file with the declared *columns* in one
+    pass. The heading line is checked against the declaration, and the data
+    ends at the first empty line. Returns a dict of column key -> numpy array.
+    """
+    lines = csv_file.read().splitlines()
+    check_pxweb_heading(lines[PXWEB_TITLE_LINES], columns)
+    data_lines = []
+    for line in lines[PXWEB_TITLE_LINES+1:]:
+        if not line.strip():
+            break
+        data_lines.append(line)
+    return parse_pxweb_rows(data_lines, columns)
+
+def iter_pxweb_csv_chunks(csv_file, columns, chunk_rows=PXWEB_CHUNK_ROWS):
+    """
+    Like read_pxweb_csv(), but reads *csv_file* lazily and yields tables of at
+    most *chunk_rows* rows, so memory use does not grow with the file size.
+    """
+    for _ in range(PXWEB_TITLE_LINES):
+        csv_file.readline()
+    check_pxweb_heading(csv_file.readline(), columns)
+    while True:
+        data_lines = []
+        for line in itertools.islice(csv_file, chunk_rows):
+            if not line.strip():
+                break
+            data_lines.append(line)
+        if data_lines:
+            yield parse_pxweb_rows(data_lines, columns)
+        if len(data_lines) < chunk_rows:
+            return
+
+def split_period_labels(labels, separator):
+    """
+    Split period labels of the form YYYY<separator>NN, such as "2022W48*",
+    into year and period number arrays. A trailing "*" marks preliminary data.
+    """
+    chars = labels.astype("U8").view("U1").reshape((len(labels), 8))
+    malformed = (chars[:, 4] != separator) | ~numpy.isin(chars[:, 7], ("", "*")) | (numpy.char.str_len(labels) > 8)
+    if malformed.any():
+        raise ValueError("Malformed period labels: %s" % (", ".join(labels[malformed].tolist()),))
+    years = chars[:, :4].copy().view("U4")[:, 0].astype(numpy.int64)
+    periods = chars[:, 5:7].copy().view("U2")[:, 0].astype(numpy.int64)
+    return years, periods
+
+class WeeklyMortality:
+    """
+    Weekly deaths of several categories in columnar form.
+
+    *week_index* is a WeekIndex, *deaths* an int32 matrix with one row per week
+    and one column per category, and *categories* the column labels.
+    """
+    def __init__(self, week_index, deaths, categories):
+        assert deaths.shape == (len(week_index), len(categories))
+        self.week_index = week_index
+        self.week_x_date = week_index.x_date
+        self.deaths = deaths
+        self.categories = list(categories)
+        self.category_columns = dict(((category, index) for index, category in enumerate(self.categories)))
+
+    def __len__(self):
+        return len(self.week_x_date)
+
+    def column(self, category):
+        return self.deaths[:, self.category_columns[category]]
+
+    def columns(self, categories):
+        return self.deaths[:, [self.category_columns[category] for category in categories]]
+
+    def trim(self, weeks_from_end):
+        if weeks_from_end <= 0:
+            return self
+        return WeeklyMortality(self.week_index[:-weeks_from_end], self.deaths[:-weeks_from_end], self.categories)
+
+    def as_tuples(self, category="total"):
+        """
+        List of (datetime.date, deaths) tuples for *category*, for code written
+        against the old row-based parser output.
+        """
+        return list(zip(self.week_index.dates.tolist(), self.column(category).tolist()))
+
+class WeeklyMortalityCategories(collections.abc.Mapping):
+    """
+    Read-only dict view of a WeeklyMortality, mapping each category to a list of
+    (datetime.date, deaths) tuples like the old *acm_by_category* dict. Lists are
+    only built for the categories that are actually accessed.
+    """
+    def __init__(self, weekly_mortality, categories):
+        self.weekly_mortality = weekly_mortality
+        self.categories = list(categories)
+        self.tuple_lists = {}
+
+    def __getitem__(self, category):
+        if category not in self.weekly_mortality.category_columns or category not in self.categories:
+            raise KeyError(category)
+        if category not in self.tuple_lists:
+            self.tuple_lists[category] = self.weekly_mortality.as_tuples(category)
+        return self.tuple_lists[category]
+
+    def __iter__(self):
+        return iter(self.categories)
+
+    def __len__(self):
+        return len(self.categories)
+
+def get_finland_acm_meta_grouping():
+    """
+    Meta category labels in order of first appearance, and a 0/1 matrix which
+    maps the age band columns (band x sex) to the meta category columns.
+    """
+    meta_categories = []
+    for _, _, band_meta_categories in FINLAND_ACM_AGE_CATEGORIES:
+        for meta_category in band_meta_categories:
+            if meta_category not in meta_categories:
+                meta_categories.append(meta_category)
+    grouping = numpy.zeros((len(FINLAND_ACM_AGE_CATEGORIES) * len(SEX_SUFFIXES),
+                            len(meta_categories) * len(SEX_SUFFIXES)), dtype=numpy.int32)
+    for band_index, (_, _, band_meta_categories) in enumerate(FINLAND_ACM_AGE_CATEGORIES):
+        for meta_category in band_meta_categories:
+            meta_index = meta_categories.index(meta_category)
+            for sex_index in range(len(SEX_SUFFIXES)):
+                grouping[band_index*len(SEX_SUFFIXES) + sex_index, meta_index*len(SEX_SUFFIXES) + sex_index] = 1
+    meta_category_keys = [meta_category + suffix for meta_category in meta_categories for suffix in SEX_SUFFIXES]
+    return meta_category_keys, grouping
+
+FINLAND_WEEKLY_MORTALITY_COLUMNS = (
+    (PxWebColumn("region", "Alue", "label"),
+     PxWebColumn("week", "Viikko", "label")) +
+    tuple(PxWebColumn("total" + suffix, "Yhteensä %s Kuolleet" % (sex_heading,), "int")
+          for suffix, sex_heading in zip(SEX_SUFFIXES, PXWEB_SEX_HEADINGS)) +
+    tuple(PxWebColumn(get_age_category_key(age_start, age_end) + suffix,
+                      "%s %s Kuolleet" % (get_pxweb_age_heading(age_start, age_end), sex_heading), "int")
+          for age_start, age_end, _ in FINLAND_ACM_AGE_CATEGORIES
+          for suffix, sex_heading in zip(SEX_SUFFIXES, PXWEB_SEX_HEADINGS)))
+
 # Parse CSV file downloaded from:
 # https://pxnet2.stat.fi/PXWeb/pxweb/fi/Kokeelliset_tilastot/Kokeelliset_tilastot__vamuu_koke/koeti_vamuu_pxt_12ng.px/
 #
@@ -179,288 +529,475 @@ class WeekNumberFormatter(matplotlib.dates.DateFormatter):
 # 
 # Click Lataa taulukko > Lataa puolipiste-eroteltu csv-tiedosto (otsikollinen)
 #
-def parse_finland_acm_csv(csv_file, trim_weeks_from_end):
-    out_tuples = []
-    acm_by_category = {}
-    all_lines = list(csv_file.readlines())
-    heading_line = all_lines[2]
-    heading_cells = heading_line.strip().split(";")
-    assert heading_cells[0] == '"Alue"'
-    assert heading_cells[1] == '"Viikko"'
-    assert heading_cells[2] == '"Yhteensä Yhteensä Kuolleet"'
-    assert heading_cells[3] == '"Yhteensä Miehet Kuolleet"'
-    assert heading_cells[4] == '"Yhteensä Naiset Kuolleet"'
-    age_categories = ((0, 4, []),
-                      (5, 9, ["5-19"]),
-                      (10, 14, ["5-19"]),
-                      (15, 19, ["5-19"]),
-                      (20, 24, ["20-39", "20-64"]),
-                      (25, 29, ["20-39", "20-64"]),
-                      (30, 34, ["20-39", "20-64"]),
-                      (35, 39, ["20-39", "20-64"]),
-                      (40, 44, ["40-64", "20-64"]),
-                      (45, 49, ["40-64", "20-64"]),
-                      (50, 54, ["40-64", "20-64"]),
-                      (55, 59, ["40-64", "20-64"]),
-                      (60, 64, ["40-64", "20-64"]),
-                      (65, 69, ["65-"]),
-                      (70, 74, ["65-"]),
-                      (75, 79, ["65-"]),
-                      (80, 84, ["65-"]),
-                      (85, 89, ["65-"]),
-                      (90, None, ["65-"]))
-    column_idx = 5
-    for age_start, age_end, meta_categories in age_categories:
-        age_category_str = str(age_start) + " -" 
-        if age_end:
-            age_category_str += " " + str(age_end)
-        assert heading_cells[column_idx] == '"%s Yhteensä Kuolleet"' % (age_category_str,)
-        assert heading_cells[column_idx+1] == '"%s Miehet Kuolleet"' % (age_category_str,)
-        assert heading_cells[column_idx+2] == '"%s Naiset Kuolleet"' % (age_category_str,)
-        category_key = str(age_start) + "-" 
-        if age_end:
-            category_key += str(age_end)
-        acm_by_category[category_key] = []
-        acm_by_category[category_key + "_male"] = []
-        acm_by_category[category_key + "_female"] = []
-        for meta_category in meta_categories:
-            if meta_category not in acm_by_category:
-                acm_by_category[meta_category] = []
-                acm_by_category[meta_category + "_male"] = []
-                acm_by_category[meta_category + "_female"] = []
-        column_idx += 3
-    year = None
-    week = None
-    for line in all_lines[3:]:
-        line = line.strip()
-        if not line:
-            break
-        cells = line.strip().split(";")
-        assert cells[0] == '"KOKO MAA"'
-        year_week_match = YEAR_WEEK_RE.match(cells[1])
-        assert year_week_match, "No match: %s" % (cells[1],)
-        year = int(year_week_match.group(1))
-        week = int(year_week_match.group(2))
-        deaths = int(cells[2])
-        male_deaths = int(cells[3])
-        female_deaths = int(cells[4])
-        begin_date = get_date_from_isoweek(year, week)
-        # sanity check for data
-        assert year >= 1900 and year < 2100
-        assert week >= 1 and week <= 53
-        assert begin_date >= datetime.date(1900, 1, 1) and begin_date < datetime.date(2100, 1, 1)
-        assert deaths > 0 and deaths < 10000
-        out_tuples.append((begin_date, deaths))
-        
-        category_deaths_sum = 0
-        male_deaths_sum = 0
-        female_deaths_sum = 0
-        column_idx = 5
-        output_meta_categories = dict()
-        for age_start, age_end, meta_categories in age_categories:
-            category_key = str(age_start) + "-" 
-            if age_end:
-                category_key += str(age_end)
-            age_deaths = int(cells[column_idx])
-            age_male_deaths = int(cells[column_idx+1])
-            age_female_deaths = int(cells[column_idx+2])
-            assert age_deaths == age_male_deaths + age_female_deaths
-            category_deaths_sum += age_deaths
-            acm_by_category[category_key].append((begin_date, age_deaths))
-            male_deaths_sum += age_male_deaths
-            acm_by_category[category_key + "_male"].append((begin_date, age_male_deaths))
-            female_deaths_sum += age_female_deaths
-            acm_by_category[category_key + "_female"].append((begin_date, age_female_deaths))
-            for meta_category in meta_categories:
-                if meta_category not in output_meta_categories:
-                    output_meta_categories[meta_category] = 0
-                    output_meta_categories[meta_category + "_male"] = 0
-                    output_meta_categories[meta_category + "_female"] = 0
-                output_meta_categories[meta_category] += age_deaths
-                output_meta_categories[meta_category + "_male"] += age_male_deaths
-                output_meta_categories[meta_category + "_female"] += age_female_deaths
-            column_idx += 3
-        for meta_category, meta_category_sum in output_meta_categories.items():
-            acm_by_category[meta_category].append((begin_date, meta_category_sum))
-        assert category_deaths_sum == deaths
-        assert male_deaths_sum == male_deaths
-        assert female_deaths_sum == female_deaths
+def parse_finland_weekly_mortality_csv(csv_file, trim_weeks_from_end, validation_mode=VALIDATION_STRICT):
+    table = read_pxweb_csv(csv_file, FINLAND_WEEKLY_MORTALITY_COLUMNS)
+    week_index = WeekIndex.from_isoweeks(*split_period_labels(table["week"], "W"))
+    value_keys = [column.key for column in FINLAND_WEEKLY_MORTALITY_COLUMNS if column.kind == "int"]
+    band_category_keys = value_keys[3:]
+    values = numpy.column_stack([table[key] for key in value_keys]).astype(numpy.int32)
+    total_deaths = values[:, :3]
+    band_deaths = values[:, 3:]
+    band_deaths_by_sex = band_deaths.reshape((len(values), len(FINLAND_ACM_AGE_CATEGORIES), len(SEX_SUFFIXES)))
+    # sanity check for data
+    validator = Validator("weekly ACM", table["week"], validation_mode)
+    validator.check(table["region"] == "KOKO MAA", "Region is not KOKO MAA")
+    validator.check((week_index.x_date >= numpy.datetime64("1900-01-01")) & (week_index.x_date < numpy.datetime64("2100-01-01")),
+                    "Week out of range")
+    validator.check((total_deaths[:, 0] > 0) & (total_deaths[:, 0] < 10000), "Total deaths out of range")
+    validator.check(values >= 0, "Negative deaths")
+    validator.check(band_deaths_by_sex[:, :, 0] == band_deaths_by_sex[:, :, 1] + band_deaths_by_sex[:, :, 2],
+                    "Male and female deaths do not add up to total", strict=True)
+    validator.check(band_deaths_by_sex.sum(axis=1) == total_deaths, "Age band deaths do not add up to total", strict=True)
+    validator.validate()
+    meta_category_keys, meta_grouping = get_finland_acm_meta_grouping()
+    meta_deaths = band_deaths @ meta_grouping
+    weekly_mortality = WeeklyMortality(week_index,
+                                       numpy.concatenate((total_deaths, band_deaths, meta_deaths), axis=1),
+                                       ["total" + suffix for suffix in SEX_SUFFIXES] + band_category_keys + meta_category_keys)
     # trim data from end because it is not final
-    return out_tuples[:-trim_weeks_from_end], dict(((k, v[:-trim_weeks_from_end]) for k, v in acm_by_category.items()))
+    return weekly_mortality.trim(trim_weeks_from_end)
+
+def get_finland_acm_by_category_keys():
+    """Category keys of the old *acm_by_category* dict, in its insertion order."""
+    category_keys = []
+    for age_start, age_end, meta_categories in FINLAND_ACM_AGE_CATEGORIES:
+        for key in [get_age_category_key(age_start, age_end)] + meta_categories:
+            for suffix in SEX_SUFFIXES:
+                if key + suffix not in category_keys:
+                    category_keys.append(key + suffix)
+    return category_keys
+
+def parse_finland_acm_csv(csv_file, trim_weeks_from_end, validation_mode=VALIDATION_STRICT):
+    weekly_mortality = parse_finland_weekly_mortality_csv(csv_file, trim_weeks_from_end, validation_mode)
+    return (weekly_mortality.as_tuples("total"),
+            WeeklyMortalityCategories(weekly_mortality, get_finland_acm_by_category_keys()))
+
+class RegionWeeklyMortality:
+    """
+    Weekly deaths of several regions by age band. *deaths* is an int32 cube
+    indexed [region, week, age band], with the age bands of
+    FINLAND_ACM_AGE_CATEGORIES as *categories*.
+    """
+    def __init__(self, regions, week_index, deaths, categories):
+        assert deaths.shape == (len(regions), len(week_index), len(categories))
+        self.regions = list(regions)
+        self.week_index = week_index
+        self.week_x_date = week_index.x_date
+        self.deaths = deaths
+        self.categories = list(categories)
+
+    def __len__(self):
+        return len(self.regions)
+
+    def total(self):
+        """Deaths of all age bands, indexed [region, week]."""
+        return self.deaths.sum(axis=2)
+
+    def select(self, regions):
+        """RegionWeeklyMortality of *regions* only, in the given order."""
+        rows = [self.regions.index(region) for region in regions]
+        return RegionWeeklyMortality(regions, self.week_index, self.deaths[rows], self.categories)
+
+def concatenate_region_mortality(chunks):
+    """Join RegionWeeklyMortality *chunks* with the same weeks into one."""
+    chunks = list(chunks)
+    if not chunks:
+        raise ValueError("No regions")
+    return RegionWeeklyMortality([region for chunk in chunks for region in chunk.regions], chunks[0].week_index,
+                                 numpy.concatenate([chunk.deaths for chunk in chunks]), chunks[0].categories)
+
+FINLAND_NATIONAL_REGION = "KOKO MAA"
+# Region labels of the maakunta (NUTS 3) regions start with "MKnn", the larger
+# "MAn" areas group them into mainland Finland and Åland
+FINLAND_MAAKUNTA_REGION_PREFIX = "MK"
+
+def get_finland_maakunta_regions(region_weekly_mortality):
+    return [region for region in region_weekly_mortality.regions if region.startswith(FINLAND_MAAKUNTA_REGION_PREFIX)]
+
+class FinlandRegionTotals:
+    """
+    Sums of the deaths of the maakunta regions and the national KOKO MAA
+    deaths of RegionWeeklyMortality chunks added one at a time, to check
+    that they add up in every week and age band.
+    """
+    def __init__(self):
+        self.week_x_date = None
+        self.maakunta_deaths = 0
+        self.national_deaths = None
+
+    def add(self, region_weekly_mortality):
+        self.week_x_date = region_weekly_mortality.week_x_date
+        self.maakunta_deaths = self.maakunta_deaths + region_weekly_mortality.select(
+            get_finland_maakunta_regions(region_weekly_mortality)).deaths.sum(axis=0)
+        if FINLAND_NATIONAL_REGION in region_weekly_mortality.regions:
+            self.national_deaths = region_weekly_mortality.select([FINLAND_NATIONAL_REGION]).deaths[0]
+
+    def validate(self, validation_mode=VALIDATION_STRICT):
+        if self.national_deaths is None:
+            raise ValueError("No %s rows in regional weekly ACM" % (FINLAND_NATIONAL_REGION,))
+        validator = Validator("regional weekly ACM", self.week_x_date, validation_mode)
+        validator.check(self.maakunta_deaths == self.national_deaths, "Regional deaths do not add up to %s" % (FINLAND_NATIONAL_REGION,),
+                        strict=True)
+        validator.validate()
+
+FINLAND_REGION_MORTALITY_COLUMNS = (
+    (PxWebColumn("region", "Alue", "label"),
+     PxWebColumn("week", "Viikko", "label"),
+     PxWebColumn("total", "Yhteensä Yhteensä Kuolleet", "int")) +
+    tuple(PxWebColumn(get_age_category_key(age_start, age_end),
+                      "%s Yhteensä Kuolleet" % (get_pxweb_age_heading(age_start, age_end),), "int")
+          for age_start, age_end, _ in FINLAND_ACM_AGE_CATEGORIES))
+
+def iter_region_mortality_chunks(tables, trim_weeks_from_end, regions_per_chunk, validation_mode):
+    """
+    Group the rows of region-major PX-Web *tables* into RegionWeeklyMortality
+    chunks of *regions_per_chunk* regions. Only the region being read and the
+    chunk being filled are kept in memory.
+    """
+    band_keys = [get_age_category_key(age_start, age_end) for age_start, age_end, _ in FINLAND_ACM_AGE_CATEGORIES]
+    week_index = None
+    seen_regions = set()
+    chunk_regions = []
+    chunk_deaths = []
+    region_weeks = []
+    region_deaths = []
+    def finish_region():
+        nonlocal week_index
+        region = region_weeks[0][0]
+        if region in seen_regions:
+            raise ValueError("Rows of region %s are not contiguous" % (region,))
+        seen_regions.add(region)
+        region_week_index = WeekIndex(numpy.concatenate([week_x_date for _, week_x_date in region_weeks]))
+        if week_index is None:
+            week_index = region_week_index
+        if not numpy.array_equal(region_week_index.x_date, week_index.x_date):
+            raise ValueError("Weeks of region %s differ from the weeks of the first region" % (region,))
+        chunk_regions.append(region)
+        chunk_deaths.append(numpy.concatenate(region_deaths))
+        region_weeks.clear()
+        region_deaths.clear()
+    def make_chunk():
+        weeks = len(week_index) - max(trim_weeks_from_end, 0)
+        chunk = RegionWeeklyMortality(chunk_regions, week_index[:weeks],
+                                      numpy.stack([deaths[:weeks] for deaths in chunk_deaths]), band_keys)
+        chunk_regions.clear()
+        chunk_deaths.clear()
+        return chunk
+    for table in tables:
+        deaths = numpy.column_stack([table[key] for key in band_keys]).astype(numpy.int32)
+        validator = Validator("regional weekly ACM", (table["region"], table["week"]), validation_mode)
+        validator.check(deaths >= 0, "Negative deaths")
+        validator.check(deaths.sum(axis=1) == table["total"], "Age band deaths do not add up to total", strict=True)
+        validator.validate()
+        week_x_date = WeekIndex.from_isoweeks(*split_period_labels(table["week"], "W")).x_date
+        regions = table["region"]
+        segment_starts = [0] + (numpy.flatnonzero(regions[1:] != regions[:-1]) + 1).tolist()
+        segment_ends = segment_starts[1:] + [len(regions)]
+        for segment_start, segment_end in zip(segment_starts, segment_ends):
+            region = str(regions[segment_start])
+            if region_weeks and region_weeks[0][0] != region:
+                finish_region()
+                if len(chunk_regions) == regions_per_chunk:
+                    yield make_chunk()
+            region_weeks.append((region, week_x_date[segment_start:segment_end]))
+            region_deaths.append(deaths[segment_start:segment_end])
+    if region_weeks:
+        finish_region()
+    if chunk_regions:
+        yield make_chunk()
+
+# Parse CSV file downloaded from:
+# https://pxnet2.stat.fi/PXWeb/pxweb/fi/Kokeelliset_tilastot/Kokeelliset_tilastot__vamuu_koke/koeti_vamuu_pxt_12ng.px/
+#
+# Choices for obtaining CSV:
+#   Alue = Valitse kaikki
+#   Viikko = Valitse kaikki
+#   Ikä = Valitse kaikki
+#   Sukupuoli = Yhteensä
+#
+# Click Lataa taulukko > Lataa puolipiste-eroteltu csv-tiedosto (otsikollinen)
+#
+def iter_finland_region_mortality_csv(csv_file, trim_weeks_from_end, regions_per_chunk=1, chunk_rows=PXWEB_CHUNK_ROWS,
+                                      validation_mode=VALIDATION_STRICT):
+    return iter_region_mortality_chunks(iter_pxweb_csv_chunks(csv_file, FINLAND_REGION_MORTALITY_COLUMNS, chunk_rows),
+                                        trim_weeks_from_end, regions_per_chunk, validation_mode)
+
+def parse_finland_region_mortality_csv(csv_file, trim_weeks_from_end, validation_mode=VALIDATION_STRICT):
+    """All regions of the region-level weekly ACM file as one RegionWeeklyMortality."""
+    return concatenate_region_mortality(iter_finland_region_mortality_csv(csv_file, trim_weeks_from_end,
+                                                                          validation_mode=validation_mode))
+
+def prefetch_chunks(chunks):
+    """
+    Iterate *chunks* while the next chunk is already being read in a
+    background thread, so that parsing overlaps with processing the current one.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        next_chunk = executor.submit(next, chunks, None)
+        while True:
+            chunk = next_chunk.result()
+            if chunk is None:
+                return
+            next_chunk = executor.submit(next, chunks, None)
+            yield chunk
 
 THL_YEAR_WEEK_RE = re.compile(r"Vuosi (\d\d\d\d) Viikko (\d\d)")
+THL_COVID_MEASURES = ("Tapausten lukumäärä",
+                      "Testausmäärä",
+                      "Kuolemantapausten lukumäärä")
+THL_VERIFIED_COVID_MEASURES = ("Tapausten lukumäärä",
+                               "Testausmäärä",
+                               "Koronasta johtuvat kuolemat, kuolintodistus (alustava tieto)",
+                               "Kuolemat joissa korona myötävaikuttavana tekijänä, kuolintodistus (alustava tieto)")
+THL_VERIFIED_COVID_IGNORED_MEASURES = ("Koronaan ajallisesti liittyvät kuolemat (30 vrk), tartuntatautirekisteri",)
+
+def read_thl_weekly_measures(csv_file, measures, ignored_measures, validation_mode):
+    """
+    Read a THL CSV export with one row per measure and week into a WeekIndex
+    and an int64 matrix indexed [week, measure] in the order of *measures*.
+    Empty cells are 0 and the "Kaikki ajat" summary rows at the end are skipped.
+    """
+    heading_line = csv_file.readline().strip()
+    if heading_line != "Mittari;Aika;val":
+        raise ValueError("Unexpected heading: %s" % (heading_line,))
+    rows = []
+    for line in csv_file:
+        line = line.strip()
+        if not line or ";Kaikki ajat;" in line:
+            break
+        rows.append(line.split(";"))
+    row_validator = Validator("THL weekly data", numpy.arange(2, len(rows)+2), validation_mode)
+    row_validator.check(numpy.array([len(cells) == 3 for cells in rows], dtype=bool), "Wrong number of cells on lines")
+    row_validator.validate()
+    cells = numpy.array(rows, dtype=str).reshape((len(rows), 3))
+    row_measures = cells[:, 0]
+    row_validator.check(numpy.isin(row_measures, measures + tuple(ignored_measures)), "Unknown measure on lines")
+    week_indices, week_labels = pandas.factorize(cells[:, 1])
+    week_matches = [THL_YEAR_WEEK_RE.fullmatch(week_label) for week_label in week_labels]
+    row_validator.check(numpy.array([week_matches[week_indices[row]] is not None for row in range(len(rows))], dtype=bool),
+                        "Malformed week on lines")
+    row_validator.check(numpy.char.isdigit(cells[:, 2]) | (cells[:, 2] == ""), "Malformed value on lines")
+    row_validator.validate()
+    week_index = WeekIndex.from_isoweeks([int(week_match.group(1)) for week_match in week_matches],
+                                         [int(week_match.group(2)) for week_match in week_matches])
+    measured = numpy.isin(row_measures, measures)
+    measure_indices = numpy.searchsorted(numpy.array(measures), row_measures[measured], sorter=numpy.argsort(measures))
+    measure_indices = numpy.argsort(measures)[measure_indices]
+    row_counts = numpy.zeros((len(week_index), len(measures)), dtype=numpy.int64)
+    numpy.add.at(row_counts, (week_indices[measured], measure_indices), 1)
+    values = numpy.zeros((len(week_index), len(measures)), dtype=numpy.int64)
+    values[week_indices[measured], measure_indices] = numpy.where(cells[measured, 2] == "", "0", cells[measured, 2]).astype(numpy.int64)
+    week_validator = Validator("THL weekly data", numpy.asarray(week_labels, dtype=str), validation_mode)
+    week_validator.check(row_counts == 1, "Weeks without exactly one row of each measure")
+    week_validator.check(numpy.diff(week_index.x_date, prepend=week_index.x_date[:1] - 7) > numpy.timedelta64(0, "D"),
+                         "Weeks out of order", strict=True)
+    week_validator.validate()
+    return week_index, values
 
 # Parse CSV file downloaded from:
 # https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19case/fact_epirapo_covid19case?row=dateweek20200101-509030&column=measure-444833.445356.492118.&fo=1
 # 
 # Click: Vie taulukko > CSV-tiedostoon
 #
-def parse_finland_thl_covid_data_csv(csv_file):
-    out_tuples = []
-    all_lines = list(csv_file.readlines())
-    heading_line = all_lines[0].strip()
-    assert heading_line == "Mittari;Aika;val"
-    cur_year = None
-    cur_week = None
-    cur_begin_date = None
-    cur_covid_cases = None
-    cur_covid_tests = None
-    for line_idx, line in enumerate(all_lines[1:]):
-        line_no = line_idx+2
-        line = line.strip()
-        if not line or ";Kaikki ajat;" in line:
-            break
-        cells = line.split(";")
-        line_type = cells[0]
-        year_week_match = THL_YEAR_WEEK_RE.fullmatch(cells[1])
-        assert year_week_match is not None
-        year = int(year_week_match.group(1))
-        week = int(year_week_match.group(2))
-        begin_date = get_date_from_isoweek(year, week)
-        if line_type == "Tapausten lukumäärä":
-            cur_covid_cases = int(cells[2] or 0)
-            assert cur_year == None
-            assert cur_week == None
-            assert cur_begin_date == None
-            cur_year = year
-            cur_week = week
-            cur_begin_date = begin_date
-        elif line_type == "Testausmäärä":
-            assert cur_year == year, "Year %s != %s on line %d" % (cur_year, year, line_no)
-            assert cur_week == week
-            assert cur_begin_date == begin_date
-            cur_covid_tests = int(cells[2] or 0)
-        elif line_type == "Kuolemantapausten lukumäärä":
-            assert cur_year == year
-            assert cur_week == week
-            assert cur_begin_date == begin_date
-            assert cur_covid_cases is not None
-            assert cur_covid_tests is not None
-            covid_deaths = int(cells[2] or 0)
-            out_tuples.append((begin_date, covid_deaths, cur_covid_cases, cur_covid_tests))
-            cur_year = None
-            cur_week = None
-            cur_begin_date = None
-            cur_covid_cases = None
-            cur_covid_tests = None
-        else:
-            assert False, "Unkown line type: %s" % (line_type,)
-    return out_tuples
+def parse_finland_thl_covid_data_csv(csv_file, validation_mode=VALIDATION_STRICT):
+    week_index, measures = read_thl_weekly_measures(csv_file, THL_COVID_MEASURES, (), validation_mode)
+    return [(begin_date,) + tuple(row) for begin_date, row in zip(week_index.dates, measures[:, [2, 0, 1]].tolist())]
 
 # Parse CSV file downloaded from:
 # https://sampo.thl.fi/pivot/prod/fi/epirapo/covid19case/fact_epirapo_covid19case?row=dateweek20200101-509030&column=measure-444833.445356.492118.816930.816957.&fo=1
 # 
 # Click: Vie taulukko > CSV-tiedostoon
 #
-def parse_finland_thl_verified_covid_data_csv(csv_file):
-    out_tuples = []
-    all_lines = list(csv_file.readlines())
-    heading_line = all_lines[0].strip()
-    assert heading_line == "Mittari;Aika;val"
-    cur_year = None
-    cur_week = None
-    cur_begin_date = None
-    cur_covid_cases = None
-    cur_covid_tests = None
-    cur_covid_caused_deaths = None
-    for line_idx, line in enumerate(all_lines[1:]):
-        line_no = line_idx+2
-        line = line.strip()
-        if not line or ";Kaikki ajat;" in line:
-            break
-        cells = line.split(";")
-        line_type = cells[0]
-        year_week_match = THL_YEAR_WEEK_RE.fullmatch(cells[1])
-        assert year_week_match is not None
-        year = int(year_week_match.group(1))
-        week = int(year_week_match.group(2))
-        begin_date = get_date_from_isoweek(year, week)
-        if line_type == "Tapausten lukumäärä":
-            cur_covid_cases = int(cells[2] or 0)
-            assert cur_year == None
-            assert cur_week == None
-            assert cur_begin_date == None
-            cur_year = year
-            cur_week = week
-            cur_begin_date = begin_date
-        elif line_type == "Testausmäärä":
-            assert cur_year == year, "Year %s != %s on line %d" % (cur_year, year, line_no)
-            assert cur_week == week
-            assert cur_begin_date == begin_date
-            cur_covid_tests = int(cells[2] or 0)
-        elif line_type == "Koronaan ajallisesti liittyvät kuolemat (30 vrk), tartuntatautirekisteri":
-            continue
-        elif line_type == "Koronasta johtuvat kuolemat, kuolintodistus (alustava tieto)":
-            assert cur_year == year
-            assert cur_week == week
-            assert cur_begin_date == begin_date
-            assert cur_covid_cases is not None
-            assert cur_covid_tests is not None
-            cur_covid_caused_deaths = int(cells[2] or 0)
-        elif line_type == "Kuolemat joissa korona myötävaikuttavana tekijänä, kuolintodistus (alustava tieto)":
-            assert cur_year == year
-            assert cur_week == week
-            assert cur_begin_date == begin_date
-            assert cur_covid_cases is not None
-            assert cur_covid_tests is not None
-            assert cur_covid_tests is not None
-            assert cur_covid_caused_deaths is not None
-            covid_contributory_deaths = int(cells[2] or 0)
-            covid_caused_or_contributory_deaths = cur_covid_caused_deaths + covid_contributory_deaths
-            out_tuples.append((begin_date, cur_covid_caused_deaths, cur_covid_cases, cur_covid_tests,
-                               cur_covid_caused_deaths, covid_contributory_deaths))
-            cur_year = None
-            cur_week = None
-            cur_begin_date = None
-            cur_covid_cases = None
-            cur_covid_tests = None
-            cur_covid_caused_deaths = None
-        else:
-            assert False, "Unkown line type: %s" % (line_type,)
-    return out_tuples
+def parse_finland_thl_verified_covid_data_csv(csv_file, validation_mode=VALIDATION_STRICT):
+    week_index, measures = read_thl_weekly_measures(csv_file, THL_VERIFIED_COVID_MEASURES, THL_VERIFIED_COVID_IGNORED_MEASURES, validation_mode)
+    return [(begin_date,) + tuple(row) for begin_date, row in zip(week_index.dates, measures[:, [2, 0, 1, 2, 3]].tolist())]
+
+EUROMOMO_POOLED_COUNTRY = "Pooled"
+EUROMOMO_ZSCORE_DECIMALS = 2
+
+class EuroMomoZScores:
+    """
+    EuroMoMo z-scores as a float32 cube indexed [week, country, group], with
+    NaN where a country has no z-score for the week. The pooled files have no
+    country column, and their only country is EUROMOMO_POOLED_COUNTRY.
+    """
+    def __init__(self, week_index, countries, groups, zscores):
+        assert zscores.shape == (len(week_index), len(countries), len(groups))
+        self.week_index = week_index
+        self.week_x_date = week_index.x_date
+        self.countries = numpy.asarray(countries)
+        self.groups = numpy.asarray(groups)
+        self.zscores = zscores
+        self.country_columns = dict(((country, index) for index, country in enumerate(self.countries.tolist())))
+        self.group_columns = dict(((group, index) for index, group in enumerate(self.groups.tolist())))
+
+    def __len__(self):
+        return len(self.week_x_date)
+
+    @property
+    def values(self):
+        return self.zscores
+
+    @property
+    def axis_labels(self):
+        """Labels of the axes after the week axis of *values*."""
+        return (self.countries, self.groups)
 
-EUROMOMO_YEAR_WEEK_RE = re.compile(r"(\d\d\d\d)-(\d\d)")
+    def matrix(self, group="Total"):
+        """z-scores of *group* indexed [week, country]."""
+        return self.zscores[:, :, self.group_columns[group]]
+
+    def column(self, country, group="Total"):
+        return self.zscores[:, self.country_columns[country], self.group_columns[group]]
+
+    def as_tuples(self, country, group="Total"):
+        """
+        List of (datetime.date, zscore) tuples for the weeks with a z-score,
+        for code written against the old parser output. The values are rounded
+        back to the published decimals, so they equal the parsed CSV cells.
+        """
+        zscores = self.column(country, group)
+        present = ~numpy.isnan(zscores)
+        return [(date, round(zscore, EUROMOMO_ZSCORE_DECIMALS))
+                for date, zscore in zip(self.week_index.dates[present].tolist(), zscores[present].tolist())]
 
 # Parse CSV file downloaded from:
 # https://www.euromomo.eu/graphs-and-maps/
 # 
 # Click: Z-scores by country > All ages, Countries Finland > Download data
 #
-def parse_euromomo_zscores_csv(csv_file):
-    out_tuples = []
-    all_lines = list(csv_file.readlines())
-    heading_line = all_lines[0].strip()
-    assert heading_line == "country;group;week;zscore"
-    cur_begin_date = None
-    cur_item = None
-    for line_idx, line in enumerate(all_lines[1:]):
-        line_no = line_idx+2
-        line = line.strip()
-        if not line:
-            break
-        cells = line.split(";")
-        assert len(cells) == 4
-        country = cells[0]
-        assert country
-        line_type = cells[1]
-        if line_type != "Total":
-            continue
-        year_week_match = EUROMOMO_YEAR_WEEK_RE.fullmatch(cells[2])
-        assert year_week_match is not None
-        year = int(year_week_match.group(1))
-        week = int(year_week_match.group(2))
-        begin_date = get_date_from_isoweek(year, week)
-        if cells[3]:
-            z_score = float(cells[3])
-            if begin_date != cur_begin_date:
-                if cur_item:
-                    out_tuples.append((cur_begin_date, cur_item))
-                cur_item = dict()
-                cur_begin_date = begin_date
-            cur_item[country] = z_score
-    if cur_item:
-        out_tuples.append((cur_begin_date, cur_item))
-    return out_tuples
+# or for the pooled z-scores:
+#
+# Click: Pooled estimates by age group > Z-scores > Download data
+#
+def parse_euromomo_zscores_csv(csv_file, validation_mode=VALIDATION_STRICT):
+    rows = pandas.read_csv(csv_file, sep=";", dtype={"country": str, "group": str, "week": str, "zscore": numpy.float32},
+                           keep_default_na=False, na_values={"zscore": [""]})
+    if list(rows.columns) not in (["country", "group", "week", "zscore"], ["group", "week", "zscore"]):
+        raise ValueError("Unexpected heading: %s" % (list(rows.columns),))
+    has_countries = "country" in rows.columns
+    row_labels = ((rows["country"].to_numpy(),) if has_countries else ()) + (rows["group"].to_numpy(), rows["week"].to_numpy())
+    validator = Validator("EuroMoMo z-scores", row_labels, validation_mode)
+    if has_countries:
+        validator.check(rows["country"].to_numpy() != "", "Empty country")
+    validator.check(rows["group"].to_numpy() != "", "Empty group")
+    validator.validate()
+    if has_countries:
+        country_indices, countries = pandas.factorize(rows["country"])
+    else:
+        country_indices, countries = numpy.zeros(len(rows), dtype=numpy.int64), [EUROMOMO_POOLED_COUNTRY]
+    group_indices, groups = pandas.factorize(rows["group"])
+    # YYYY-WW labels sort chronologically, so only the unique labels need converting
+    week_indices, week_labels = pandas.factorize(rows["week"], sort=True)
+    week_index = WeekIndex.from_isoweeks(*split_period_labels(numpy.asarray(week_labels, dtype=str), "-"))
+    cell_indices = (week_indices * len(countries) + country_indices) * len(groups) + group_indices
+    validator.check(~pandas.Series(cell_indices).duplicated().to_numpy(), "Duplicate z-score rows", strict=True)
+    validator.validate()
+    zscores = numpy.full((len(week_index), len(countries), len(groups)), numpy.nan, dtype=numpy.float32)
+    zscores[week_indices, country_indices, group_indices] = rows["zscore"].to_numpy()
+    return EuroMomoZScores(week_index, numpy.asarray(countries, dtype=str), numpy.asarray(groups, dtype=str), zscores)
+
+EUROMOMO_NUMBERS_QUANTITIES = ("Low normal range", "High normal range", "Baseline", "Substantial increase", "Observed count")
+
+class EuroMomoNumbers:
+    """
+    EuroMoMo pooled death counts and baseline ranges as a float64 cube indexed
+    [week, group, quantity], with the quantities of EUROMOMO_NUMBERS_QUANTITIES.
+    """
+    def __init__(self, week_index, groups, numbers):
+        assert numbers.shape == (len(week_index), len(groups), len(EUROMOMO_NUMBERS_QUANTITIES))
+        self.week_index = week_index
+        self.week_x_date = week_index.x_date
+        self.groups = numpy.asarray(groups)
+        self.quantities = numpy.array(EUROMOMO_NUMBERS_QUANTITIES)
+        self.numbers = numbers
+        self.group_columns = dict(((group, index) for index, group in enumerate(self.groups.tolist())))
+
+    def __len__(self):
+        return len(self.week_x_date)
+
+    @property
+    def values(self):
+        return self.numbers
+
+    @property
+    def axis_labels(self):
+        """Labels of the axes after the week axis of *values*."""
+        return (self.groups, self.quantities)
+
+    def column(self, group, quantity):
+        return self.numbers[:, self.group_columns[group], EUROMOMO_NUMBERS_QUANTITIES.index(quantity)]
+
+# Parse CSV file downloaded from:
+# https://www.euromomo.eu/graphs-and-maps/
+#
+# Click: Pooled estimates by age group > Number of deaths > Download data
+#
+def parse_euromomo_numbers_csv(csv_file, validation_mode=VALIDATION_STRICT):
+    rows = pandas.read_csv(csv_file, sep=";", dtype=dict([("group", str), ("week", str)] +
+                                                          [(quantity, numpy.float64) for quantity in EUROMOMO_NUMBERS_QUANTITIES]),
+                           keep_default_na=False, na_values=dict(((quantity, [""]) for quantity in EUROMOMO_NUMBERS_QUANTITIES)))
+    if list(rows.columns) != ["group", "week"] + list(EUROMOMO_NUMBERS_QUANTITIES):
+        raise ValueError("Unexpected heading: %s" % (list(rows.columns),))
+    validator = Validator("EuroMoMo numbers", (rows["group"].to_numpy(), rows["week"].to_numpy()), validation_mode)
+    validator.check(rows["group"].to_numpy() != "", "Empty group")
+    validator.validate()
+    group_indices, groups = pandas.factorize(rows["group"])
+    week_indices, week_labels = pandas.factorize(rows["week"], sort=True)
+    week_index = WeekIndex.from_isoweeks(*split_period_labels(numpy.asarray(week_labels, dtype=str), "-"))
+    cell_indices = week_indices * len(groups) + group_indices
+    validator.check(~pandas.Series(cell_indices).duplicated().to_numpy(), "Duplicate rows", strict=True)
+    validator.validate()
+    numbers = numpy.full((len(week_index), len(groups), len(EUROMOMO_NUMBERS_QUANTITIES)), numpy.nan)
+    numbers[week_indices, group_indices] = rows[list(EUROMOMO_NUMBERS_QUANTITIES)].to_numpy()
+    return EuroMomoNumbers(week_index, numpy.asarray(groups, dtype=str), numbers)
+
+FINLAND_POPULATION_MAX_AGE = 112
+
+class PopulationByAge:
+    """
+    Population at the end of each year by single year of age, as an int32 cube
+    indexed [year, age, sex] with sex in the order of SEX_SUFFIXES. Cumulative
+    sums over age make the population of any age band a constant time lookup.
+    """
+    def __init__(self, years, population):
+        assert population.shape[0] == len(years) and population.shape[2] == len(SEX_SUFFIXES)
+        assert (numpy.diff(years) > 0).all()
+        self.years = numpy.asarray(years)
+        self.population = population
+        # cumulative_population[year, age, sex] is the population younger than age
+        self.cumulative_population = numpy.zeros((population.shape[0], population.shape[1]+1, population.shape[2]), dtype=numpy.int64)
+        numpy.cumsum(population, axis=1, out=self.cumulative_population[:, 1:])
+
+    def __len__(self):
+        return len(self.years)
+
+    def contains(self, years):
+        """Whether each of *years* has population data."""
+        year_indices = numpy.minimum(self.years.searchsorted(years), len(self.years)-1)
+        return self.years[year_indices] == years
+
+    def age_populations(self, year):
+        """Population of *year* indexed [age, sex]."""
+        return self.population[self.years.searchsorted(year)]
+
+    def band(self, years, age_start, age_end, sex_index=0):
+        """
+        Population aged *age_start*...*age_end* (inclusive, None for no upper
+        limit) in each of *years*.
+        """
+        assert self.contains(years).all()
+        year_indices = self.years.searchsorted(years)
+        age_stop = self.population.shape[1] if age_end is None else min(age_end+1, self.population.shape[1])
+        return (self.cumulative_population[year_indices, age_stop, sex_index] -
+                self.cumulative_population[year_indices, age_start, sex_index])
+FINLAND_POPULATION_BY_AGE_COLUMNS = (
+    (PxWebColumn("year", "Vuosi", "int"),) +
+    tuple(column
+          for suffix, sex_heading in zip(SEX_SUFFIXES, PXWEB_SEX_HEADINGS)
+          for column in ((PxWebColumn("population_total" + suffix, "%s Yhteensä Väestö 31.12." % (sex_heading,), "int"),) +
+                         tuple(PxWebColumn("population_%d%s" % (age, suffix), "%s %d Väestö 31.12." % (sex_heading, age), "int")
+                               for age in range(FINLAND_POPULATION_MAX_AGE+1)))))
 
 # Parse CSV file downloaded from:
 # https://pxnet2.stat.fi/PXWeb/pxweb/fi/StatFin/StatFin__vrm__vaerak/statfin_vaerak_pxt_11rd.px/
@@ -472,42 +1009,31 @@ def parse_euromomo_zscores_csv(csv_file):
 # 
 # Click: Lataa taulukko > Lataa puolipiste-eroteltu csv-tiedosto (otsikollinen)
 #
-def parse_finland_tilastokeskus_population_csv(csv_file):
-    population_by_year_and_age = {}
-    all_lines = list(csv_file.readlines())
-    heading_line = all_lines[2].strip()
-    heading_cells = heading_line.split(";")
-    assert heading_cells[0] == '"Vuosi"'
-    assert heading_cells[1].startswith('"Yhteensä Yhteensä Väestö')
-    max_age = 112
-    for age in range(0, max_age+1):
-        assert heading_cells[2+age].startswith('"Yhteensä ' + str(age) + ' Väestö')
-        assert heading_cells[2+max_age+2+age].startswith('"Miehet ' + str(age) + ' Väestö')
-        assert heading_cells[2+2*(max_age+2)+age].startswith('"Naiset ' + str(age) + ' Väestö')
-    for line_idx, line in enumerate(all_lines[3:]):
-        cells = line.strip().split(";")
-        year = int(cells[0].strip('"'))
-        assert 1900 <= year <= 2100
-        year_total_population = int(cells[1])
-        year_population_sum = 0
-        assert year not in population_by_year_and_age
-        population_by_year_and_age[year] = {
-            "year_total": year_total_population,
-        }
-        for age in range(0, max_age+1):
-            age_population = int(cells[2+age].strip('"'))
-            assert 0 <= age_population < 1000000
-            age_male_population = int(cells[2+max_age+2+age].strip('"'))
-            assert 0 <= age_male_population < 1000000
-            age_female_population = int(cells[2+2*(max_age+2)+age].strip('"'))
-            assert 0 <= age_female_population < 1000000
-            assert age_male_population + age_female_population == age_population
-            assert age not in population_by_year_and_age[year]
-            population_by_year_and_age[year][age] = age_population, age_male_population, age_female_population
-            year_population_sum += age_population
-        assert year_total_population == year_population_sum
-    return population_by_year_and_age
+def parse_finland_tilastokeskus_population_csv(csv_file, validation_mode=VALIDATION_STRICT):
+    table = read_pxweb_csv(csv_file, FINLAND_POPULATION_BY_AGE_COLUMNS)
+    years = table["year"]
+    # population[year, age, sex], where sex is in the order of SEX_SUFFIXES
+    population = numpy.stack([numpy.column_stack([table["population_%d%s" % (age, suffix)] for suffix in SEX_SUFFIXES])
+                              for age in range(FINLAND_POPULATION_MAX_AGE+1)], axis=1)
+    population_totals = numpy.column_stack([table["population_total" + suffix] for suffix in SEX_SUFFIXES])
+    validator = Validator("population by age", years, validation_mode)
+    validator.check((years >= 1900) & (years <= 2100), "Year out of range")
+    validator.check(numpy.diff(years, prepend=years[:1] - 1) > 0, "Years not in increasing order")
+    validator.check((population >= 0) & (population < 1000000), "Population out of range")
+    validator.check(population[:, :, 1] + population[:, :, 2] == population[:, :, 0],
+                    "Male and female population do not add up to total", strict=True)
+    validator.check(population.sum(axis=1) == population_totals, "Age populations do not add up to total", strict=True)
+    validator.validate()
+    return PopulationByAge(years, population.astype(numpy.int32))
     
+FINLAND_DEATHS_FORECAST_YEARS = (2021, 2019, 2018, 2015, 2012, 2009, 2007)
+FINLAND_DEATHS_FORECAST_COLUMNS = (
+    (PxWebColumn("year", "Vuosi", "int"),
+     PxWebColumn("info", "Tiedot", "label"),
+     PxWebColumn("deaths_actual", "Yhteensä Todelliset tiedot", "int?")) +
+    tuple(PxWebColumn("deaths_forecast_%d" % (year,), "Yhteensä Väestöennuste %d" % (year,), "int?")
+          for year in FINLAND_DEATHS_FORECAST_YEARS))
+
 # Parse CSV file downloaded from:
 # https://pxnet2.stat.fi/PXWeb/pxweb/fi/StatFin/StatFin__vrm__vaenn/statfin_vaenn_pxt_139e.px/table/tableViewLayout1/
 # 
@@ -519,37 +1045,20 @@ def parse_finland_tilastokeskus_population_csv(csv_file):
 # 
 # Click: Lataa taulukko > Lataa puolipiste-eroteltu csv-tiedosto (otsikollinen)
 #
-def parse_finland_deaths_forecast_csv(csv_file):
-    all_lines = list(csv_file.readlines())
-    heading_line = all_lines[2].strip()
-    heading_cells = heading_line.split(";")
-    assert heading_cells[0] == '"Vuosi"'
-    assert heading_cells[1] == '"Tiedot"'
-    assert heading_cells[2] == '"Yhteensä Todelliset tiedot"'
-    years = (2021, 2019, 2018, 2015, 2012, 2009, 2007)
-    for index, year in enumerate(years):
-        assert heading_cells[3+index] == '"Yhteensä Väestöennuste ' + str(year) + '"'
-    def _parse_int(s):
-        if s == ".":
-            return None
-        else:
-            return int(s)
-    result = []
-    for line_idx, line in enumerate(all_lines[3:]):
-        cells = line.strip().split(";")
-        year = int(cells[0].strip('"'))
-        assert 1900 <= year <= 2100
-        assert cells[1] == '"Kuolleet"'
-        deaths_actual = _parse_int(cells[2])
-        output = {
-            "year": year,
-            "deaths_actual": deaths_actual,
-        }
-        for index, year in enumerate(years):
-            deaths_forecast = _parse_int(cells[3+index])
-            output["deaths_forecast_" + str(year)] = deaths_forecast
-        result.append(output)
-    return result
+def parse_finland_deaths_forecast_csv(csv_file, validation_mode=VALIDATION_STRICT):
+    table = read_pxweb_csv(csv_file, FINLAND_DEATHS_FORECAST_COLUMNS)
+    validator = Validator("deaths forecast", table["year"], validation_mode)
+    validator.check((table["year"] >= 1900) & (table["year"] <= 2100), "Year out of range")
+    validator.check(table["info"] == "Kuolleet", "Info is not Kuolleet")
+    validator.validate()
+    # masked cells become None
+    output_keys = [column.key for column in FINLAND_DEATHS_FORECAST_COLUMNS if column.key != "info"]
+    return [dict(zip(output_keys, row)) for row in zip(*[table[key].tolist() for key in output_keys])]
+
+FINLAND_DEATHS_AND_POPULATION_BY_MONTH_COLUMNS = (
+    PxWebColumn("month", "Kuukausi", "label"),
+    PxWebColumn("deaths", "Kuolleet", "int"),
+    PxWebColumn("population", "Väkiluku", "int"))
 
 # Parse CSV file downloaded from:
 # https://pxnet2.stat.fi/PXWeb/pxweb/fi/StatFin/StatFin__vrm__vamuu/statfin_vamuu_pxt_11ll.px/
@@ -560,36 +1069,35 @@ def parse_finland_deaths_forecast_csv(csv_file):
 # 
 # Click: Lataa taulukko > Lataa puolipiste-eroteltu csv-tiedosto (otsikollinen)
 #
-def parse_finland_deaths_and_population_by_month_csv(csv_file, trim_months_from_end):
-    all_lines = list(csv_file.readlines())
-    heading_line = all_lines[2].strip()
-    heading_cells = heading_line.split(";")
-    assert heading_cells[0] == '"Kuukausi"'
-    assert heading_cells[1] == '"Kuolleet"'
-    assert heading_cells[2] == '"Väkiluku"'
+def parse_finland_deaths_and_population_by_month_csv(csv_file, trim_months_from_end, validation_mode=VALIDATION_STRICT):
+    table = read_pxweb_csv(csv_file, FINLAND_DEATHS_AND_POPULATION_BY_MONTH_COLUMNS)
+    years, months = split_period_labels(table["month"], "M")
+    validator = Validator("deaths and population by month", table["month"], validation_mode)
+    validator.check((years >= 1900) & (years <= 2100), "Year out of range")
+    validator.check((months >= 1) & (months <= 12), "Month out of range")
+    validator.check(table["population"] > 0, "Population is not positive")
+    validator.validate()
+    deaths = table["deaths"]
+    population = table["population"]
     result = []
-    for line_idx, line in enumerate(all_lines[3:]):
-        if line == "\n":
-            break
-        cells = line.strip().split(";")
-        year_month_name = cells[0].strip('"').rstrip("*")
-        year_s, month_s = year_month_name.split("M")
-        year = int(year_s)
-        month = int(month_s)
-        assert 1900 <= year <= 2100
-        assert 1 <= month <= 12
-        deaths = int(cells[1])
-        population = int(cells[2])
+    for year, month, month_deaths, month_population, deaths_per_100k in zip(years.tolist(), months.tolist(), deaths.tolist(), population.tolist(),
+                                                                          (deaths / (population / 100000)).tolist()):
         output = {
             "year": year,
             "month": month,
-            "deaths": deaths,
-            "population": population,
-            "deaths_per_100k": deaths / (population / 100000),
+            "deaths": month_deaths,
+            "population": month_population,
+            "deaths_per_100k": deaths_per_100k,
         }
         result.append(output)
     return result[:-trim_months_from_end] if trim_months_from_end > 0 else result
 
+FINLAND_DEATHS_BY_MONTH_COLUMNS = (
+    (PxWebColumn("year", "Vuosi", "int"),
+     PxWebColumn("deaths_total", "Koko vuosi Kuolleet", "int")) +
+    tuple(PxWebColumn("deaths_%d" % (month,), "%s Kuolleet" % (month_heading,), "int")
+          for month, month_heading in enumerate(PXWEB_MONTH_HEADINGS, start=1)))
+
 # Parse CSV file downloaded from:
 # https://pxnet2.stat.fi/PXWeb/pxweb/fi/StatFin/StatFin__vrm__kuol/statfin_kuol_pxt_12ah.px/
 # 
@@ -601,33 +1109,28 @@ def parse_finland_deaths_and_population_by_month_csv(csv_file, trim_months_from_
 # 
 # Click: Lataa taulukko > Lataa puolipiste-eroteltu csv-tiedosto (otsikollinen)
 #
-def parse_finland_deaths_by_month_csv(csv_file):
-    all_lines = list(csv_file.readlines())
-    heading_line = all_lines[2].strip()
-    heading_cells = heading_line.split(";")
-    assert heading_cells[0] == '"Vuosi"'
-    assert heading_cells[1] == '"Koko vuosi Kuolleet"'
-    assert heading_cells[2] == '"Tammikuu Kuolleet"'
-    assert heading_cells[-1] == '"Joulukuu Kuolleet"'
+def parse_finland_deaths_by_month_csv(csv_file, validation_mode=VALIDATION_STRICT):
+    table = read_pxweb_csv(csv_file, FINLAND_DEATHS_BY_MONTH_COLUMNS)
+    month_deaths = numpy.column_stack([table["deaths_%d" % (month,)] for month in range(1, 13)])
+    validator = Validator("deaths by month", table["year"], validation_mode)
+    validator.check((table["year"] >= 1900) & (table["year"] <= 2100), "Year out of range")
+    validator.check(month_deaths.sum(axis=1) == table["deaths_total"], "Month deaths do not add up to total", strict=True)
+    validator.validate()
     result = []
-    for line_idx, line in enumerate(all_lines[3:]):
-        cells = line.strip().split(";")
-        year = int(cells[0].strip('"'))
-        assert 1900 <= year <= 2100
-        deaths_total = int(cells[1])
+    for year, deaths_total, year_month_deaths in zip(table["year"].tolist(), table["deaths_total"].tolist(), month_deaths.tolist()):
         output = {
             "year": year,
             "deaths_total": deaths_total,
         }
-        deaths_sum = 0
-        for month in range(1, 13):
-            month_deaths = int(cells[2+month-1])
-            output[month] = month_deaths
-            deaths_sum += month_deaths
-        assert deaths_sum == deaths_total
+        for month, deaths in enumerate(year_month_deaths, start=1):
+            output[month] = deaths
         result.append(output)
     return result
 
+FINLAND_POPULATION_BY_YEAR_COLUMNS = (
+    PxWebColumn("year", "Vuosi", "int"),
+    PxWebColumn("population", "Yhteensä Väestö 31.12.", "int"))
+
 # Parse CSV file downloaded from:
 # https://pxnet2.stat.fi/PXWeb/pxweb/fi/StatFin/StatFin__vrm__vaerak/statfin_vaerak_pxt_11rb.px/table/tableViewLayout1/
 # 
@@ -638,61 +1141,452 @@ def parse_finland_deaths_by_month_csv(csv_file):
 # 
 # Click: Lataa taulukko > Lataa puolipiste-eroteltu csv-tiedosto (otsikollinen)
 #
-def parse_finland_population_by_month_csv(csv_file):
-    all_lines = list(csv_file.readlines())
-    heading_line = all_lines[2].strip()
-    heading_cells = heading_line.split(";")
-    assert heading_cells[0] == '"Vuosi"'
-    assert heading_cells[1] == '"Yhteensä Väestö 31.12."'
-    result = []
-    for line_idx, line in enumerate(all_lines[3:]):
-        cells = line.strip().split(";")
-        year = int(cells[0].strip('"'))
-        assert 1900 <= year <= 2100
-        population = int(cells[1])
-        assert 200000 <= population <= 10000000
-        result.append((year, population))
+def parse_finland_population_by_month_csv(csv_file, validation_mode=VALIDATION_STRICT):
+    table = read_pxweb_csv(csv_file, FINLAND_POPULATION_BY_YEAR_COLUMNS)
+    validator = Validator("population by year", table["year"], validation_mode)
+    validator.check((table["year"] >= 1900) & (table["year"] <= 2100), "Year out of range")
+    validator.check((table["population"] >= 200000) & (table["population"] <= 10000000), "Population out of range")
+    validator.validate()
+    return list(zip(table["year"].tolist(), table["population"].tolist()))
+
+PARSE_CACHE_DIR = "cache/parsed"
+
+# Parsed results are stored as uncompressed .npz files, so every parser with a
+# cache entry needs a codec which turns its result into a dict of plain numpy
+# arrays and back. The cache key includes the source of the module which
+# defines the parser, so editing a parser, a helper function such as
+# read_pxweb_csv or Validator, or a codec invalidates its entries; bump the
+# version when the output changes through code outside the module.
+ParseCacheCodec = collections.namedtuple("ParseCacheCodec", ["version", "encode", "decode"])
+
+def encode_records(records):
+    """List of equal-length tuples to one array per column; datetime.date columns become datetime64[D]."""
+    columns = list(zip(*records))
+    arrays = {"column_count": numpy.array(len(columns))}
+    for index, column in enumerate(columns):
+        if isinstance(column[0], datetime.date):
+            arrays["column_%d" % (index,)] = numpy.array(column, dtype="datetime64[D]")
+        else:
+            arrays["column_%d" % (index,)] = numpy.array(column)
+    return arrays
+
+def decode_records(arrays):
+    columns = [arrays["column_%d" % (index,)].tolist() for index in range(int(arrays["column_count"]))]
+    return list(zip(*columns))
+
+def encode_dict_records(records):
+    """List of dicts sharing the same int or str keys to one array per key; None values are masked."""
+    keys = list(records[0].keys()) if records else []
+    arrays = {
+        "keys": numpy.array([str(key) for key in keys], dtype=str),
+        "key_is_int": numpy.array([isinstance(key, int) for key in keys], dtype=bool),
+    }
+    for index, key in enumerate(keys):
+        assert all((list(record.keys()) == keys for record in records))
+        values = [record[key] for record in records]
+        mask = numpy.array([value is None for value in values])
+        arrays["column_%d" % (index,)] = numpy.array([0 if value is None else value for value in values])
+        arrays["mask_%d" % (index,)] = mask
+    return arrays
+
+def decode_dict_records(arrays):
+    keys = [int(key) if is_int else str(key) for key, is_int in zip(arrays["keys"].tolist(), arrays["key_is_int"].tolist())]
+    columns = []
+    for index in range(len(keys)):
+        values = arrays["column_%d" % (index,)].tolist()
+        mask = arrays["mask_%d" % (index,)].tolist()
+        columns.append([None if is_masked else value for value, is_masked in zip(values, mask)])
+    return [dict(zip(keys, row)) for row in zip(*columns)]
+
+def test_encode_dict_records():
+    records = [{"year": 2020, 1: 5, "note": None}, {"year": 2021, 1: 7, "note": 3}]
+    assert decode_dict_records(encode_dict_records(records)) == records
+    assert decode_dict_records(encode_dict_records([])) == []
+    assert decode_records(encode_records([])) == []
+test_encode_dict_records()
+
+def encode_weekly_mortality(weekly_mortality):
+    return {
+        "week_x_date": weekly_mortality.week_x_date,
+        "deaths": weekly_mortality.deaths,
+        "categories": numpy.array(weekly_mortality.categories),
+    }
+
+def decode_weekly_mortality(arrays):
+    return WeeklyMortality(WeekIndex(arrays["week_x_date"]), arrays["deaths"], arrays["categories"].tolist())
+
+def encode_region_weekly_mortality(region_weekly_mortality):
+    return {
+        "regions": numpy.array(region_weekly_mortality.regions),
+        "week_x_date": region_weekly_mortality.week_x_date,
+        "deaths": region_weekly_mortality.deaths,
+        "categories": numpy.array(region_weekly_mortality.categories),
+    }
+
+def decode_region_weekly_mortality(arrays):
+    return RegionWeeklyMortality(arrays["regions"].tolist(), WeekIndex(arrays["week_x_date"]), arrays["deaths"], arrays["categories"].tolist())
+
+def encode_population_by_age(population_by_age):
+    return {
+        "years": population_by_age.years,
+        "population": population_by_age.population,
+    }
+
+def decode_population_by_age(arrays):
+    return PopulationByAge(arrays["years"], arrays["population"])
+
+def encode_euromomo_zscores(euromomo_zscores):
+    return {
+        "week_x_date": euromomo_zscores.week_x_date,
+        "countries": euromomo_zscores.countries,
+        "groups": euromomo_zscores.groups,
+        "zscores": euromomo_zscores.zscores,
+    }
+
+def decode_euromomo_zscores(arrays):
+    return EuroMomoZScores(WeekIndex(arrays["week_x_date"]), arrays["countries"], arrays["groups"], arrays["zscores"])
+
+def encode_euromomo_numbers(euromomo_numbers):
+    return {
+        "week_x_date": euromomo_numbers.week_x_date,
+        "groups": euromomo_numbers.groups,
+        "numbers": euromomo_numbers.numbers,
+    }
+
+def decode_euromomo_numbers(arrays):
+    return EuroMomoNumbers(WeekIndex(arrays["week_x_date"]), arrays["groups"], arrays["numbers"])
+
+PARSE_CACHE_CODECS = {
+    "parse_finland_weekly_mortality_csv": ParseCacheCodec(1, encode_weekly_mortality, decode_weekly_mortality),
+    "parse_finland_region_mortality_csv": ParseCacheCodec(1, encode_region_weekly_mortality, decode_region_weekly_mortality),
+    "parse_finland_thl_covid_data_csv": ParseCacheCodec(1, encode_records, decode_records),
+    "parse_finland_thl_verified_covid_data_csv": ParseCacheCodec(1, encode_records, decode_records),
+    "parse_euromomo_zscores_csv": ParseCacheCodec(2, encode_euromomo_zscores, decode_euromomo_zscores),
+    "parse_euromomo_numbers_csv": ParseCacheCodec(1, encode_euromomo_numbers, decode_euromomo_numbers),
+    "parse_finland_tilastokeskus_population_csv": ParseCacheCodec(2, encode_population_by_age, decode_population_by_age),
+    "parse_finland_deaths_forecast_csv": ParseCacheCodec(1, encode_dict_records, decode_dict_records),
+    "parse_finland_deaths_and_population_by_month_csv": ParseCacheCodec(1, encode_dict_records, decode_dict_records),
+    "parse_finland_deaths_by_month_csv": ParseCacheCodec(1, encode_dict_records, decode_dict_records),
+    "parse_finland_population_by_month_csv": ParseCacheCodec(1, encode_records, decode_records),
+}
+
+@functools.lru_cache(maxsize=None)
+def get_module_source_hash(module_name):
+    return hashlib.sha256(inspect.getsource(sys.modules[module_name]).encode("utf-8")).hexdigest()
+
+def get_parse_cache_key(file_data, parser, parser_version, parser_kwargs):
+    key_hash = hashlib.sha256()
+    key_hash.update(("%s\0%s\0%d\0%s\0" % (parser.__name__, get_module_source_hash(parser.__module__), parser_version,
+                                             repr(sorted(parser_kwargs.items())))).encode("utf-8"))
+    key_hash.update(file_data)
+    return key_hash.hexdigest()
+
+def load_parsed_csv(file_name, encoding, parser, cache_dir=PARSE_CACHE_DIR, validation_mode=VALIDATION_STRICT, **parser_kwargs):
+    """
+    Return parser(csv_file, **parser_kwargs) for *file_name*. The result is
+    cached in *cache_dir* under a hash of the file contents, the source of the
+    parser module and the parser version and arguments, so unchanged files are
+    loaded without parsing.
+    Only results of VALIDATION_STRICT parses are written to the cache, so
+    cached results are always strictly validated and *validation_mode* only
+    applies to files which are parsed.
+    """
+    with open(file_name, "rb") as data_file:
+        file_data = data_file.read()
+    codec = PARSE_CACHE_CODECS.get(parser.__name__)
+    if codec is None or cache_dir is None:
+        return parser(io.TextIOWrapper(io.BytesIO(file_data), encoding=encoding), validation_mode=validation_mode, **parser_kwargs)
+    cache_key = get_parse_cache_key(file_data, parser, codec.version, parser_kwargs)
+    cache_file_name = os.path.join(cache_dir, cache_key + ".npz")
+    if os.path.exists(cache_file_name):
+        with numpy.load(cache_file_name, allow_pickle=False) as arrays:
+            return codec.decode(dict(arrays.items()))
+    result = parser(io.TextIOWrapper(io.BytesIO(file_data), encoding=encoding), validation_mode=validation_mode, **parser_kwargs)
+    if validation_mode != VALIDATION_STRICT:
+        return result
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first so that concurrent runs never see a partial file
+    temp_file_name = "%s.%d.tmp" % (cache_file_name, os.getpid())
+    with open(temp_file_name, "wb") as cache_file:
+        numpy.savez(cache_file, **codec.encode(result))
+    os.replace(temp_file_name, cache_file_name)
     return result
 
-def calculate_moving_average(arr, w, position="left"):
-    assert w >= 3
-    results = []
-    for i in range(len(arr)):
-        if position == "left":
-            lower_i = i-(w-1)
-            upper_i = i
-        elif position == "center":
-            lower_i = i-((w-w//2)-1)
-            upper_i = i+w//2
-        elif position == "right":
-            lower_i = i
-            upper_i = i+(w-1)
+def test_load_parsed_csv():
+    import tempfile
+    heading = "group;week;" + ";".join(EUROMOMO_NUMBERS_QUANTITIES)
+    rows = ["0-14;2020-01;1;2;3;4;5", "0-14;2020-02;1;2;3;4;6"]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        cache_dir = os.path.join(temp_dir, "cache")
+        file_name = os.path.join(temp_dir, "numbers.csv")
+        with open(file_name, "w", encoding="utf-8") as csv_file:
+            csv_file.write("\n".join([heading] + rows) + "\n")
+        parsed = load_parsed_csv(file_name, "utf-8", parse_euromomo_numbers_csv, cache_dir=cache_dir)
+        cached = load_parsed_csv(file_name, "utf-8", parse_euromomo_numbers_csv, cache_dir=cache_dir, validation_mode=VALIDATION_FAST)
+        assert len(os.listdir(cache_dir)) == 1
+        assert numpy.array_equal(cached.numbers, parsed.numbers) and cached.groups.tolist() == parsed.groups.tolist()
+        # the key covers the helpers of the parser, not only the parser itself
+        module_source = inspect.getsource(sys.modules[parse_euromomo_numbers_csv.__module__])
+        assert all((inspect.getsource(helper) in module_source for helper in (read_pxweb_csv, split_period_labels, Validator, WeekIndex)))
+        # a duplicate row only fails the strict checks
+        with open(file_name, "w", encoding="utf-8") as csv_file:
+            csv_file.write("\n".join([heading] + rows + rows[-1:]) + "\n")
+        load_parsed_csv(file_name, "utf-8", parse_euromomo_numbers_csv, cache_dir=cache_dir, validation_mode=VALIDATION_FAST)
+        assert len(os.listdir(cache_dir)) == 1
+        try:
+            load_parsed_csv(file_name, "utf-8", parse_euromomo_numbers_csv, cache_dir=cache_dir)
+        except ValueError as error:
+            assert "Duplicate rows" in str(error)
         else:
-            raise ValueError("Unknown position: %s" % (position,))
-        assert lower_i <= upper_i
-        if lower_i < 0 or upper_i >= len(arr):
-            results.append(None)
-            continue
-        window = arr[lower_i:upper_i+1]
-        assert len(window) == w
-        if w % 2 == 0:
-            # even length window
-            result = (0.5 * window[0] + sum(window[1:-1]) + 0.5 * window[-1]) / (len(window) - 1)
+            assert False, "Strict load of a fast parsed file was not validated"
+test_load_parsed_csv()
+
+EUROMOMO_ZSCORE_VINTAGES = "EuroMoMo/Euromomo all countries z-scores *.csv"
+EUROMOMO_POOLED_ZSCORE_VINTAGES = "EuroMoMo/EuroMoMo pooled by age group Z-scores *.csv"
+EUROMOMO_POOLED_NUMBERS_VINTAGES = "EuroMoMo/EuroMoMo pooled by age group numbers *.csv"
+EUROMOMO_VINTAGE_RE = re.compile(r"(\d\d\d\d-\d\d-\d\d)\.csv$")
+
+class EuroMomoVintages:
+    """
+    Several vintages (download dates) of one EuroMoMo table, aligned on the
+    union of their weeks and labels. The first vintage is stored as a dense
+    array and each later vintage only as the cells that differ from the
+    vintage before it, so memory grows with the number of revised cells. A
+    revision which changes most cells is stored densely instead, with None as
+    its cell indices. Cells outside the weeks or labels of a vintage are NaN.
+    """
+    def __init__(self, vintages, week_index, axis_labels, first_values, revisions):
+        assert first_values.shape == (len(week_index),) + tuple((len(labels) for labels in axis_labels))
+        assert len(revisions) == len(vintages) - 1
+        self.vintages = list(vintages)
+        self.week_index = week_index
+        self.week_x_date = week_index.x_date
+        self.axis_labels = tuple(axis_labels)
+        self.first_values = first_values
+        # (revised cell count, flat cell indices, new values) for each vintage after the first
+        self.revisions = list(revisions)
+
+    def __len__(self):
+        return len(self.vintages)
+
+    def vintage_values(self, vintage_index):
+        """Dense array of one vintage, indexed [week, ...]."""
+        values = self.first_values.copy()
+        for _, cell_indices, cell_values in self.revisions[:vintage_index]:
+            if cell_indices is None:
+                values[...] = cell_values
+            else:
+                values.flat[cell_indices] = cell_values
+        return values
+
+    def array(self):
+        """Dense array of all vintages, indexed [vintage, week, ...]."""
+        values = numpy.empty((len(self.vintages),) + self.first_values.shape, dtype=self.first_values.dtype)
+        values[0] = self.first_values
+        for vintage_index, (_, cell_indices, cell_values) in enumerate(self.revisions, start=1):
+            if cell_indices is None:
+                values[vintage_index] = cell_values
+            else:
+                values[vintage_index] = values[vintage_index-1]
+                values[vintage_index].flat[cell_indices] = cell_values
+        return values
+
+    def revised_cells(self, vintage_index):
+        """Number of cells which *vintage_index* changed relative to the vintage before it."""
+        return self.revisions[vintage_index-1][0] if vintage_index > 0 else 0
+
+    def revision_deltas(self, from_vintage_index, to_vintage_index):
+        """
+        Change of each cell from one vintage to another, indexed [week, ...].
+        NaN where either vintage has no value.
+        """
+        return self.vintage_values(to_vintage_index) - self.vintage_values(from_vintage_index)
+
+def load_euromomo_vintages(file_pattern, parser, cache_dir=PARSE_CACHE_DIR, validation_mode=VALIDATION_STRICT):
+    """
+    Load all files matching *file_pattern*, whose names end in the download
+    date, with *parser* into an EuroMomoVintages in date order.
+    """
+    snapshots = []
+    for file_name in glob.glob(file_pattern):
+        vintage_match = EUROMOMO_VINTAGE_RE.search(file_name)
+        if not vintage_match:
+            raise ValueError("No download date in file name: %s" % (file_name,))
+        snapshots.append((datetime.date.fromisoformat(vintage_match.group(1)),
+                          load_parsed_csv(file_name, "utf-8", parser, cache_dir=cache_dir, validation_mode=validation_mode)))
+    if not snapshots:
+        raise ValueError("No files match %s" % (file_pattern,))
+    snapshots.sort(key=lambda snapshot: snapshot[0])
+    week_x_date = numpy.unique(numpy.concatenate([snapshot.week_x_date for _, snapshot in snapshots]))
+    axis_labels = []
+    for axis in range(len(snapshots[0][1].axis_labels)):
+        axis_labels.append(numpy.array(list(dict.fromkeys((label for _, snapshot in snapshots
+                                                             for label in snapshot.axis_labels[axis].tolist())))))
+    first_values = None
+    previous_values = None
+    revisions = []
+    for _, snapshot in snapshots:
+        values = numpy.full((len(week_x_date),) + tuple((len(labels) for labels in axis_labels)), numpy.nan, dtype=snapshot.values.dtype)
+        positions = [week_x_date.searchsorted(snapshot.week_x_date)]
+        for labels, snapshot_labels in zip(axis_labels, snapshot.axis_labels):
+            label_positions = dict(((label, index) for index, label in enumerate(labels.tolist())))
+            positions.append([label_positions[label] for label in snapshot_labels.tolist()])
+        values[numpy.ix_(*positions)] = snapshot.values
+        if previous_values is None:
+            first_values = values
         else:
-            # odd length window
-            result = sum(window) / len(window)
-        results.append(result)
-    return numpy.array(results)
+            changed = (values != previous_values) & ~(numpy.isnan(values) & numpy.isnan(previous_values))
+            cell_indices = numpy.flatnonzero(changed).astype(numpy.int32)
+            cell_values = values.flat[cell_indices]
+            if cell_indices.nbytes + cell_values.nbytes < values.nbytes:
+                revisions.append((len(cell_indices), cell_indices, cell_values))
+            else:
+                revisions.append((len(cell_indices), None, values))
+        previous_values = values
+    return EuroMomoVintages([vintage for vintage, _ in snapshots], WeekIndex(week_x_date), axis_labels, first_values, revisions)
+
+# Input datasets by name. *load* parses the dataset and *min_length* is a
+# sanity check for the size of the result.
+Dataset = collections.namedtuple("Dataset", ["load", "min_length"])
+# The regional weekly ACM file is not a dataset: the regions output streams it with iter_finland_region_mortality_csv
+FINLAND_REGION_MORTALITY_FILE = "Finland/Finland_weekly_ACM_by_region.csv"
+FINLAND_REGION_MORTALITY_TRIM_WEEKS = 2
+DATASETS = {
+    "finland_weekly_mortality": Dataset(functools.partial(load_parsed_csv, "Finland/Finland weekly ACM.csv", "iso-8859-1",
+                                                          parse_finland_weekly_mortality_csv, trim_weeks_from_end=2), 50),
+    "finland_deaths_and_population_by_month": Dataset(functools.partial(load_parsed_csv, "Finland/Finland population and deaths by month.csv", "iso-8859-1",
+                                                                        parse_finland_deaths_and_population_by_month_csv, trim_months_from_end=0), 50),
+    "finland_deaths_by_month_since_1945": Dataset(functools.partial(load_parsed_csv, "Finland/Finland deaths by month.csv", "iso-8859-1",
+                                                                    parse_finland_deaths_by_month_csv), 50),
+    "finland_covid_data": Dataset(functools.partial(load_parsed_csv, "Finland/Finland verified covid deaths.csv", "utf-8",
+                                                    parse_finland_thl_verified_covid_data_csv), 50),
+    "finland_population_by_age": Dataset(functools.partial(load_parsed_csv, "Finland/Finland Population by age.csv", "iso-8859-1",
+                                                           parse_finland_tilastokeskus_population_csv), 10),
+    "finland_deaths_forecast": Dataset(functools.partial(load_parsed_csv, "Finland/Finland deaths forecast.csv", "iso-8859-1",
+                                                         parse_finland_deaths_forecast_csv), 10),
+    "euromomo_zscores": Dataset(functools.partial(load_parsed_csv, "EuroMoMo/Euromomo all countries z-scores 2022-11-05.csv", "utf-8",
+                                                  parse_euromomo_zscores_csv), 50),
+    "euromomo_zscore_vintages": Dataset(functools.partial(load_euromomo_vintages, EUROMOMO_ZSCORE_VINTAGES, parse_euromomo_zscores_csv), 1),
+    "euromomo_pooled_zscore_vintages": Dataset(functools.partial(load_euromomo_vintages, EUROMOMO_POOLED_ZSCORE_VINTAGES, parse_euromomo_zscores_csv), 1),
+    "euromomo_pooled_numbers_vintages": Dataset(functools.partial(load_euromomo_vintages, EUROMOMO_POOLED_NUMBERS_VINTAGES, parse_euromomo_numbers_csv), 1),
+}
+
+class DatasetRegistry(collections.abc.Mapping):
+    """
+    Read-only dict of the *datasets* which loads each one on first access and
+    keeps it for the rest of the process.
+    """
+    def __init__(self, datasets):
+        self.datasets = datasets
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            dataset = self.datasets[name]
+            data = dataset.load()
+            if len(data) < dataset.min_length:
+                raise ValueError("Dataset %s has only %d items" % (name, len(data)))
+            self.loaded[name] = data
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(self.datasets)
+
+    def __len__(self):
+        return len(self.datasets)
+
+DATASET_REGISTRY = DatasetRegistry(DATASETS)
+
+def get_moving_average_window(w, position):
+    """Number of elements before and after the current element in a window of *w* elements."""
+    if position == "left":
+        return w-1, 0
+    elif position == "center":
+        return (w-w//2)-1, w//2
+    elif position == "right":
+        return 0, w-1
+    else:
+        raise ValueError("Unknown position: %s" % (position,))
+
+def get_nan_aware_prefix_sums(values):
+    """
+    Prefix sums along the rows of *values* with NaN counted as zero, and prefix
+    counts of NaN, both with a leading zero column. A window [i, j) contains a
+    NaN if nan_counts[:, j] - nan_counts[:, i] is positive.
+    """
+    is_nan = numpy.isnan(values)
+    cumulative = numpy.zeros((len(values), values.shape[1]+1))
+    numpy.cumsum(numpy.where(is_nan, 0.0, values), axis=1, out=cumulative[:, 1:])
+    nan_counts = numpy.zeros((len(values), values.shape[1]+1), dtype=numpy.int64)
+    numpy.cumsum(is_nan, axis=1, out=nan_counts[:, 1:])
+    return cumulative, nan_counts
+
+def calculate_moving_averages(arr, w, position="left"):
+    """
+    Moving averages of each row of the (series x week) matrix *arr*. An even
+    length window gives half weight to its first and last elements. Weeks
+    whose window does not fit in the series or contains a NaN are NaN.
+    """
+    if w < 3:
+        raise ValueError("Window too short: %d" % (w,))
+    values = numpy.asarray(arr, dtype=numpy.float64).reshape((len(arr), -1))
+    before, after = get_moving_average_window(w, position)
+    weeks = values.shape[1]
+    results = numpy.full(values.shape, numpy.nan)
+    if weeks < w:
+        return results
+    cumulative, nan_counts = get_nan_aware_prefix_sums(values)
+    window_sums = cumulative[:, w:] - cumulative[:, :-w]
+    window_sums[nan_counts[:, w:] > nan_counts[:, :-w]] = numpy.nan
+    if w % 2 == 0:
+        # even length window
+        results[:, before:weeks-after] = (window_sums - 0.5 * values[:, :weeks-w+1] - 0.5 * values[:, w-1:]) / (w - 1)
+    else:
+        # odd length window
+        results[:, before:weeks-after] = window_sums / w
+    return results
+
+def calculate_moving_average(arr, w, position="left"):
+    results = calculate_moving_averages([arr], w, position)[0]
+    if numpy.isnan(results).any():
+        # weeks without a full window are None
+        return numpy.array([None if numpy.isnan(result) else result for result in results.tolist()])
+    return results
+
+def calculate_variable_window_moving_averages(arr, w):
+    """
+    Centered moving averages of each row of the (series x week) matrix *arr*.
+    Windows shrink at both ends of the series. Weeks whose window contains a
+    NaN are NaN.
+    """
+    values = numpy.asarray(arr, dtype=numpy.float64).reshape((len(arr), -1))
+    before, after = get_moving_average_window(w, "center")
+    weeks = values.shape[1]
+    cumulative, nan_counts = get_nan_aware_prefix_sums(values)
+    indices = numpy.arange(weeks)
+    lower_i = numpy.maximum(indices - before, 0)
+    upper_i = numpy.minimum(indices + after, weeks - 1)
+    results = (cumulative[:, upper_i+1] - cumulative[:, lower_i]) / (upper_i - lower_i + 1)
+    results[nan_counts[:, upper_i+1] > nan_counts[:, lower_i]] = numpy.nan
+    return results
 
 def calculate_variable_window_moving_average(arr, w):
-    results = []
-    for i in range(len(arr)):
-        lower_i = max(0, i-((w-w//2)-1))
-        upper_i = min(len(arr)-1, i+w//2)
-        window = arr[lower_i:upper_i+1]
-        result = sum(window) / len(window)
-        results.append(result)
-    return numpy.array(results)
+    return calculate_variable_window_moving_averages([arr], w)[0]
+
+def test_calculate_moving_average():
+    source = [4.0, 8.0, 6.0, -1.0, 3.0, 5.0]
+    assert repr(calculate_moving_average(source, 3).tolist()) == repr([None, None, 6.0, 13/3, 8/3, 7/3])
+    assert repr(calculate_moving_average(source, 3, position="right").tolist()) == repr([6.0, 13/3, 8/3, 7/3, None, None])
+    assert repr(calculate_moving_average(source, 4, position="center").tolist()) == repr([None, 15.5/3, 3.5, 2.5, None, None])
+    result = calculate_moving_averages([source, source[::-1]], 3, position="center")
+    assert repr(result[1, 1:-1].tolist()) == repr(calculate_moving_average(source[::-1], 3, position="center")[1:-1].tolist())
+    # a NaN only affects the windows which contain it
+    with_nan = [[1.0, 2.0, numpy.nan, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0]]
+    result = calculate_moving_averages(with_nan, 3)[0]
+    assert numpy.isnan(result[:5]).all() and result[5:].tolist() == [5.0, 6.0, 7.0, 8.0, 9.0]
+    result = calculate_moving_averages(with_nan, 4, position="center")[0]
+    assert numpy.isnan(result[:4]).all() and result[4:-2].tolist() == [5.5, 6.5, 7.5, 8.5]
+test_calculate_moving_average()
 
 def test_calculate_variable_window_moving_average():
     assert repr(list(calculate_variable_window_moving_average([], 3))) == repr([])
@@ -707,85 +1601,730 @@ def test_calculate_variable_window_moving_average():
     expected4 = [75.0, 86.0, 89.2, 94.8, 93.4, 94.4, 71.4, 60.2, 58.4, 58.6, 43.6, 67.8, 82.6, 76.0, 90.0]
     assert repr(result4) == repr(expected4), \
         "%s not equal to %s" % (repr(result4), repr(expected4))
+    source5 = numpy.array(source4)
+    source5[6] = numpy.nan
+    result5 = calculate_variable_window_moving_average(source5, 5)
+    assert numpy.isnan(result5[4:9]).all()
+    assert repr(result5[:4].tolist() + result5[9:].tolist()) == repr(expected4[:4] + expected4[9:])
 test_calculate_variable_window_moving_average()
 
 def map_datetime_to_x(d):
-    if isinstance(d, numpy.ndarray):
-        return numpy.array([(d-T0_DATE).days for d in d])
+    if isinstance(d, WeekIndex):
+        return d.x
+    elif isinstance(d, numpy.ndarray):
+        return (d.astype("datetime64[D]") - T0_DATETIME64).astype(numpy.int64)
     else:
         return (d - T0_DATE).days
 
 def map_datetime64_to_x(d):
     return (d - T0_DATETIME64) / numpy.timedelta64(1, 'D')
 
-def calculate_trend_extrapolation_slope(all_cause_mortality, years):
-    acm_baseline_x_list = []
-    acm_baseline_x_date_list = []
-    acm_baseline_y_list = []
-    start_date = BASELINE_CUTOFF_DATE - dateutil.relativedelta.relativedelta(years=years)
-    for item_date, item_deaths in all_cause_mortality:
-        if start_date <= item_date < BASELINE_CUTOFF_DATE:
-            x = (item_date - T0_DATE).days
-            acm_baseline_x_list.append(x)
-            acm_baseline_x_date_list.append(item_date)
-            acm_baseline_y_list.append(item_deaths)
-    acm_baseline_x = numpy.array(acm_baseline_x_list)
-    acm_baseline_x_date = numpy.array(acm_baseline_x_date_list)
-    acm_baseline_y = numpy.array(acm_baseline_y_list)
-    a, b = numpy.polyfit(acm_baseline_x, acm_baseline_y, 1)
+class WeeklyWindows:
+    """
+    Sums and means of weekly values over any number of date windows
+    [start, end) in one call, from a cumulative sum over the weeks, which
+    must be in date order.
+    """
+    def __init__(self, x_date, y):
+        self.x_date = numpy.asarray(x_date, dtype="datetime64[D]")
+        self.x = map_datetime_to_x(self.x_date)
+        self.y = numpy.asarray(y)
+        self.cumulative_y = numpy.concatenate((numpy.zeros(1, dtype=self.y.dtype), numpy.cumsum(self.y)))
+
+    def indices(self, starts, ends):
+        """Index ranges [lower, upper) of the weeks in each window."""
+        lower = self.x_date.searchsorted(numpy.asarray(starts, dtype="datetime64[D]"))
+        upper = self.x_date.searchsorted(numpy.asarray(ends, dtype="datetime64[D]"))
+        return lower, numpy.maximum(lower, upper)
+
+    def sums(self, starts, ends):
+        lower, upper = self.indices(starts, ends)
+        return self.cumulative_y[upper] - self.cumulative_y[lower]
+
+    def counts(self, starts, ends):
+        lower, upper = self.indices(starts, ends)
+        return upper - lower
+
+    def means(self, starts, ends):
+        lower, upper = self.indices(starts, ends)
+        return (self.cumulative_y[upper] - self.cumulative_y[lower]) / (upper - lower)
+
+def test_weekly_windows():
+    windows = WeeklyWindows([datetime.date(2020, 1, 2) + datetime.timedelta(days=7*i) for i in range(10)], numpy.arange(10) * 10)
+    starts = [datetime.date(2020, 1, 2), datetime.date(2020, 1, 10), datetime.date(2019, 1, 1)]
+    ends = [datetime.date(2020, 1, 16), datetime.date(2020, 3, 6), datetime.date(2020, 1, 1)]
+    assert windows.sums(starts, ends).tolist() == [10, 440, 0]
+    assert windows.counts(starts, ends).tolist() == [2, 8, 0]
+    assert windows.means(starts[:2], ends[:2]).tolist() == [5.0, 55.0]
+test_weekly_windows()
+
+def calculate_trend_extrapolation_slope(weekly_windows, years, cutoff_date):
+    start_date = cutoff_date - dateutil.relativedelta.relativedelta(years=years)
+    lower, upper = weekly_windows.indices([start_date], [cutoff_date])
+    a, b = numpy.polyfit(weekly_windows.x[lower[0]:upper[0]], weekly_windows.y[lower[0]:upper[0]], 1)
     return a    
 
-def calculate_acm_baseline_method1(all_cause_mortality, all_cause_mortality_estimate):
-    acm_raw_x_list = []
-    acm_raw_x_date_list = []
-    acm_raw_y_list = []
-    acm_baseline_x_list = []
-    acm_baseline_x_date_list = []
-    acm_baseline_y_list = []
-    for item_date, item_deaths in all_cause_mortality:
-        if item_date < BASELINE_START_DATE:
-            continue
-        x = (item_date - T0_DATE).days
-        acm_raw_x_list.append(x)
-        acm_raw_x_date_list.append(item_date)
-        acm_raw_y_list.append(item_deaths)
-        if item_date < BASELINE_CUTOFF_DATE:
-            acm_baseline_x_list.append(x)
-            acm_baseline_x_date_list.append(item_date)
-            acm_baseline_y_list.append(item_deaths)
-    acm_raw_x = numpy.array(acm_raw_x_list)
-    acm_raw_x_date = numpy.array(acm_raw_x_date_list)
-    acm_raw_y = numpy.array(acm_raw_y_list)
-    acm_baseline_x = numpy.array(acm_baseline_x_list)
-    acm_baseline_x_date = numpy.array(acm_baseline_x_date_list)
-    acm_baseline_y = numpy.array(acm_baseline_y_list)
+def get_linear_interpolation_basis(knot_x, x):
+    """
+    Sparse (len(x) x len(knot_x)) matrix of hat functions, so that
+    basis @ knot_y interpolates linearly between the knots. Like
+    interp1d(..., fill_value="extrapolate"), x outside the knots extends the
+    first or the last segment.
+    """
+    knot_x = numpy.asarray(knot_x, dtype=numpy.float64)
+    x = numpy.asarray(x, dtype=numpy.float64).ravel()
+    segments = numpy.clip(numpy.searchsorted(knot_x, x, side="right") - 1, 0, len(knot_x) - 2)
+    t = (x - knot_x[segments]) / (knot_x[segments+1] - knot_x[segments])
+    rows = numpy.arange(len(x))
+    return scipy.sparse.csr_matrix((numpy.concatenate((1 - t, t)), (numpy.concatenate((rows, rows)), numpy.concatenate((segments, segments+1)))),
+                                   shape=(len(x), len(knot_x)))
 
-    acm_averaged_x = acm_raw_x
-    acm_averaged_x_date = acm_raw_x_date
-    acm_averaged_y = calculate_variable_window_moving_average(acm_raw_y, 7)
+def get_year_start_x(years):
+    """x of January 1st of each of *years*."""
+    years = numpy.asarray(years)
+    return ((years - 1970).astype("datetime64[Y]").astype("datetime64[D]") - T0_DATETIME64).astype(numpy.int64)
+
+class BaselineModel:
+    """
+    Base class of fitted baselines, which are called like functions of x and
+    give weekly deaths. Subclasses implement integrate(a, b), the integral
+    over days from *a* to *b*, which may be arrays.
+    """
+    def yearly_totals(self, years):
+        """Baseline deaths in each of *years*."""
+        years = numpy.asarray(years)
+        return self.integrate(get_year_start_x(years), get_year_start_x(years + 1)) / 7
+
+    def describe(self):
+        """Lines of text which describe the seasonal parameters, for printing."""
+        return ["%s: %s" % (name, numpy.array2string(numpy.asarray(value), precision=4)) for name, value in self.seasonal_params.items()]
+
+class PiecewiseCubicTrend(BaselineModel):
+    """
+    Piecewise cubic function with (4 x segment) *coefficients* of the powers
+    3, 2, 1 and 0 of x - knot_x[segment], like scipy.interpolate.PPoly.
+    x outside the knots extends the first or the last segment.
+    """
+    def __init__(self, knot_x, coefficients):
+        self.knot_x = numpy.asarray(knot_x, dtype=numpy.float64)
+        self.coefficients = numpy.asarray(coefficients, dtype=numpy.float64)
+        assert self.coefficients.shape == (4, len(self.knot_x) - 1)
+
+    def get_segments(self, x):
+        return numpy.clip(numpy.searchsorted(self.knot_x, x, side="right") - 1, 0, len(self.knot_x) - 2)
+
+    def __call__(self, x):
+        x = numpy.asarray(x, dtype=numpy.float64)
+        segments = self.get_segments(x)
+        c3, c2, c1, c0 = self.coefficients[:, segments]
+        dx = x - self.knot_x[segments]
+        return ((c3 * dx + c2) * dx + c1) * dx + c0
+
+    def integrate(self, a, b):
+        return self.integrate_seasonal(a, b, 0, 0)
+
+    def integrate_seasonal(self, a, b, t_offs, amplitude):
+        """
+        Integral of trend(x) * (1 + amplitude * cos(2 * pi * (x + t_offs) / DAYS_IN_YEAR_EXACT))
+        from *a* to *b*, in closed form segment by segment.
+        """
+        omega = 2 * math.pi / DAYS_IN_YEAR_EXACT
+        def antiderivative(segments, x):
+            # antiderivative of p(dx) * (1 + amplitude * cos(omega * (x + t_offs))) from the start of
+            # the segment, where p is the cubic of the segment and dx = x - x0. Integrating by parts,
+            # the integral of p * cos is (p - p'' / omega^2) * sin / omega + (p' - p''' / omega^2) * cos / omega^2
+            x0 = self.knot_x[segments]
+            c3, c2, c1, c0 = self.coefficients[:, segments]
+            def part(dx, x):
+                p = ((c3 * dx + c2) * dx + c1) * dx + c0
+                p1 = (3 * c3 * dx + 2 * c2) * dx + c1
+                p2 = 6 * c3 * dx + 2 * c2
+                p3 = 6 * c3
+                phase = omega * (x + t_offs)
+                polynomial_part = (((c3 / 4 * dx + c2 / 3) * dx + c1 / 2) * dx + c0) * dx
+                seasonal_part = (p - p2 / omega**2) * numpy.sin(phase) / omega + (p1 - p3 / omega**2) * numpy.cos(phase) / omega**2
+                return polynomial_part + amplitude * seasonal_part
+            return part(x - x0, x) - part(0, x0)
+        knot_segments = numpy.arange(len(self.knot_x) - 1)
+        knot_integrals = numpy.concatenate(([0], numpy.cumsum(antiderivative(knot_segments, self.knot_x[1:]))))
+        def integral_from_first_knot(x):
+            x = numpy.asarray(x, dtype=numpy.float64)
+            segments = self.get_segments(x)
+            return knot_integrals[segments] + antiderivative(segments, x)
+        return integral_from_first_knot(b) - integral_from_first_knot(a)
+
+class PiecewiseLinearTrend(PiecewiseCubicTrend):
+    """Piecewise linear function through the knots, extrapolating the end segments."""
+    def __init__(self, knot_x, knot_y):
+        knot_x = numpy.asarray(knot_x, dtype=numpy.float64)
+        self.knot_y = numpy.asarray(knot_y, dtype=numpy.float64)
+        self.slopes = numpy.diff(self.knot_y) / numpy.diff(knot_x)
+        zeros = numpy.zeros(len(self.slopes))
+        PiecewiseCubicTrend.__init__(self, knot_x, numpy.vstack((zeros, zeros, self.slopes, self.knot_y[:-1])))
+
+    def __call__(self, x):
+        x = numpy.asarray(x, dtype=numpy.float64)
+        return (get_linear_interpolation_basis(self.knot_x, x) @ self.knot_y).reshape(x.shape)
+
+def get_pchip_trend(knot_x, knot_y, tail_x=None, tail_y=None):
+    """
+    PiecewiseCubicTrend of the PCHIP spline through the knots. If *tail_x*
+    and *tail_y* are given, the trend continues from the last knot as the
+    line through (tail_x, tail_y) instead.
+    """
+    spline = scipy.interpolate.PchipInterpolator(knot_x, knot_y)
+    if tail_x is None:
+        return PiecewiseCubicTrend(spline.x, spline.c)
+    tail_slope = (tail_y - knot_y[-1]) / (tail_x - knot_x[-1])
+    return PiecewiseCubicTrend(numpy.append(spline.x, tail_x),
+                               numpy.column_stack((spline.c, [0, 0, tail_slope, knot_y[-1]])))
+
+class SeasonalTrendBaseline(BaselineModel):
+    """trend(x) * (1 + a * cos(2 * pi * (x + t_offs) / DAYS_IN_YEAR_EXACT)) with a PiecewiseCubicTrend."""
+    def __init__(self, trend, t_offs, a):
+        self.trend = trend
+        self.t_offs = t_offs
+        self.a = a
+
+    @property
+    def seasonal_params(self):
+        return {"t_offs": self.t_offs, "a": self.a}
+
+    def __call__(self, x):
+        x = numpy.asarray(x, dtype=numpy.float64)
+        return self.trend(x) * (1 + self.a * numpy.cos(1 / DAYS_IN_YEAR_EXACT * 2 * math.pi * (x + self.t_offs)))
+
+    def integrate(self, a, b):
+        return self.trend.integrate_seasonal(a, b, self.t_offs, self.a)
+
+    def describe(self):
+        return ["Cosine time offset %.2f days (%.3f rad)" % (self.t_offs, 2 * math.pi * self.t_offs / DAYS_IN_YEAR_EXACT),
+                "Cosine amplitude factor: %.4f" % (self.a,)]
+
+def test_get_linear_interpolation_basis():
+    knot_x = numpy.array([0.0, 10.0, 30.0])
+    knot_y = numpy.array([1.0, 3.0, -1.0])
+    x = numpy.array([-5.0, 0.0, 5.0, 10.0, 20.0, 30.0, 40.0])
+    result = (get_linear_interpolation_basis(knot_x, x) @ knot_y).tolist()
+    expected = scipy.interpolate.interp1d(knot_x, knot_y, fill_value="extrapolate")(x).tolist()
+    assert result == expected, "Invalid result: %s, expected %s" % (repr(result), repr(expected))
+    assert PiecewiseLinearTrend(knot_x, knot_y)(25.0) == 0.0
+test_get_linear_interpolation_basis()
+
+def test_baseline_integrate():
+    baseline = SeasonalTrendBaseline(PiecewiseLinearTrend([-400.0, 0.0, 700.0], [900.0, 1000.0, 950.0]), 40.0, 0.1)
+    for a, b in ((-1000.0, -500.0), (-100.0, 1000.0), (3.5, 3.5), (800.0, 20.0)):
+        result = baseline.integrate(a, b)
+        expected, _ = scipy.integrate.quad(baseline, a, b, points=[-400.0, 0.0, 700.0] if a < b else None, epsabs=1e-7)
+        assert abs(result - expected) < 1e-6 * max(1.0, abs(expected)), "Invalid result: %s, expected %s" % (result, expected)
+    assert list(baseline.yearly_totals([2020, 2021])) == [baseline.integrate(-366, 0) / 7, baseline.integrate(0, 365) / 7]
+    knot_x = [-400.0, 0.0, 300.0, 700.0]
+    baseline = SeasonalTrendBaseline(get_pchip_trend(knot_x, [900.0, 1000.0, 980.0, 950.0], 1200.0, 1100.0), 40.0, 0.1)
+    assert abs(baseline.trend(1000.0) - 1040.0) < 1e-9
+    for a, b in ((-1000.0, -500.0), (-100.0, 1500.0), (800.0, 20.0)):
+        result = baseline.integrate(a, b)
+        expected, _ = scipy.integrate.quad(baseline, a, b, points=knot_x + [1200.0] if a < b else None, epsabs=1e-7, limit=200)
+        assert abs(result - expected) < 1e-6 * max(1.0, abs(expected)), "Invalid result: %s, expected %s" % (result, expected)
+test_baseline_integrate()
+
+def fit_seasonal_trend_baseline(x, y, trend_basis, trend_offset, t_offs0=0.0, a0=0.0, fit_weights=None):
+    """
+    Fit y ~ (trend_basis @ p + trend_offset) * (1 + a * cos(2 * pi * (x + t_offs) / DAYS_IN_YEAR_EXACT))
+    and return (t_offs, a, p) with a >= 0. The fit starts from *t_offs0* and
+    *a0*, which only affect the number of iterations. The squared residuals
+    are weighted with *fit_weights* if it is given.
+
+    The seasonal term is written as 1 + alpha * cos + beta * sin, and for each
+    (alpha, beta) the trend parameters p are solved by linear least squares
+    (variable projection). Only alpha and beta are optimized, with the exact
+    Golub-Pereyra jacobian of the projected residuals, so the fit converges in
+    a few deterministic iterations whatever the number of trend knots.
+    """
+    trend_basis = numpy.asarray(trend_basis, dtype=numpy.float64)
+    angle = 2 * math.pi / DAYS_IN_YEAR_EXACT * numpy.asarray(x, dtype=numpy.float64)
+    seasonal_basis = numpy.column_stack((numpy.cos(angle), numpy.sin(angle)))
+    # weighted least squares is least squares of the rows scaled by the square roots of the weights
+    sqrt_fit_weights = numpy.ones(len(angle)) if fit_weights is None else numpy.sqrt(fit_weights)
+    weighted_seasonal_basis = seasonal_basis * sqrt_fit_weights[:, None]
+    projection = {}
+    def project(seasonal_params):
+        key = tuple(seasonal_params.tolist())
+        if projection.get("key") != key:
+            weights = 1 + seasonal_basis @ seasonal_params
+            q, r = numpy.linalg.qr(trend_basis * (sqrt_fit_weights * weights)[:, None])
+            p = scipy.linalg.solve_triangular(r, q.T @ (sqrt_fit_weights * (y - weights * trend_offset)))
+            trend = trend_basis @ p + trend_offset
+            projection.update(key=key, q=q, r=r, p=p, trend=trend, residuals=sqrt_fit_weights * (weights * trend - y))
+        return projection
+    def residuals_fn(seasonal_params):
+        return project(seasonal_params)["residuals"]
+    def jacobian_fn(seasonal_params):
+        fit = project(seasonal_params)
+        q, r = fit["q"], fit["r"]
+        # d(weights)/d(alpha, beta) is the seasonal basis
+        weighted_trend = weighted_seasonal_basis * fit["trend"][:, None]
+        jacobian = weighted_trend - q @ (q.T @ weighted_trend)
+        jacobian -= q @ scipy.linalg.solve_triangular(r, trend_basis.T @ (weighted_seasonal_basis * fit["residuals"][:, None]), trans="T")
+        return jacobian
+    phase0 = 2 * math.pi / DAYS_IN_YEAR_EXACT * t_offs0
+    result = scipy.optimize.least_squares(residuals_fn, numpy.array([a0 * math.cos(phase0), -a0 * math.sin(phase0)]),
+                                          jac=jacobian_fn, method="lm")
+    alpha, beta = result.x
+    t_offs = math.atan2(-beta, alpha) / (2 * math.pi) * DAYS_IN_YEAR_EXACT
+    return t_offs, math.hypot(alpha, beta), project(result.x)["p"]
+
+def get_huber_weights(u, k=1.345):
+    return numpy.minimum(1, k / numpy.maximum(numpy.abs(u), 1e-12))
+
+def get_bisquare_weights(u, c=4.685):
+    return numpy.where(numpy.abs(u) < c, (1 - (u / c)**2)**2, 0.0)
+
+# Weights of standardized residuals for robust fits, by loss, with the usual
+# tuning constants for 95% efficiency with normal errors
+ROBUST_WEIGHT_FUNCTIONS = {
+    "huber": get_huber_weights,
+    "bisquare": get_bisquare_weights,
+}
+ROBUST_MAX_ITERATIONS = 20
+# Reweighting stops when no weight changes more than this
+ROBUST_TOLERANCE = 1e-3
+# Series with fewer average weekly deaths are fitted without reweighting, because
+# the skewed Poisson noise of small counts looks like outliers to symmetric losses
+ROBUST_MIN_WEEKLY_DEATHS = 20
+# Configuration of the category and region fits, where epidemic weeks of single
+# age bands and regions would otherwise pull their baselines up. Robust fits are
+# not additive, so the excess of the age bands of a region need not add up to
+# the excess of its total.
+ROBUST_BASELINE_CONFIG = DEFAULT_BASELINE_CONFIG._replace(robust_loss="huber")
+
+def fit_robust_seasonal_trend_baseline(x, y, trend_basis, trend_offset, robust_loss, t_offs0=0.0, a0=0.0):
+    """
+    fit_seasonal_trend_baseline with iteratively reweighted least squares for
+    the *robust_loss* of ROBUST_WEIGHT_FUNCTIONS, and return (t_offs, a, p,
+    weights) with the weights of the final fit. The residuals are
+    standardized by their median absolute deviation, but at least by the
+    Poisson standard deviation sqrt(baseline) of each week. Each refit
+    starts from the seasonal term of the previous fit. Series with less than
+    ROBUST_MIN_WEEKLY_DEATHS average weekly deaths are not reweighted, and
+    all their weights are one.
+    """
+    weight_fn = ROBUST_WEIGHT_FUNCTIONS[robust_loss]
+    angle = 2 * math.pi / DAYS_IN_YEAR_EXACT * numpy.asarray(x, dtype=numpy.float64)
+    t_offs, a, p = fit_seasonal_trend_baseline(x, y, trend_basis, trend_offset, t_offs0, a0)
+    weights = numpy.ones(len(y))
+    iterations = ROBUST_MAX_ITERATIONS if numpy.mean(y) >= ROBUST_MIN_WEEKLY_DEATHS else 0
+    for iteration in range(iterations):
+        seasonal_phase = angle + 2 * math.pi / DAYS_IN_YEAR_EXACT * t_offs
+        baseline = (trend_basis @ p + trend_offset) * (1 + a * numpy.cos(seasonal_phase))
+        residuals = y - baseline
+        mad_scale = numpy.median(numpy.abs(residuals - numpy.median(residuals))) / 0.6745
+        # a baseline below one death per week still gets the scale of one death
+        scale = numpy.maximum(mad_scale, numpy.sqrt(numpy.maximum(baseline, 1)))
+        new_weights = weight_fn(residuals / scale)
+        if numpy.max(numpy.abs(new_weights - weights)) <= ROBUST_TOLERANCE:
+            break
+        weights = new_weights
+        t_offs, a, p = fit_seasonal_trend_baseline(x, y, trend_basis, trend_offset, t_offs, a, weights)
+    return t_offs, a, p, weights
+
+def test_fit_robust_seasonal_trend_baseline():
+    rng = numpy.random.default_rng(0)
+    x = numpy.arange(0.0, 7 * 520, 7)
+    trend_basis = get_linear_interpolation_basis([x[0], x[-1]], x).toarray()
+    y = (trend_basis @ [1000.0, 1100.0]) * (1 + 0.08 * numpy.cos(2 * math.pi * (x - 30) / DAYS_IN_YEAR_EXACT)) + rng.normal(0, 20, len(x))
+    # epidemic peaks in three winters
+    epidemic_weeks = numpy.zeros(len(x), dtype=bool)
+    for start in (52, 156, 364):
+        epidemic_weeks[start:start+6] = True
+    y[epidemic_weeks] += 250
+    _, plain_a, _ = fit_seasonal_trend_baseline(x, y, trend_basis, numpy.zeros(len(x)))
+    for robust_loss in ROBUST_WEIGHT_FUNCTIONS:
+        t_offs, a, p, weights = fit_robust_seasonal_trend_baseline(x, y, trend_basis, numpy.zeros(len(x)), robust_loss)
+        assert abs(a - 0.08) < abs(plain_a - 0.08) and abs(a - 0.08) < 0.01, "Invalid amplitude %s with %s loss" % (a, robust_loss)
+        assert abs(t_offs + 30) < 10 and numpy.abs(p - [1000.0, 1100.0]).max() < 10
+        assert weights[epidemic_weeks].max() < 0.5 < weights[~epidemic_weeks].mean()
+    # sparse counts, where most weeks have no deaths, and small counts
+    for mean_deaths in (0.3, 1.5, 4.0, 25.0):
+        sparse_y = rng.poisson(mean_deaths * (1 + 0.1 * numpy.cos(2 * math.pi * x / DAYS_IN_YEAR_EXACT)), (20, len(x))).astype(numpy.float64)
+        for robust_loss in ROBUST_WEIGHT_FUNCTIONS:
+            biases = []
+            for series_y in sparse_y:
+                t_offs, a, p, weights = fit_robust_seasonal_trend_baseline(x, series_y, trend_basis, numpy.zeros(len(x)), robust_loss)
+                baseline = (trend_basis @ p) * (1 + a * numpy.cos(2 * math.pi * (x + t_offs) / DAYS_IN_YEAR_EXACT))
+                biases.append(numpy.sum(series_y - baseline) / numpy.sum(series_y))
+                if mean_deaths < ROBUST_MIN_WEEKLY_DEATHS:
+                    assert (weights == 1).all()
+            assert abs(numpy.median(biases)) < 0.01, "Biased %s fit of %s deaths per week: %s" % (robust_loss, mean_deaths, numpy.median(biases))
+test_fit_robust_seasonal_trend_baseline()
+
+class SerflingBaseline(BaselineModel):
+    """
+    trend(x) plus annual harmonics: the sum over k of c_k * cos(k * w * x) + s_k * sin(k * w * x),
+    w = 2 * pi / DAYS_IN_YEAR_EXACT, with *harmonic_coefficients* c_1, s_1, c_2, s_2, ...
+    """
+    def __init__(self, trend, harmonic_coefficients):
+        self.trend = trend
+        self.harmonic_coefficients = numpy.asarray(harmonic_coefficients, dtype=numpy.float64)
+        self.harmonic_k = numpy.arange(1, len(self.harmonic_coefficients) // 2 + 1)
+
+    @property
+    def seasonal_params(self):
+        return {"harmonic_coefficients": self.harmonic_coefficients}
+
+    def __call__(self, x):
+        x = numpy.asarray(x, dtype=numpy.float64)
+        phases = 2 * math.pi / DAYS_IN_YEAR_EXACT * x[..., None] * self.harmonic_k
+        return self.trend(x) + numpy.cos(phases) @ self.harmonic_coefficients[0::2] + numpy.sin(phases) @ self.harmonic_coefficients[1::2]
+
+    def integrate(self, a, b):
+        frequencies = 2 * math.pi / DAYS_IN_YEAR_EXACT * self.harmonic_k
+        def harmonic_antiderivative(x):
+            phases = numpy.asarray(x, dtype=numpy.float64)[..., None] * frequencies
+            return (numpy.sin(phases) / frequencies) @ self.harmonic_coefficients[0::2] - (numpy.cos(phases) / frequencies) @ self.harmonic_coefficients[1::2]
+        return self.trend.integrate(a, b) + harmonic_antiderivative(b) - harmonic_antiderivative(a)
+
+    def describe(self, label="Harmonic"):
+        # c_k * cos(k * w * x) + s_k * sin(k * w * x) = amplitude * cos(k * w * (x + t_offs))
+        amplitudes = numpy.hypot(self.harmonic_coefficients[0::2], self.harmonic_coefficients[1::2])
+        t_offs = -numpy.arctan2(self.harmonic_coefficients[1::2], self.harmonic_coefficients[0::2]) * DAYS_IN_YEAR_EXACT / (2 * math.pi * self.harmonic_k)
+        return ["%s %d amplitude %.4f, time offset %.2f days" % (label, k, amplitude, offset)
+                for k, amplitude, offset in zip(self.harmonic_k.tolist(), amplitudes.tolist(), t_offs.tolist())]
+
+SERFLING_HARMONICS = 2
+SERFLING_TREND_KNOTS = 2
+
+def get_serfling_design_matrix(x, trend_knot_x, harmonics):
+    """
+    (len(x) x (len(trend_knot_x) + 2 * harmonics)) design matrix of a
+    SerflingBaseline: the hat functions of the trend knots, then the cosine
+    and the sine of each harmonic.
+    """
+    x = numpy.asarray(x, dtype=numpy.float64)
+    phases = 2 * math.pi / DAYS_IN_YEAR_EXACT * numpy.outer(x, numpy.arange(1, harmonics + 1))
+    harmonic_columns = numpy.stack((numpy.cos(phases), numpy.sin(phases)), axis=2).reshape((len(x), 2 * harmonics))
+    return numpy.hstack((get_linear_interpolation_basis(trend_knot_x, x).toarray(), harmonic_columns))
+
+def get_weighted_gram(design, weights):
+    """(series x parameter x parameter) matrices design' diag(w) design of the columns w of the (week x series) *weights*."""
+    parameter_count = design.shape[1]
+    outer_design = (design[:, :, None] * design[:, None, :]).reshape((len(design), parameter_count * parameter_count))
+    return (weights.T @ outer_design).reshape((-1, parameter_count, parameter_count))
+
+def solve_weighted_least_squares(design, y, weights):
+    """
+    Weighted least squares coefficients (series x parameter) of each column
+    of the (week x series) *y* on the (week x parameter) *design*, which
+    must have full column rank. With (week,) *weights* all series share one
+    QR factorization and are solved as stacked right-hand sides, and with
+    (week x series) *weights* the normal equations of all series are solved
+    as one batch.
+    """
+    if weights.ndim == 1:
+        weeks = weights > 0
+        sqrt_weights = numpy.sqrt(weights[weeks])[:, None]
+        q, r = scipy.linalg.qr(design[weeks] * sqrt_weights, mode="economic")
+        return scipy.linalg.solve_triangular(r, q.T @ (y[weeks] * sqrt_weights)).T
+    return numpy.linalg.solve(get_weighted_gram(design, weights), ((weights * y).T @ design)[:, :, None])[:, :, 0]
+
+# Result of fit_serfling_baselines: the trend knots, the (series x parameter)
+# coefficients of the design matrix columns, the (series x week) baselines and
+# the (week x series) weights of the final fit, zero outside the fitted weeks
+# and in epidemic weeks
+SerflingFit = collections.namedtuple("SerflingFit", ["trend_knot_x", "coefficients", "baselines", "weights"])
+
+def fit_serfling_baselines(week_x_date, deaths, config=DEFAULT_BASELINE_CONFIG, harmonics=SERFLING_HARMONICS,
+                           trend_knots=SERFLING_TREND_KNOTS, epidemic_weeks=None, epidemic_z=None):
+    """
+    Fit a SerflingBaseline with *harmonics* harmonics and a piecewise linear
+    trend through *trend_knots* evenly spaced weeks to each column of the
+    (week x series) *deaths*, by linear least squares over the weeks from
+    config.start_date to config.cutoff_date, and return a SerflingFit.
+    Weeks where the (week,) or (week x series) mask *epidemic_weeks* is True
+    are left out. Unless *epidemic_z* is None, the weeks more than
+    *epidemic_z* residual standard deviations above a first fit are also left
+    out of a second fit, separately for each series. That trim removes the
+    upper tail of the noise too, so it biases the baseline down, most of all
+    in series with small counts.
+
+    Without a mask, or with a (week,) mask, all series share one QR
+    factorization. A (week x series) mask or *epidemic_z* needs the batched
+    normal equations of solve_weighted_least_squares instead.
+    """
+    week_x_date = numpy.asarray(week_x_date, dtype="datetime64[D]")
+    week_x = map_datetime_to_x(week_x_date)
+    deaths = numpy.asarray(deaths, dtype=numpy.float64).reshape((len(week_x), -1))
+    fit_weeks = (week_x_date >= numpy.datetime64(config.start_date)) & (week_x_date < numpy.datetime64(config.cutoff_date))
+    fit_week_x = week_x[fit_weeks]
+    trend_knot_x = fit_week_x[numpy.linspace(0, len(fit_week_x) - 1, trend_knots).round().astype(int)]
+    design = get_serfling_design_matrix(week_x, trend_knot_x, harmonics)
+    fit_design = design[fit_weeks]
+    fit_deaths = deaths[fit_weeks]
+    fit_weights = numpy.ones(len(fit_week_x))
+    if epidemic_weeks is not None:
+        fit_weights = numpy.where(numpy.asarray(epidemic_weeks, dtype=bool)[fit_weeks], 0.0, 1.0)
+    coefficients = solve_weighted_least_squares(fit_design, fit_deaths, fit_weights)
+    if epidemic_z is not None:
+        residuals = fit_deaths - fit_design @ coefficients.T
+        fit_weights = numpy.broadcast_to(fit_weights.reshape((len(fit_week_x), -1)), fit_deaths.shape)
+        sigma = numpy.sqrt(numpy.sum(fit_weights * residuals**2, axis=0) / (numpy.sum(fit_weights, axis=0) - design.shape[1]))
+        fit_weights = fit_weights * (residuals <= epidemic_z * sigma)
+        coefficients = solve_weighted_least_squares(fit_design, fit_deaths, fit_weights)
+    weights = numpy.zeros(deaths.shape)
+    weights[fit_weeks] = fit_weights.reshape((len(fit_week_x), -1))
+    return SerflingFit(trend_knot_x, coefficients, coefficients @ design.T, weights)
+
+def get_serfling_baseline_fns(serfling_fit):
+    """SerflingBaseline of each series of *serfling_fit*."""
+    knot_count = len(serfling_fit.trend_knot_x)
+    return [SerflingBaseline(PiecewiseLinearTrend(serfling_fit.trend_knot_x, coefficients[:knot_count]), coefficients[knot_count:])
+            for coefficients in serfling_fit.coefficients]
+
+def test_fit_serfling_baselines():
+    week_x_date = numpy.arange(numpy.datetime64("2010-01-04"), numpy.datetime64("2020-01-06"), 7)
+    x = map_datetime_to_x(week_x_date).astype(numpy.float64)
+    phases = 2 * math.pi / DAYS_IN_YEAR_EXACT * x
+    deaths = numpy.column_stack((1000 + 0.02 * x + 90 * numpy.cos(phases) - 20 * numpy.sin(phases) + 10 * numpy.cos(2 * phases),
+                                 300 - 0.01 * x + 30 * numpy.sin(phases)))
+    epidemic_weeks = numpy.zeros(len(x), dtype=bool)
+    epidemic_weeks[100:110] = True
+    deaths[epidemic_weeks] += 500
+    config = DEFAULT_BASELINE_CONFIG._replace(start_date=datetime.date(2010, 1, 1), cutoff_date=datetime.date(2020, 1, 1))
+    for epidemic_weeks_arg, epidemic_z in ((epidemic_weeks, None), (numpy.column_stack((epidemic_weeks, epidemic_weeks)), None), (None, 2.0)):
+        serfling_fit = fit_serfling_baselines(week_x_date, deaths, config, epidemic_weeks=epidemic_weeks_arg, epidemic_z=epidemic_z)
+        errors = numpy.abs(serfling_fit.baselines.T - deaths)[~epidemic_weeks]
+        assert errors.max() < 1e-6, "Invalid fit: maximum error %s" % (errors.max(),)
+        assert not serfling_fit.weights[epidemic_weeks].any()
+    baseline_fn = get_serfling_baseline_fns(serfling_fit)[0]
+    assert numpy.abs(baseline_fn(x) - serfling_fit.baselines[0]).max() < 1e-6
+    for a, b in ((-1000.0, -500.0), (-100.0, 1500.0), (800.0, 20.0)):
+        result = baseline_fn.integrate(a, b)
+        expected, _ = scipy.integrate.quad(baseline_fn, a, b, points=serfling_fit.trend_knot_x if a < b else None, epsabs=1e-7, limit=200)
+        assert abs(result - expected) < 1e-6 * max(1.0, abs(expected)), "Invalid result: %s, expected %s" % (result, expected)
+test_fit_serfling_baselines()
+
+class QuasiPoissonBaseline(BaselineModel):
+    """
+    exp(linear_predictor(x)), a log-linear baseline with the quasi-Poisson
+    variance dispersion * baseline. The *linear_predictor* is a
+    SerflingBaseline on the log scale.
+    """
+    # Gauss-Legendre quadrature of integrate(): nodes per piece and pieces per interval
+    quadrature_nodes, quadrature_weights = numpy.polynomial.legendre.leggauss(8)
+    quadrature_pieces = 64
+
+    def __init__(self, linear_predictor, dispersion):
+        self.linear_predictor = linear_predictor
+        self.trend = linear_predictor.trend
+        self.dispersion = dispersion
+
+    @property
+    def seasonal_params(self):
+        return dict(self.linear_predictor.seasonal_params, dispersion=self.dispersion)
+
+    def __call__(self, x):
+        return numpy.exp(self.linear_predictor(x))
+
+    def describe(self):
+        return self.linear_predictor.describe("Log scale harmonic") + ["Dispersion: %.4f" % (self.dispersion,)]
+
+    def integrate(self, a, b):
+        a = numpy.asarray(a, dtype=numpy.float64)[..., None, None]
+        b = numpy.asarray(b, dtype=numpy.float64)[..., None, None]
+        piece_length = (b - a) / self.quadrature_pieces
+        piece_starts = a + piece_length * numpy.arange(self.quadrature_pieces)[:, None]
+        x = piece_starts + piece_length * (self.quadrature_nodes + 1) / 2
+        return numpy.sum(self(x) * self.quadrature_weights, axis=(-2, -1)) * piece_length[..., 0, 0] / 2
+
+QUASI_POISSON_MAX_ITERATIONS = 25
+QUASI_POISSON_MIN_LINEAR_PREDICTOR = math.log(numpy.finfo(numpy.float64).eps)
+# IRLS stops for a series when the relative change of each of its coefficients is below this
+QUASI_POISSON_TOLERANCE = 1e-8
+# Number of series per batch of the (week x parameter x parameter) products in the z-scores
+QUASI_POISSON_ZSCORE_BATCH = 256
+
+# Result of fit_quasi_poisson_baselines: the trend knots, the (series x
+# parameter) coefficients of the design matrix columns on the log scale, the
+# (series x week) baselines, the dispersion of each series, the (series x week)
+# z-scores, whether IRLS converged for each series and the number of IRLS
+# iterations
+QuasiPoissonFit = collections.namedtuple("QuasiPoissonFit", ["trend_knot_x", "coefficients", "baselines", "dispersion", "zscores",
+                                                             "converged", "iterations"])
+
+def fit_quasi_poisson_baselines(week_x_date, deaths, config=DEFAULT_BASELINE_CONFIG, harmonics=SERFLING_HARMONICS,
+                                trend_knots=SERFLING_TREND_KNOTS, epidemic_weeks=None,
+                                max_iterations=QUASI_POISSON_MAX_ITERATIONS, tolerance=QUASI_POISSON_TOLERANCE):
+    """
+    Fit a quasi-Poisson GLM with a log link, log(baseline) = piecewise linear
+    trend + *harmonics* harmonics as in fit_serfling_baselines, to each
+    column of the (week x series) *deaths* over the weeks from
+    config.start_date to config.cutoff_date, and return a QuasiPoissonFit.
+    Weeks where the (week,) or (week x series) mask *epidemic_weeks* is True
+    are left out. Each IRLS iteration solves the weighted least squares
+    problems of the series which have not converged yet as one batch.
+
+    The dispersion is the Pearson statistic over the residual degrees of
+    freedom, NaN for series without deaths in the fitted weeks. Like
+    EuroMoMo, the z-scores compare the 2/3 powers of the deaths and the
+    baseline, with the variance of both from the delta method. They are NaN
+    for series without deaths and for series where IRLS did not converge,
+    which happens when a few deaths leave no finite fit.
+    """
+    week_x_date = numpy.asarray(week_x_date, dtype="datetime64[D]")
+    week_x = map_datetime_to_x(week_x_date)
+    deaths = numpy.asarray(deaths, dtype=numpy.float64).reshape((len(week_x), -1))
+    series_count = deaths.shape[1]
+    fit_weeks = (week_x_date >= numpy.datetime64(config.start_date)) & (week_x_date < numpy.datetime64(config.cutoff_date))
+    fit_week_x = week_x[fit_weeks]
+    trend_knot_x = fit_week_x[numpy.linspace(0, len(fit_week_x) - 1, trend_knots).round().astype(int)]
+    design = get_serfling_design_matrix(week_x, trend_knot_x, harmonics)
+    fit_design = design[fit_weeks]
+    # the IRLS state is (series x week), so that selecting the series which have not converged copies whole rows
+    fit_deaths = deaths[fit_weeks].T.copy()
+    prior_weights = numpy.ones(fit_deaths.shape)
+    if epidemic_weeks is not None:
+        prior_weights *= ~numpy.asarray(epidemic_weeks, dtype=bool).reshape((len(week_x), -1))[fit_weeks].T
+
+    coefficients = numpy.zeros((series_count, design.shape[1]))
+    mu = fit_deaths + 0.5
+    eta = numpy.log(mu)
+    active = numpy.arange(series_count)
+    for iteration in range(1, max_iterations + 1):
+        active_mu = mu[active]
+        working_y = eta[active] + (fit_deaths[active] - active_mu) / active_mu
+        active_coefficients = solve_weighted_least_squares(fit_design, working_y.T, (prior_weights[active] * active_mu).T)
+        # like R's poisson family, keep the baseline above machine epsilon for series with few deaths
+        active_eta = numpy.maximum(active_coefficients @ fit_design.T, QUASI_POISSON_MIN_LINEAR_PREDICTOR)
+        eta[active] = active_eta
+        mu[active] = numpy.exp(active_eta)
+        converged = numpy.all(numpy.abs(active_coefficients - coefficients[active]) <= tolerance * (numpy.abs(active_coefficients) + 0.1), axis=1)
+        coefficients[active] = active_coefficients
+        active = active[~converged]
+        if len(active) == 0:
+            break
+    converged = numpy.ones(series_count, dtype=bool)
+    converged[active] = False
+
+    residual_dof = numpy.sum(prior_weights, axis=1) - design.shape[1]
+    dispersion = numpy.sum(prior_weights * (fit_deaths - mu)**2 / mu, axis=1) / residual_dof
+    dispersion[numpy.sum(prior_weights * fit_deaths, axis=1) == 0] = numpy.nan
+    baselines = numpy.exp(coefficients @ design.T)
+    # the variance of the linear predictor is dispersion * x' inverse(X' W X) x
+    inverse_gram = numpy.linalg.inv(get_weighted_gram(fit_design, (prior_weights * mu).T))
+    predictor_variance = numpy.empty(baselines.shape)
+    for batch_start in range(0, series_count, QUASI_POISSON_ZSCORE_BATCH):
+        batch = slice(batch_start, batch_start + QUASI_POISSON_ZSCORE_BATCH)
+        predictor_variance[batch] = numpy.einsum("wp,spq,wq->sw", design, inverse_gram[batch], design, optimize=True)
+    zscore_dispersion = numpy.where(converged, dispersion, numpy.nan)[:, None]
+    baseline_cbrt = numpy.cbrt(baselines)
+    zscore_sd = 2 / 3 * numpy.sqrt(zscore_dispersion * baseline_cbrt * (1 + baselines * predictor_variance))
+    zscores = (numpy.cbrt(numpy.maximum(deaths.T, 0))**2 - baseline_cbrt**2) / zscore_sd
+    return QuasiPoissonFit(trend_knot_x, coefficients, baselines, dispersion, zscores, converged, iteration)
+
+def get_quasi_poisson_baseline_fns(quasi_poisson_fit):
+    """QuasiPoissonBaseline of each series of *quasi_poisson_fit*."""
+    knot_count = len(quasi_poisson_fit.trend_knot_x)
+    return [QuasiPoissonBaseline(SerflingBaseline(PiecewiseLinearTrend(quasi_poisson_fit.trend_knot_x, coefficients[:knot_count]),
+                                                  coefficients[knot_count:]), dispersion)
+            for coefficients, dispersion in zip(quasi_poisson_fit.coefficients, quasi_poisson_fit.dispersion.tolist())]
+
+def get_quasi_poisson_trend_fn(baseline_fn):
+    """The QuasiPoissonBaseline *baseline_fn* without its harmonics."""
+    return QuasiPoissonBaseline(SerflingBaseline(baseline_fn.trend, []), baseline_fn.dispersion)
+
+def test_fit_quasi_poisson_baselines():
+    rng = numpy.random.default_rng(0)
+    week_x_date = numpy.arange(numpy.datetime64("2010-01-04"), numpy.datetime64("2020-01-06"), 7)
+    x = map_datetime_to_x(week_x_date).astype(numpy.float64)
+    phases = 2 * math.pi / DAYS_IN_YEAR_EXACT * x
+    log_mu = numpy.column_stack((math.log(1000) + 1e-5 * x + 0.1 * numpy.cos(phases), math.log(20) - 0.05 * numpy.sin(phases)))
+    deaths = rng.poisson(numpy.exp(log_mu)).astype(numpy.float64)
+    config = DEFAULT_BASELINE_CONFIG._replace(start_date=datetime.date(2010, 1, 1), cutoff_date=datetime.date(2020, 1, 1))
+    fit = fit_quasi_poisson_baselines(week_x_date, deaths, config, harmonics=1)
+    assert (numpy.abs(numpy.log(fit.baselines.T) - log_mu).max(axis=0) < [0.02, 0.1]).all()
+    assert (numpy.abs(fit.dispersion - 1) < 0.2).all(), "Invalid dispersion: %s" % (fit.dispersion,)
+    assert abs(fit.zscores.mean()) < 0.1 and abs(fit.zscores.std() - 1) < 0.1
+    single_fit = fit_quasi_poisson_baselines(week_x_date, deaths[:, 1], config, harmonics=1)
+    assert numpy.abs(single_fit.coefficients[0] - fit.coefficients[1]).max() < 1e-6
+    baseline_fn = get_quasi_poisson_baseline_fns(fit)[0]
+    assert numpy.abs(baseline_fn(x) / fit.baselines[0] - 1).max() < 1e-9
+    for a, b in ((-1000.0, -500.0), (-100.0, 1500.0), (800.0, 20.0)):
+        result = baseline_fn.integrate(a, b)
+        expected, _ = scipy.integrate.quad(baseline_fn, a, b, points=fit.trend_knot_x if a < b else None, epsabs=1e-7, limit=200)
+        assert abs(result - expected) < 1e-6 * max(1.0, abs(expected)), "Invalid result: %s, expected %s" % (result, expected)
+test_fit_quasi_poisson_baselines()
+
+class ExcessMortality:
+    """
+    Weekly deaths of a series with its baseline, excess deaths and cumulative
+    excess deaths, all aligned with *x*. The baseline is evaluated once over
+    all weeks, and plots and CSV files of the series share the result.
+    """
+    def __init__(self, x, x_date, deaths, baseline):
+        self.x = x
+        self.x_date = x_date
+        self.deaths = deaths
+        self.baseline = baseline
+        self.excess = deaths - baseline
+        self.cumulative_excess = numpy.cumsum(self.excess)
+
+    def __len__(self):
+        return len(self.x)
+
+    def since(self, start_date):
+        """The weeks from *start_date* on, with the cumulative excess starting from zero."""
+        weeks = self.x_date >= start_date
+        return ExcessMortality(self.x[weeks], self.x_date[weeks], self.deaths[weeks], self.baseline[weeks])
+
+    def excess_before(self, end_date):
+        """Sum of excess deaths and of deaths in the weeks before *end_date*."""
+        weeks = numpy.count_nonzero(self.x_date < end_date)
+        if weeks == 0:
+            return 0, 0
+        return self.cumulative_excess[weeks-1], self.deaths[:weeks].sum()
+
+def calculate_excess_mortality(all_cause_mortality, baseline_fn):
+    x_date = numpy.array([item_date for item_date, _ in all_cause_mortality])
+    x = numpy.array([(item_date - T0_DATE).days for item_date in x_date.tolist()])
+    deaths = numpy.array([item_deaths for _, item_deaths in all_cause_mortality])
+    return ExcessMortality(x, x_date, deaths, baseline_fn(x))
+
+# Result of fit_acm_baseline_method1 and fit_acm_baseline_method2: the anchor points of
+# the trend with their averages, the estimate points (None without estimates), the
+# fitted baseline models and the weights of the weeks in a robust fit (None otherwise)
+BaselineFit = collections.namedtuple("BaselineFit", ["anchor_x", "anchor_x_date", "anchor_y",
+                                                     "estimate_x", "estimate_x_date", "estimate_y",
+                                                     "baseline_trend_fn", "baseline_fn", "weights"],
+                                     defaults=(None,))
+
+def fit_acm_baseline_method1(acm_raw_x_date, acm_raw_y, all_cause_mortality_estimate, config=DEFAULT_BASELINE_CONFIG, spline_trend=False):
+    """
+    Fit the method 1 baseline to weekly deaths *acm_raw_y* on the dates
+    *acm_raw_x_date* (datetime.date) without printing or writing anything,
+    and return a BaselineFit. The trend goes through the averages of
+    consecutive windows of *config.interval*, linearly or with a PCHIP
+    spline if *spline_trend* is True.
+    """
+    acm_raw_week_x_date = numpy.asarray(acm_raw_x_date, dtype="datetime64[D]")
+    raw_part = acm_raw_week_x_date >= numpy.datetime64(config.start_date)
+    baseline_part = raw_part & (acm_raw_week_x_date < numpy.datetime64(config.cutoff_date))
+    acm_raw_x = map_datetime_to_x(acm_raw_week_x_date)
+    acm_baseline_x = acm_raw_x[baseline_part]
+    acm_baseline_y = numpy.asarray(acm_raw_y)[baseline_part]
+    acm_raw_x_date = numpy.asarray(acm_raw_x_date)[raw_part]
+    acm_raw_y = numpy.asarray(acm_raw_y)[raw_part]
 
     baseline_average_x_list = []
     baseline_average_x_date_list = []
-    x_date = min(acm_raw_x_date) + BASELINE_INTERVAL / 2
-    while x_date < BASELINE_CUTOFF_DATE:
+    x_date = min(acm_raw_x_date) + config.interval / 2
+    while x_date < config.cutoff_date:
         baseline_average_x_list.append((x_date - T0_DATE).days)
         baseline_average_x_date_list.append(x_date)
-        x_date += BASELINE_INTERVAL
+        x_date += config.interval
     baseline_average_x = numpy.array(baseline_average_x_list)
     baseline_average_x_date = numpy.array(baseline_average_x_date_list)
-    baseline_average_y_list = []
-    for baseline_x in baseline_average_x_date_list:
-        window_start_date = baseline_x - BASELINE_INTERVAL / 2
-        window_end_date = baseline_x + BASELINE_INTERVAL / 2
-        average_sum = 0
-        average_count = 0
-        for acm_date, acm_y in zip(acm_raw_x_date, acm_raw_y):
-            if acm_date >= window_start_date and acm_date < window_end_date:
-                average_sum += acm_y
-                average_count += 1
-        baseline_y = average_sum / average_count
-        baseline_average_y_list.append(baseline_y)
-    baseline_average_y = numpy.array(baseline_average_y_list)
+    acm_raw_windows = WeeklyWindows(acm_raw_x_date, acm_raw_y)
+    baseline_average_y = acm_raw_windows.means([baseline_x - config.interval / 2 for baseline_x in baseline_average_x_date_list],
+                                               [baseline_x + config.interval / 2 for baseline_x in baseline_average_x_date_list])
     
     if all_cause_mortality_estimate is not None:
         acm_estimate_x_list = [baseline_average_x[-1]]
@@ -803,22 +2342,19 @@ def calculate_acm_baseline_method1(all_cause_mortality, all_cause_mortality_esti
         acm_estimate_x = None
         acm_estimate_x_date = None
         acm_estimate_y = None
-    if False:
-        # spline trend
-        spline_only_fn = scipy.interpolate.PchipInterpolator(baseline_average_x, baseline_average_y, axis=0, extrapolate=True)
-        if all_cause_mortality_estimate is not None:
-            def baseline_trend_fn(x):
-                y = spline_only_fn(x)
-                y[x > acm_estimate_x[0]]= acm_estimate_y[0] + (x[x>acm_estimate_x[0]] - acm_estimate_x[0]) * (acm_estimate_y[1] - acm_estimate_y[0]) / (acm_estimate_x[1] - acm_estimate_x[0])
-                return y
+    if spline_trend:
+        # spline trend, continuing as a line towards the first estimate
+        if acm_estimate_x is not None:
+            baseline_trend_fn = get_pchip_trend(baseline_average_x, baseline_average_y, acm_estimate_x[1], acm_estimate_y[1])
         else:
-            baseline_trend_fn = spline_only_fn
-    else:
+            baseline_trend_fn = get_pchip_trend(baseline_average_x, baseline_average_y)
+    elif acm_estimate_x is not None:
         # linear trend
         baseline_average_and_estimate_x = numpy.concatenate((baseline_average_x, acm_estimate_x[1:]))
-        baseline_average_and_estimate_x_date = numpy.concatenate((baseline_average_x_date, acm_estimate_x_date[1:]))
         baseline_average_and_estimate_y = numpy.concatenate((baseline_average_y, acm_estimate_y[1:]))
-        baseline_trend_fn = scipy.interpolate.interp1d(baseline_average_and_estimate_x, baseline_average_and_estimate_y, axis=0, fill_value="extrapolate")
+        baseline_trend_fn = PiecewiseLinearTrend(baseline_average_and_estimate_x, baseline_average_and_estimate_y)
+    else:
+        baseline_trend_fn = PiecewiseLinearTrend(baseline_average_x, baseline_average_y)
         
     def days_to_rad(days):
         return 1 / DAYS_IN_YEAR_EXACT * 2 * math.pi * days
@@ -828,119 +2364,67 @@ def calculate_acm_baseline_method1(all_cause_mortality, all_cause_mortality_esti
         return baseline * (1 + a * numpy.cos(days_to_rad(x + t_offs)))
 
     baseline_cosine_params, _ = scipy.optimize.curve_fit(baseline_cosine_fn, acm_baseline_x, acm_baseline_y, p0=[-51, 0])
-    print("Cosine time offset %.2f days (%.3f rad)" % (baseline_cosine_params[0], days_to_rad(baseline_cosine_params[0])))
-    print("Cosine amplitude factor: %.4f" % (baseline_cosine_params[1],))
-    def baseline_fn(x):
-        return baseline_cosine_fn(x, *baseline_cosine_params)
-
-    excess_mortality_x_list = []
-    excess_mortality_x_date_list = []
-    excess_mortality_y_list = []
-    excess_mortality_baseline_part_sum = 0
-    excess_mortality_baseline_part_count = 0
-    baseline_part_deaths_sum = 0
-    for item_date, item_deaths in all_cause_mortality:
-        x = (item_date - T0_DATE).days
-        baseline_deaths = baseline_fn(numpy.array([x]))[0]
-        excess_deaths = item_deaths - baseline_deaths
-        if item_date < BASELINE_CUTOFF_DATE:
-            excess_mortality_baseline_part_sum += excess_deaths
-            excess_mortality_baseline_part_count += 1
-            baseline_part_deaths_sum += item_deaths
-        excess_mortality_x_list.append(x)
-        excess_mortality_x_date_list.append(item_date)
-        excess_mortality_y_list.append(excess_deaths)
-    excess_mortality_x = numpy.array(excess_mortality_x_list)
-    excess_mortality_x_date = numpy.array(excess_mortality_x_date_list)
-    excess_mortality_y = numpy.array(excess_mortality_y_list)
-    if excess_mortality_baseline_part_count > 0:
-        excess_mortality_baseline_part_avg = excess_mortality_baseline_part_sum / excess_mortality_baseline_part_count
-    else:
-        excess_mortality_baseline_part_avg = 0
-    print("Sum of excess deaths: %.1f of %d total deaths" % (excess_mortality_baseline_part_sum, baseline_part_deaths_sum))
+    baseline_fn = SeasonalTrendBaseline(baseline_trend_fn, *baseline_cosine_params)
+    return BaselineFit(baseline_average_x, baseline_average_x_date, baseline_average_y,
+                       acm_estimate_x, acm_estimate_x_date, acm_estimate_y,
+                       baseline_trend_fn, baseline_fn)
 
-    output_dataseries("data_output/excess_mortality.csv", 
-                      ["excess_mortality_x", "excess_mortality_x_date", "excess_mortality_y"],
-                      excess_mortality_x, excess_mortality_x_date, excess_mortality_y)
-    return (
-        (acm_raw_x, acm_raw_x_date, acm_raw_y),
-        (acm_averaged_x, acm_averaged_x_date, acm_averaged_y),
-        (baseline_average_x, baseline_average_x_date, baseline_average_y),
-        (acm_estimate_x, acm_estimate_x_date, acm_estimate_y),
-        (baseline_trend_fn, baseline_fn),
-        (excess_mortality_x, excess_mortality_x_date, excess_mortality_y)
-    )
+def get_method2_knot_dates(first_date, last_date, knot_spacing):
+    """
+    Trend knot dates of method 2: *first_date*, every *knot_spacing* after it
+    and *last_date*, dropping a spaced knot closer than half a spacing to
+    *last_date*. Only the first and the last date if *knot_spacing* is None.
+    """
+    knot_dates = [first_date]
+    if knot_spacing is not None:
+        if knot_spacing <= datetime.timedelta(0):
+            raise ValueError("Knot spacing must be positive: %s" % (knot_spacing,))
+        knot_count = 1
+        while first_date + knot_count * knot_spacing < last_date - knot_spacing / 2:
+            knot_dates.append(first_date + knot_count * knot_spacing)
+            knot_count += 1
+    knot_dates.append(last_date)
+    return knot_dates
 
-def calculate_acm_baseline_method2(all_cause_mortality, all_cause_mortality_estimate):
-    acm_raw_x_list = []
-    acm_raw_x_date_list = []
-    acm_raw_y_list = []
-    acm_baseline_x_list = []
-    acm_baseline_x_date_list = []
-    acm_baseline_y_list = []
-    for item_date, item_deaths in all_cause_mortality:
-        x = (item_date - T0_DATE).days
-        acm_raw_x_list.append(x)
-        acm_raw_x_date_list.append(item_date)
-        acm_raw_y_list.append(item_deaths)
-        if BASELINE_START_DATE <= item_date < BASELINE_CUTOFF_DATE:
-            acm_baseline_x_list.append(x)
-            acm_baseline_x_date_list.append(item_date)
-            acm_baseline_y_list.append(item_deaths)
-    acm_raw_x = numpy.array(acm_raw_x_list)
-    acm_raw_x_date = numpy.array(acm_raw_x_date_list)
-    acm_raw_y = numpy.array(acm_raw_y_list)
-    acm_baseline_x = numpy.array(acm_baseline_x_list)
-    acm_baseline_x_date = numpy.array(acm_baseline_x_date_list)
-    acm_baseline_y = numpy.array(acm_baseline_y_list)
+def test_get_method2_knot_dates():
+    first_date, last_date = datetime.date(2008, 1, 7), datetime.date(2020, 12, 28)
+    assert get_method2_knot_dates(first_date, last_date, None) == [first_date, last_date]
+    yearly = get_method2_knot_dates(first_date, last_date, datetime.timedelta(days=365))
+    assert len(yearly) == 14 and yearly[1] == datetime.date(2009, 1, 6) and yearly[-1] == last_date
+    assert min((b - a for a, b in zip(yearly[:-1], yearly[1:]))) >= datetime.timedelta(days=365/2)
+    assert len(get_method2_knot_dates(first_date, last_date, datetime.timedelta(days=182))) == 27
+test_get_method2_knot_dates()
 
-    acm_averaged_x = acm_raw_x
-    acm_averaged_x_date = acm_raw_x_date
-    acm_averaged_y = calculate_variable_window_moving_average(acm_raw_y, 7)
-
-    baseline_point_x_list = []
-    baseline_point_x_date_list = []
-    min_date = min(acm_baseline_x_date)
-    max_date = max(acm_baseline_x_date)
-    for x_date in (min_date, max_date):
-        baseline_point_x_list.append((x_date - T0_DATE).days)
-        baseline_point_x_date_list.append(x_date)
-    #for year in range(min_date.year+1, max_date.year+10, 3):
-    #    x_date = datetime.date(year, 1, 1) + datetime.timedelta(days=182)
-    #    if min_date <= x_date <= max_date and x_date < BASELINE_CUTOFF_DATE:
-    #        baseline_point_x_list.append((x_date - T0_DATE).days)
-    #        baseline_point_x_date_list.append(x_date)
-    baseline_point_x = numpy.array(baseline_point_x_list)
+def fit_acm_baseline_method2(acm_raw_x_date, acm_raw_y, all_cause_mortality_estimate, config=DEFAULT_BASELINE_CONFIG, initial_baseline_fn=None):
+    """
+    Fit the method 2 baseline to weekly deaths *acm_raw_y* on the dates
+    *acm_raw_x_date* (datetime.date) without printing or writing anything,
+    and return a BaselineFit. The trend is fitted through the anchor points
+    of get_method2_knot_dates(). The seasonal term of a
+    SeasonalTrendBaseline *initial_baseline_fn*, such as the fit of a nearby
+    cutoff date, is used as the starting point of the fit.
+    """
+    acm_raw_week_x_date = numpy.asarray(acm_raw_x_date, dtype="datetime64[D]")
+    acm_raw_x = map_datetime_to_x(acm_raw_week_x_date)
+    baseline_part = (acm_raw_week_x_date >= numpy.datetime64(config.start_date)) & (acm_raw_week_x_date < numpy.datetime64(config.cutoff_date))
+    acm_baseline_x = acm_raw_x[baseline_part]
+    acm_baseline_x_date = numpy.asarray(acm_raw_x_date)[baseline_part]
+    acm_baseline_y = numpy.asarray(acm_raw_y)[baseline_part]
+
+    baseline_point_x_date_list = get_method2_knot_dates(min(acm_baseline_x_date), max(acm_baseline_x_date), config.knot_spacing)
+    baseline_point_x = numpy.array([(x_date - T0_DATE).days for x_date in baseline_point_x_date_list])
     baseline_point_x_date = numpy.array(baseline_point_x_date_list)
-    baseline_average_y_list = []
-    for baseline_x in baseline_point_x_date_list:
-        window_size = datetime.timedelta(days=365*3)
-        window_start_date = baseline_x - window_size / 2
-        window_end_date = baseline_x + window_size / 2
-        average_sum = 0
-        average_count = 0
-        for acm_date, acm_y in zip(acm_raw_x_date, acm_raw_y):
-            if acm_date >= window_start_date and acm_date < window_end_date:
-                average_sum += acm_y
-                average_count += 1
-        baseline_y = average_sum / average_count
-        baseline_average_y_list.append(baseline_y)
-    baseline_average_y = numpy.array(baseline_average_y_list)
+    acm_raw_windows = WeeklyWindows(acm_raw_x_date, acm_raw_y)
+    baseline_average_y = acm_raw_windows.means([baseline_x - config.anchor_window / 2 for baseline_x in baseline_point_x_date_list],
+                                               [baseline_x + config.anchor_window / 2 for baseline_x in baseline_point_x_date_list])
 
-    if False:
-        print("Years\tTrend extrapolation slope")
-        for i in (5, 6, 7, 8, 9, 10, 11):
-            trend_extrapolation_slope = calculate_trend_extrapolation_slope(all_cause_mortality, years=i)
-            print("%d\t%.5f" % (i, trend_extrapolation_slope))
-        trend_extrapolation_slope = calculate_trend_extrapolation_slope(all_cause_mortality, years=10)
+    if config.estimation_past_years is not None:
+        trend_extrapolation_slope = calculate_trend_extrapolation_slope(acm_raw_windows, years=config.estimation_past_years,
+                                                                        cutoff_date=config.cutoff_date)
     else:
         trend_extrapolation_slope = None
-    
-    print("Year\t3 year average weekly dead")
-    for x_date, deaths_average in zip(baseline_point_x_date, baseline_average_y):
-        print("%s\t%.1f" % (x_date.year, deaths_average))
+
     if all_cause_mortality_estimate is not None:
-        print("Year\tEstimated average weekly dead")
         acm_estimate_x_list = [baseline_point_x[-1]]
         acm_estimate_x_date_list = [baseline_point_x_date[-1]]
         acm_estimate_y_list = [baseline_average_y[-1]]
@@ -948,7 +2432,6 @@ def calculate_acm_baseline_method2(all_cause_mortality, all_cause_mortality_esti
             x = (x_date - T0_DATE).days
             acm_estimate_x_list.append(x)
             acm_estimate_x_date_list.append(x_date)
-            print("%s\t%.1f" % (x_date.year, estimated_weekly_mortality))
             acm_estimate_y_list.append(estimated_weekly_mortality)
         acm_estimate_x = numpy.array(acm_estimate_x_list)
         acm_estimate_x_date = numpy.array(acm_estimate_x_date_list)
@@ -960,103 +2443,812 @@ def calculate_acm_baseline_method2(all_cause_mortality, all_cause_mortality_esti
 
     # linear interpolation between points found through curve fitting, where the point y-values are curve fitting variables
     #
-        
-    def get_linfit_fn(yvalues):
-        linfit_x = baseline_point_x
-        if acm_estimate_x is not None:
-            linfit_x = numpy.concatenate((linfit_x, acm_estimate_x[1:]))
+    linfit_x = baseline_point_x
+    if acm_estimate_x is not None:
+        linfit_x = numpy.concatenate((linfit_x, acm_estimate_x[1:]))
+    if trend_extrapolation_slope is not None:
+        trend_extrapolation_delta_x = linfit_x[-1] - linfit_x[-2]
+        linfit_x = numpy.concatenate((linfit_x, numpy.array([linfit_x[-1] + trend_extrapolation_delta_x])))
+
+    def get_linfit_y(yvalues):
         linfit_y = numpy.array(yvalues)
         if acm_estimate_x is not None:
             linfit_y = numpy.concatenate((linfit_y, acm_estimate_y[1:]))
         if trend_extrapolation_slope is not None:
-            delta_x = linfit_x[-1] - linfit_x[-2]
-            trend_extrapolation_x = linfit_x[-1] + (linfit_x[-1] - linfit_x[-2])
-            trend_extrapolation_y = linfit_y[-1] + delta_x * trend_extrapolation_slope
-            linfit_x = numpy.concatenate((linfit_x, numpy.array([trend_extrapolation_x])))
+            trend_extrapolation_y = linfit_y[-1] + trend_extrapolation_delta_x * trend_extrapolation_slope
             linfit_y = numpy.concatenate((linfit_y, numpy.array([trend_extrapolation_y])))
-        return scipy.interpolate.interp1d(linfit_x, linfit_y, axis=0, fill_value="extrapolate")
-        
-    def days_to_rad(days):
-        return 1 / DAYS_IN_YEAR_EXACT * 2 * math.pi * days
-        
-    def baseline_optimization_fn(x, t_offs, a, *yvalues):
-        assert len(yvalues) == len(baseline_point_x), "Invalid lengths: %s != %s" % (len(yvalues), len(baseline_point_x))
-        linfit_fn = get_linfit_fn(yvalues)
-        trend_value = linfit_fn(x)
-        return trend_value * (1 + a * numpy.cos(days_to_rad(x + t_offs)))
-
-    # Reason for this hack is that curve_fit inspects the optimization function and requires 
-    # positional parameters, i.e. variable *args is not possible. This array allows for
-    # variable amount of piecewise linear points
-    fn_wrappers = [lambda x, t_offs, a, p0: baseline_optimization_fn(x, t_offs, a, p0),
-                   lambda x, t_offs, a, p0, p1: baseline_optimization_fn(x, t_offs, a, p0, p1),
-                   lambda x, t_offs, a, p0, p1, p2: baseline_optimization_fn(x, t_offs, a, p0, p1, p2),
-                   lambda x, t_offs, a, p0, p1, p2, p3: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5, p6: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5, p6),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16),
-                   lambda x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16, p17: baseline_optimization_fn(x, t_offs, a, p0, p1, p2, p3, p4, p5, p6, p7, p8, p9, p10, p11, p12, p13, p14, p15, p16, p17),
-                   ]
-    optimization_values, _ = scipy.optimize.curve_fit(fn_wrappers[len(baseline_point_x)-1], acm_baseline_x, acm_baseline_y)
-    baseline_trend_fn = get_linfit_fn(optimization_values[2:])
-    print("Cosine time offset %.2f days (%.3f rad)" % (optimization_values[0], days_to_rad(optimization_values[0])))
-    print("Cosine amplitude factor: %.4f" % (optimization_values[1],))
-    
-    def baseline_fn(x):
-        return baseline_optimization_fn(x, *optimization_values)
-
-    excess_mortality_x_list = []
-    excess_mortality_x_date_list = []
-    excess_mortality_y_list = []
-    excess_mortality_baseline_part_sum = 0
-    excess_mortality_baseline_part_count = 0
-    baseline_part_deaths_sum = 0
+        return linfit_y
+
+    # The trend is a fixed sparse hat function basis times the knot y-values, which are an affine
+    # function of the fitted y-values. For a fixed seasonal term the model is linear in them.
+    linfit_y_offset = get_linfit_y(numpy.zeros(len(baseline_point_x)))
+    linfit_y_basis = numpy.column_stack([get_linfit_y(unit_y) - linfit_y_offset for unit_y in numpy.eye(len(baseline_point_x))])
+    acm_baseline_basis = get_linear_interpolation_basis(linfit_x, acm_baseline_x)
+    seasonal_params0 = {} if initial_baseline_fn is None else {"t_offs0": initial_baseline_fn.t_offs, "a0": initial_baseline_fn.a}
+    if config.robust_loss is None:
+        t_offs, a, yvalues = fit_seasonal_trend_baseline(acm_baseline_x, acm_baseline_y,
+                                                         acm_baseline_basis @ linfit_y_basis, acm_baseline_basis @ linfit_y_offset,
+                                                         **seasonal_params0)
+        weights = None
+    else:
+        t_offs, a, yvalues, baseline_weights = fit_robust_seasonal_trend_baseline(acm_baseline_x, acm_baseline_y,
+                                                                                  acm_baseline_basis @ linfit_y_basis,
+                                                                                  acm_baseline_basis @ linfit_y_offset,
+                                                                                  config.robust_loss, **seasonal_params0)
+        # weights of all the weeks of the series, zero outside the fitted weeks
+        weights = numpy.zeros(len(acm_raw_x))
+        weights[baseline_part] = baseline_weights
+    baseline_trend_fn = PiecewiseLinearTrend(linfit_x, get_linfit_y(yvalues))
+    baseline_fn = SeasonalTrendBaseline(baseline_trend_fn, t_offs, a)
+    return BaselineFit(baseline_point_x, baseline_point_x_date, baseline_average_y,
+                       acm_estimate_x, acm_estimate_x_date, acm_estimate_y,
+                       baseline_trend_fn, baseline_fn, weights)
+
+class BaselineMethod:
+    """
+    Baseline method of BASELINE_MODELS with its BaselineConfig and optional
+    estimates. fit(x_date, y) fits it to weekly deaths and returns the
+    method, after which predict(x) and integrate(a, b) evaluate the fitted
+    baseline and params holds its parameters. Subclasses implement
+    fit_baseline(x_date, y), which returns a BaselineFit. Bump the version
+    of a subclass when its fit changes, so that cached fits are refitted.
+    """
+    version = 1
+
+    def __init__(self, config=DEFAULT_BASELINE_CONFIG, all_cause_mortality_estimate=None):
+        self.config = config
+        self.all_cause_mortality_estimate = all_cause_mortality_estimate
+        self.baseline_fit = None
+
+    def fit(self, acm_raw_x_date, acm_raw_y):
+        self.baseline_fit = self.fit_baseline(numpy.asarray(acm_raw_x_date, dtype=object), numpy.asarray(acm_raw_y))
+        return self
+
+    @property
+    def baseline_fn(self):
+        return self.baseline_fit.baseline_fn
+
+    def predict(self, x):
+        return self.baseline_fit.baseline_fn(x)
+
+    def integrate(self, a, b):
+        return self.baseline_fit.baseline_fn.integrate(a, b)
+
+    @property
+    def params(self):
+        baseline_fn = self.baseline_fit.baseline_fn
+        return dict(baseline_fn.seasonal_params,
+                    trend_knot_x=baseline_fn.trend.knot_x,
+                    trend_knot_y=self.baseline_fit.baseline_trend_fn(baseline_fn.trend.knot_x))
+
+    def get_cache_key(self, acm_raw_x_date, acm_raw_y):
+        key_hash = hashlib.sha256()
+        key_hash.update(("%s\0%d\0%s\0%s\0" % (type(self).__name__, self.version, repr(self.config),
+                                               repr(self.all_cause_mortality_estimate))).encode("utf-8"))
+        key_hash.update(numpy.asarray(acm_raw_x_date, dtype="datetime64[D]").tobytes())
+        key_hash.update(numpy.asarray(acm_raw_y, dtype=numpy.float64).tobytes())
+        return key_hash.hexdigest()
+
+class Method1Baseline(BaselineMethod):
+    """Linear trend through the averages of consecutive windows of config.interval."""
+    def fit_baseline(self, acm_raw_x_date, acm_raw_y):
+        return fit_acm_baseline_method1(acm_raw_x_date, acm_raw_y, self.all_cause_mortality_estimate, self.config)
+
+class Method1PchipBaseline(BaselineMethod):
+    """PCHIP spline trend through the averages of consecutive windows of config.interval."""
+    def fit_baseline(self, acm_raw_x_date, acm_raw_y):
+        return fit_acm_baseline_method1(acm_raw_x_date, acm_raw_y, self.all_cause_mortality_estimate, self.config, spline_trend=True)
+
+class Method2Baseline(BaselineMethod):
+    """Linear trend fitted together with the seasonal term through the knots of config.knot_spacing."""
+    def fit_baseline(self, acm_raw_x_date, acm_raw_y):
+        return fit_acm_baseline_method2(acm_raw_x_date, acm_raw_y, self.all_cause_mortality_estimate, self.config)
+
+class SerflingBaselineMethod(BaselineMethod):
+    """Serfling regression with SERFLING_HARMONICS harmonics, see fit_serfling_baselines. Estimates are not supported."""
+    def fit_baseline(self, acm_raw_x_date, acm_raw_y):
+        if self.all_cause_mortality_estimate is not None:
+            raise ValueError("Serfling baselines do not support estimates")
+        serfling_fit = fit_serfling_baselines(acm_raw_x_date, acm_raw_y, self.config)
+        baseline_fn, = get_serfling_baseline_fns(serfling_fit)
+        anchor_x = serfling_fit.trend_knot_x
+        return BaselineFit(anchor_x, numpy.array([T0_DATE + datetime.timedelta(days=int(x)) for x in anchor_x.tolist()]),
+                           baseline_fn.trend(anchor_x), None, None, None, baseline_fn.trend, baseline_fn)
+
+class QuasiPoissonBaselineMethod(BaselineMethod):
+    """Quasi-Poisson GLM with SERFLING_HARMONICS harmonics, see fit_quasi_poisson_baselines. Estimates are not supported."""
+    def fit_baseline(self, acm_raw_x_date, acm_raw_y):
+        if self.all_cause_mortality_estimate is not None:
+            raise ValueError("Quasi-Poisson baselines do not support estimates")
+        quasi_poisson_fit = fit_quasi_poisson_baselines(acm_raw_x_date, acm_raw_y, self.config)
+        baseline_fn, = get_quasi_poisson_baseline_fns(quasi_poisson_fit)
+        baseline_trend_fn = get_quasi_poisson_trend_fn(baseline_fn)
+        anchor_x = quasi_poisson_fit.trend_knot_x
+        return BaselineFit(anchor_x, numpy.array([T0_DATE + datetime.timedelta(days=int(x)) for x in anchor_x.tolist()]),
+                           baseline_trend_fn(anchor_x), None, None, None, baseline_trend_fn, baseline_fn)
+
+BASELINE_MODELS = {
+    "method1": Method1Baseline,
+    "method1_pchip": Method1PchipBaseline,
+    "method2": Method2Baseline,
+    "serfling": SerflingBaselineMethod,
+    "quasi_poisson": QuasiPoissonBaselineMethod,
+}
+
+BASELINE_MODEL_NAME = "method2"
+
+MODEL_CACHE_DIR = "cache/models"
+
+def encode_baseline_fit(baseline_fit):
+    baseline_fn = baseline_fit.baseline_fn
+    arrays = {
+        "anchor_x": baseline_fit.anchor_x,
+        "anchor_x_date": numpy.asarray(baseline_fit.anchor_x_date, dtype="datetime64[D]"),
+        "anchor_y": baseline_fit.anchor_y,
+        "trend_knot_x": baseline_fn.trend.knot_x,
+        "trend_coefficients": baseline_fn.trend.coefficients,
+    }
+    arrays.update(((name, numpy.asarray(value)) for name, value in baseline_fn.seasonal_params.items()))
+    # linear trends keep their knot values, which evaluate exactly at the knots
+    if isinstance(baseline_fn.trend, PiecewiseLinearTrend):
+        arrays["trend_knot_y"] = baseline_fn.trend.knot_y
+    if baseline_fit.weights is not None:
+        arrays["weights"] = baseline_fit.weights
+    if baseline_fit.estimate_x is not None:
+        arrays["estimate_x"] = baseline_fit.estimate_x
+        arrays["estimate_x_date"] = numpy.asarray(baseline_fit.estimate_x_date, dtype="datetime64[D]")
+        arrays["estimate_y"] = baseline_fit.estimate_y
+    return arrays
+
+def decode_baseline_fit(arrays):
+    if "trend_knot_y" in arrays:
+        baseline_trend_fn = PiecewiseLinearTrend(arrays["trend_knot_x"], arrays["trend_knot_y"])
+    else:
+        baseline_trend_fn = PiecewiseCubicTrend(arrays["trend_knot_x"], arrays["trend_coefficients"])
+    if "estimate_x" in arrays:
+        estimate = (arrays["estimate_x"], arrays["estimate_x_date"].astype(object), arrays["estimate_y"])
+    else:
+        estimate = (None, None, None)
+    if "dispersion" in arrays:
+        baseline_fn = QuasiPoissonBaseline(SerflingBaseline(baseline_trend_fn, arrays["harmonic_coefficients"]), float(arrays["dispersion"]))
+        baseline_trend_fn = get_quasi_poisson_trend_fn(baseline_fn)
+    elif "harmonic_coefficients" in arrays:
+        baseline_fn = SerflingBaseline(baseline_trend_fn, arrays["harmonic_coefficients"])
+    else:
+        baseline_fn = SeasonalTrendBaseline(baseline_trend_fn, float(arrays["t_offs"]), float(arrays["a"]))
+    return BaselineFit(arrays["anchor_x"], arrays["anchor_x_date"].astype(object), arrays["anchor_y"], *estimate,
+                       baseline_trend_fn, baseline_fn, arrays.get("weights"))
+
+def fit_baseline_model(model_name, acm_raw_x_date, acm_raw_y, all_cause_mortality_estimate=None,
+                       config=DEFAULT_BASELINE_CONFIG, cache_dir=MODEL_CACHE_DIR):
+    """
+    Fit the baseline model *model_name* of BASELINE_MODELS to weekly deaths
+    *acm_raw_y* on the dates *acm_raw_x_date* and return the fitted model.
+    The fit is cached in *cache_dir* under a hash of the model and its
+    version, *config*, the estimates and the series, like load_parsed_csv.
+    """
+    model = BASELINE_MODELS[model_name](config, all_cause_mortality_estimate)
+    if cache_dir is None:
+        return model.fit(acm_raw_x_date, acm_raw_y)
+    cache_file_name = os.path.join(cache_dir, model.get_cache_key(acm_raw_x_date, acm_raw_y) + ".npz")
+    if os.path.exists(cache_file_name):
+        with numpy.load(cache_file_name, allow_pickle=False) as arrays:
+            model.baseline_fit = decode_baseline_fit(dict(arrays.items()))
+        return model
+    model.fit(acm_raw_x_date, acm_raw_y)
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_file_name = "%s.%d.tmp" % (cache_file_name, os.getpid())
+    with open(temp_file_name, "wb") as cache_file:
+        numpy.savez(cache_file, **encode_baseline_fit(model.baseline_fit))
+    os.replace(temp_file_name, cache_file_name)
+    return model
+
+def test_fit_baseline_model():
+    import tempfile
+    x_date = numpy.arange(numpy.datetime64("2010-01-04"), numpy.datetime64("2016-01-04"), 7).astype(object)
+    x = numpy.array([(x_date_item - T0_DATE).days for x_date_item in x_date.tolist()])
+    y = 1000 + 0.01 * x + 80 * numpy.cos(2 * math.pi * (x - 30) / DAYS_IN_YEAR_EXACT)
+    config = DEFAULT_BASELINE_CONFIG._replace(start_date=datetime.date(2010, 1, 1), cutoff_date=datetime.date(2016, 1, 1))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for model_name in BASELINE_MODELS:
+            fitted = fit_baseline_model(model_name, x_date, y, config=config, cache_dir=cache_dir)
+            cached = fit_baseline_model(model_name, x_date, y, config=config, cache_dir=cache_dir)
+            assert cached.predict(x).tolist() == fitted.predict(x).tolist(), "Invalid cached fit of %s" % (model_name,)
+            assert cached.integrate(x[0], x[-1]) == fitted.integrate(x[0], x[-1])
+            assert cached.params["trend_knot_x"].tolist() == fitted.params["trend_knot_x"].tolist()
+        assert len(os.listdir(cache_dir)) == len(BASELINE_MODELS)
+test_fit_baseline_model()
+
+def calculate_acm_baseline(all_cause_mortality, all_cause_mortality_estimate, model_name=BASELINE_MODEL_NAME, config=DEFAULT_BASELINE_CONFIG,
+                           cache_dir=MODEL_CACHE_DIR, output_filename="data_output/excess_mortality.csv"):
+    acm_raw_x_list = []
+    acm_raw_x_date_list = []
+    acm_raw_y_list = []
     for item_date, item_deaths in all_cause_mortality:
         x = (item_date - T0_DATE).days
-        baseline_deaths = baseline_fn(numpy.array([x]))[0]
-        excess_deaths = item_deaths - baseline_deaths
-        if item_date < BASELINE_CUTOFF_DATE:
-            excess_mortality_baseline_part_sum += excess_deaths
-            excess_mortality_baseline_part_count += 1
-            baseline_part_deaths_sum += item_deaths
-        excess_mortality_x_list.append(x)
-        excess_mortality_x_date_list.append(item_date)
-        excess_mortality_y_list.append(excess_deaths)
-    excess_mortality_x = numpy.array(excess_mortality_x_list)
-    excess_mortality_x_date = numpy.array(excess_mortality_x_date_list)
-    excess_mortality_y = numpy.array(excess_mortality_y_list)
-    if excess_mortality_baseline_part_count > 0:
-        excess_mortality_baseline_part_avg = excess_mortality_baseline_part_sum / excess_mortality_baseline_part_count
-    else:
-        excess_mortality_baseline_part_avg = 0
+        acm_raw_x_list.append(x)
+        acm_raw_x_date_list.append(item_date)
+        acm_raw_y_list.append(item_deaths)
+    acm_raw_x = numpy.array(acm_raw_x_list)
+    acm_raw_x_date = numpy.array(acm_raw_x_date_list)
+    acm_raw_y = numpy.array(acm_raw_y_list)
+
+    acm_averaged_x = acm_raw_x
+    acm_averaged_x_date = acm_raw_x_date
+    acm_averaged_y = calculate_variable_window_moving_average(acm_raw_y, config.smoothing_weeks)
+
+    baseline_fit = fit_baseline_model(model_name, acm_raw_x_date, acm_raw_y, all_cause_mortality_estimate, config, cache_dir).baseline_fit
+    baseline_point_x, baseline_point_x_date = baseline_fit.anchor_x, baseline_fit.anchor_x_date
+    acm_estimate_x, acm_estimate_x_date, acm_estimate_y = baseline_fit.estimate_x, baseline_fit.estimate_x_date, baseline_fit.estimate_y
+    baseline_trend_fn, baseline_fn = baseline_fit.baseline_trend_fn, baseline_fit.baseline_fn
+    print("Year\t3 year average weekly dead")
+    for x_date, deaths_average in zip(baseline_point_x_date, baseline_fit.anchor_y):
+        print("%s\t%.1f" % (x_date.year, deaths_average))
+    if all_cause_mortality_estimate is not None:
+        print("Year\tEstimated average weekly dead")
+        for x_date, estimated_weekly_mortality in all_cause_mortality_estimate:
+            print("%s\t%.1f" % (x_date.year, estimated_weekly_mortality))
+
+    for line in baseline_fn.describe():
+        print(line)
+
+    excess_mortality = calculate_excess_mortality(all_cause_mortality, baseline_fn)
+    excess_mortality_baseline_part_sum, baseline_part_deaths_sum = excess_mortality.excess_before(config.cutoff_date)
     print("Sum of excess deaths: %.1f of %d total deaths" % (excess_mortality_baseline_part_sum, baseline_part_deaths_sum))
 
     excess_mortality_week = []
-    for x_date in excess_mortality_x_date:
+    for x_date in excess_mortality.x_date:
         year, week, _ = x_date.isocalendar()
         excess_mortality_week.append("%dW%02d" % (year, week))
-    output_dataseries("data_output/excess_mortality.csv", 
+    output_dataseries(output_filename,
                       ["excess_mortality_x", "excess_mortality_x_date", "excess_mortality_week", "excess_mortality_y"],
-                      excess_mortality_x, excess_mortality_x_date, excess_mortality_week, excess_mortality_y)
+                      excess_mortality.x, excess_mortality.x_date, excess_mortality_week, excess_mortality.excess)
     return (
         (acm_raw_x, acm_raw_x_date, acm_raw_y),
         (acm_averaged_x, acm_averaged_x_date, acm_averaged_y),
         (baseline_point_x, baseline_point_x_date, baseline_trend_fn(baseline_point_x)),
         (acm_estimate_x, acm_estimate_x_date, acm_estimate_y),
         (baseline_trend_fn, baseline_fn),
-        (excess_mortality_x, excess_mortality_x_date, excess_mortality_y)
+        excess_mortality
     )
 
+class SharedArray:
+    """
+    numpy array in multiprocessing shared memory. It pickles as the name of
+    the shared memory block, so process pool workers attach to the data
+    instead of receiving a copy. The creating process must unlink() it.
+    """
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        size = max(1, math.prod(self.shape) * self.dtype.itemsize)
+        self.shared_memory = multiprocessing.shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.array = numpy.ndarray(self.shape, self.dtype, buffer=self.shared_memory.buf)
+
+    @classmethod
+    def copy_of(cls, array):
+        shared_array = cls(array.shape, array.dtype)
+        shared_array.array[...] = array
+        return shared_array
+
+    def __reduce__(self):
+        return (SharedArray, (self.shape, self.dtype.str, self.shared_memory.name))
+
+    def close(self):
+        self.array = None
+        self.shared_memory.close()
+
+    def unlink(self):
+        self.close()
+        self.shared_memory.unlink()
+
+class CategoryBaselines:
+    """
+    Baselines fitted separately to each category of a WeeklyMortality, as
+    (category x week) matrices aligned with *week_index*. *weights* are the
+    weights of the weeks in the fits, or None.
+    """
+    def __init__(self, categories, week_index, deaths, baselines, baseline_fns, weights=None):
+        assert deaths.shape == baselines.shape == (len(categories), len(week_index))
+        assert weights is None or weights.shape == deaths.shape
+        self.categories = list(categories)
+        self.week_index = week_index
+        self.deaths = deaths
+        self.baselines = baselines
+        self.baseline_fns = list(baseline_fns)
+        self.weights = weights
+        self.excess = deaths - baselines
+        self.cumulative_excess = numpy.cumsum(self.excess, axis=1)
+        self.category_rows = dict(((category, index) for index, category in enumerate(self.categories)))
+
+    def __len__(self):
+        return len(self.categories)
+
+    def excess_mortality(self, category):
+        """ExcessMortality of one category."""
+        row = self.category_rows[category]
+        return ExcessMortality(self.week_index.x, self.week_index.dates, self.deaths[row], self.baselines[row])
+
+# Number of batches of series per process pool worker in fit_series_baselines,
+# so that uneven fitting times still balance between the workers
+SERIES_BATCHES_PER_WORKER = 4
+
+def fit_shared_baselines(shared_week_x_date, shared_deaths, shared_baselines, shared_weights, columns, all_cause_mortality_estimate, config):
+    """
+    Process pool task of fit_series_baselines: fit the range *columns* of the
+    shared (week x series) deaths and write their baselines, and their
+    weights in robust fits, to the same rows of the shared (series x week)
+    baselines and weights.
+    """
+    week_x_date = shared_week_x_date.array
+    week_dates = week_x_date.astype(object)
+    week_x = map_datetime_to_x(week_x_date)
+    baseline_fns = []
+    for column in columns:
+        baseline_fit = fit_acm_baseline_method2(week_dates, shared_deaths.array[:, column], all_cause_mortality_estimate, config)
+        shared_baselines.array[column] = baseline_fit.baseline_fn(week_x)
+        if baseline_fit.weights is not None:
+            shared_weights.array[column] = baseline_fit.weights
+        baseline_fns.append(baseline_fit.baseline_fn)
+    for shared_array in (shared_week_x_date, shared_deaths, shared_baselines, shared_weights):
+        shared_array.close()
+    return baseline_fns
+
+def fit_series_baselines(week_x_date, deaths, all_cause_mortality_estimate=None, max_workers=None, config=DEFAULT_BASELINE_CONFIG):
+    """
+    Fit a method 2 baseline to each column of the (week x series) *deaths*
+    in a process pool of *max_workers* processes (all CPUs by default), and
+    return the (series x week) baselines, the list of baseline models and
+    the (series x week) weights of robust fits, None if config.robust_loss
+    is None. The deaths go to the workers in shared memory, in contiguous
+    batches of columns.
+    """
+    week_x_date = numpy.asarray(week_x_date, dtype="datetime64[D]")
+    series_count = deaths.shape[1]
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_workers <= 1 or series_count <= 1:
+        week_dates = week_x_date.astype(object)
+        baseline_fits = [fit_acm_baseline_method2(week_dates, deaths[:, column], all_cause_mortality_estimate, config)
+                         for column in range(series_count)]
+        baseline_fns = [baseline_fit.baseline_fn for baseline_fit in baseline_fits]
+        baselines = numpy.array([baseline_fn(map_datetime_to_x(week_x_date)) for baseline_fn in baseline_fns]).reshape((series_count, len(week_x_date)))
+        weights = None
+        if config.robust_loss is not None:
+            weights = numpy.array([baseline_fit.weights for baseline_fit in baseline_fits]).reshape((series_count, len(week_x_date)))
+        return baselines, baseline_fns, weights
+    workers = min(max_workers, series_count)
+    batch_bounds = numpy.linspace(0, series_count, min(series_count, workers * SERIES_BATCHES_PER_WORKER) + 1).astype(int).tolist()
+    shared_arrays = [SharedArray.copy_of(week_x_date), SharedArray.copy_of(deaths),
+                     SharedArray((series_count, len(week_x_date)), numpy.float64), SharedArray((series_count, len(week_x_date)), numpy.float64)]
+    try:
+        shared_week_x_date, shared_deaths, shared_baselines, shared_weights = shared_arrays
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(fit_shared_baselines, shared_week_x_date, shared_deaths, shared_baselines, shared_weights,
+                                       range(batch_start, batch_end), all_cause_mortality_estimate, config)
+                       for batch_start, batch_end in zip(batch_bounds[:-1], batch_bounds[1:])]
+            baseline_fns = [baseline_fn for future in futures for baseline_fn in future.result()]
+        baselines = shared_baselines.array.copy()
+        weights = None if config.robust_loss is None else shared_weights.array.copy()
+    finally:
+        for shared_array in shared_arrays:
+            shared_array.unlink()
+    return baselines, baseline_fns, weights
+
+def fit_serfling_series_baselines(week_x_date, deaths, all_cause_mortality_estimate=None, max_workers=None, config=DEFAULT_BASELINE_CONFIG):
+    """
+    Like fit_series_baselines with Serfling baselines, which are fitted for
+    all series at once in this process, so *max_workers* is not used. The
+    weights are zero in the epidemic weeks of each series.
+    """
+    if all_cause_mortality_estimate is not None:
+        raise ValueError("Serfling baselines do not support estimates")
+    serfling_fit = fit_serfling_baselines(week_x_date, deaths, config)
+    return serfling_fit.baselines, get_serfling_baseline_fns(serfling_fit), serfling_fit.weights.T.copy()
+
+def fit_quasi_poisson_series_baselines(week_x_date, deaths, all_cause_mortality_estimate=None, max_workers=None, config=DEFAULT_BASELINE_CONFIG):
+    """
+    Like fit_series_baselines with quasi-Poisson baselines, which are fitted
+    for all series at once in this process, so *max_workers* is not used.
+    There are no weights.
+    """
+    if all_cause_mortality_estimate is not None:
+        raise ValueError("Quasi-Poisson baselines do not support estimates")
+    quasi_poisson_fit = fit_quasi_poisson_baselines(week_x_date, deaths, config)
+    return quasi_poisson_fit.baselines, get_quasi_poisson_baseline_fns(quasi_poisson_fit), None
+
+# Functions which fit a baseline to each column of (week x series) deaths, by
+# name, with the arguments and the result of fit_series_baselines
+SERIES_BASELINE_ENGINES = {
+    "method2": fit_series_baselines,
+    "serfling": fit_serfling_series_baselines,
+    "quasi_poisson": fit_quasi_poisson_series_baselines,
+}
+
+def fit_category_baselines(weekly_mortality, categories, all_cause_mortality_estimate=None, max_workers=None, config=ROBUST_BASELINE_CONFIG,
+                           engine="method2"):
+    """
+    Fit a baseline to each of *categories* of *weekly_mortality* with the
+    SERIES_BASELINE_ENGINES function *engine* and return a
+    CategoryBaselines.
+    """
+    deaths = weekly_mortality.columns(categories)
+    baselines, baseline_fns, weights = SERIES_BASELINE_ENGINES[engine](weekly_mortality.week_x_date, deaths, all_cause_mortality_estimate,
+                                                                       max_workers, config)
+    return CategoryBaselines(categories, weekly_mortality.week_index, deaths.T.copy(), baselines, baseline_fns, weights)
+
+class RegionExcessMortality:
+    """
+    Baselines fitted separately to each age band of each region, as
+    (region x category x week) cubes aligned with *week_index*. The first
+    category is the total of all age bands. *weights* are the weights of
+    the weeks in the fits, or None.
+    """
+    def __init__(self, regions, categories, week_index, deaths, baselines, baseline_fns, weights=None):
+        assert deaths.shape == baselines.shape == (len(regions), len(categories), len(week_index))
+        assert weights is None or weights.shape == deaths.shape
+        self.regions = list(regions)
+        self.categories = list(categories)
+        self.week_index = week_index
+        self.deaths = deaths
+        self.baselines = baselines
+        self.weights = weights
+        # baseline models indexed [region][category]
+        self.baseline_fns = baseline_fns
+        self.excess = deaths - baselines
+        self.cumulative_excess = numpy.cumsum(self.excess, axis=2)
+
+    def __len__(self):
+        return len(self.regions)
+
+    def excess_mortality(self, region, category):
+        """ExcessMortality of one age band of one region."""
+        region_row = self.regions.index(region)
+        category_row = self.categories.index(category)
+        return ExcessMortality(self.week_index.x, self.week_index.dates,
+                               self.deaths[region_row, category_row], self.baselines[region_row, category_row])
+
+def fit_region_baselines(region_weekly_mortality, all_cause_mortality_estimate=None, max_workers=None, config=ROBUST_BASELINE_CONFIG,
+                         engine="method2"):
+    """
+    Fit a baseline to the total and to each age band of each region of
+    *region_weekly_mortality* in one call of the SERIES_BASELINE_ENGINES
+    function *engine*, and return a RegionExcessMortality.
+    """
+    region_deaths = region_weekly_mortality.deaths
+    deaths = numpy.concatenate((region_deaths.sum(axis=2, keepdims=True), region_deaths), axis=2)
+    categories = ["total"] + region_weekly_mortality.categories
+    region_count, week_count, category_count = deaths.shape
+    series_deaths = deaths.transpose((1, 0, 2)).reshape((week_count, region_count * category_count))
+    baselines, baseline_fns, weights = SERIES_BASELINE_ENGINES[engine](region_weekly_mortality.week_x_date, series_deaths,
+                                                                       all_cause_mortality_estimate, max_workers, config)
+    return RegionExcessMortality(region_weekly_mortality.regions, categories, region_weekly_mortality.week_index,
+                                 deaths.transpose((0, 2, 1)).copy(),
+                                 baselines.reshape((region_count, category_count, week_count)),
+                                 [baseline_fns[region_row*category_count:(region_row+1)*category_count] for region_row in range(region_count)],
+                                 None if weights is None else weights.reshape((region_count, category_count, week_count)))
+
+def concatenate_region_excess_mortality(parts):
+    """Join RegionExcessMortality *parts* with the same categories and weeks into one."""
+    parts = list(parts)
+    if not parts:
+        raise ValueError("No regions")
+    has_weights = all((part.weights is not None for part in parts))
+    return RegionExcessMortality([region for part in parts for region in part.regions], parts[0].categories, parts[0].week_index,
+                                 numpy.concatenate([part.deaths for part in parts]),
+                                 numpy.concatenate([part.baselines for part in parts]),
+                                 [region_fns for part in parts for region_fns in part.baseline_fns],
+                                 numpy.concatenate([part.weights for part in parts]) if has_weights else None)
+
+# Regions per RegionWeeklyMortality chunk of the streamed regional weekly ACM file
+REGIONS_PER_CHUNK = 4
+
+def fit_region_chunk_baselines(chunks, engines=("method2",), all_cause_mortality_estimate=None, max_workers=None, config=ROBUST_BASELINE_CONFIG):
+    """
+    Like fit_region_baselines for each of the SERIES_BASELINE_ENGINES
+    functions *engines*, for regions read as RegionWeeklyMortality *chunks*.
+    The next chunk is read with prefetch_chunks while the current one is
+    fitted, so only two chunks of deaths are held besides the fitted cubes.
+    Returns a list of one RegionExcessMortality per engine.
+    """
+    engine_parts = [[] for _ in engines]
+    for chunk in prefetch_chunks(iter(chunks)):
+        for parts, engine in zip(engine_parts, engines):
+            parts.append(fit_region_baselines(chunk, all_cause_mortality_estimate, max_workers, config, engine))
+    return [concatenate_region_excess_mortality(parts) for parts in engine_parts]
+
+def test_fit_region_chunk_baselines():
+    week_index = WeekIndex(numpy.arange(numpy.datetime64("2010-01-04"), numpy.datetime64("2016-01-04"), 7))
+    rng = numpy.random.default_rng(3)
+    seasonal = 1 + 0.1 * numpy.cos(2 * math.pi * (week_index.x - 30) / DAYS_IN_YEAR_EXACT)
+    deaths = rng.poisson(numpy.array([40, 80, 120, 160, 200])[:, None, None] * seasonal[None, :, None] * [[[0.3, 0.7]]]).astype(numpy.int32)
+    region_weekly_mortality = RegionWeeklyMortality(["MK%02d" % (region,) for region in range(5)], week_index, deaths, ["0-64", "65-"])
+    config = DEFAULT_BASELINE_CONFIG._replace(start_date=datetime.date(2010, 1, 1), cutoff_date=datetime.date(2015, 1, 1))
+    chunks = [region_weekly_mortality.select(regions) for regions in (["MK00", "MK01"], ["MK02", "MK03"], ["MK04"])]
+    for engine, chunked in zip(SERIES_BASELINE_ENGINES, fit_region_chunk_baselines(chunks, tuple(SERIES_BASELINE_ENGINES), max_workers=1,
+                                                                                    config=config)):
+        whole = fit_region_baselines(region_weekly_mortality, max_workers=1, config=config, engine=engine)
+        assert chunked.regions == whole.regions and len(chunked.baseline_fns) == len(whole.regions)
+        assert numpy.allclose(chunked.baselines, whole.baselines, rtol=1e-9), "Chunked %s fit differs" % (engine,)
+        assert numpy.array_equal(chunked.deaths, whole.deaths)
+test_fit_region_chunk_baselines()
+
+BOOTSTRAP_REPLICATES = 1000
+BOOTSTRAP_BLOCK_WEEKS = 8
+BOOTSTRAP_SEED = 0
+BOOTSTRAP_PERCENTILES = (2.5, 97.5)
+
+def get_seasonal_block_bootstrap_indices(rng, week_count, replicates, block_weeks, season_weeks=round(WEEKS_IN_YEAR_EXACT)):
+    """
+    (replicate x week) indices of a seasonal block bootstrap over *week_count*
+    weeks. Each block of *block_weeks* consecutive weeks is replaced by the
+    same weeks of a randomly chosen year, shifting by a whole number of
+    *season_weeks*, so the resampled weeks keep their place in the season
+    and their autocorrelation within the block.
+    """
+    block_starts = numpy.arange(0, week_count, block_weeks)
+    block_lengths = numpy.minimum(block_weeks, week_count - block_starts)
+    min_shifts = -(block_starts // season_weeks)
+    max_shifts = (week_count - block_lengths - block_starts) // season_weeks
+    shifts = rng.integers(min_shifts, max_shifts + 1, size=(replicates, len(block_starts)))
+    weeks = numpy.arange(week_count)
+    return weeks + season_weeks * shifts[:, weeks // block_weeks]
+
+def test_get_seasonal_block_bootstrap_indices():
+    indices = get_seasonal_block_bootstrap_indices(numpy.random.default_rng(1), 200, 50, 8, season_weeks=52)
+    assert indices.shape == (50, 200)
+    assert indices.min() >= 0 and indices.max() < 200
+    assert ((indices - numpy.arange(200)) % 52 == 0).all()
+    assert (numpy.diff(indices[:, :8], axis=1) == 1).all()
+test_get_seasonal_block_bootstrap_indices()
+
+class BaselineBootstrap:
+    """
+    Bootstrap replicates of a baseline. *excess_mortality* is the
+    ExcessMortality of the fit to the observed deaths, and *baselines* a
+    (replicate x week) matrix of the refitted baselines over the same weeks.
+    The weekly excess of each replicate is the observed deaths minus its
+    baseline, and its all-time cumulative excess starts at *start_date*, the
+    start of the fitted weeks.
+    """
+    def __init__(self, excess_mortality, baselines, baseline_fns, start_date):
+        assert baselines.shape == (len(baseline_fns), len(excess_mortality))
+        self.excess_mortality = excess_mortality
+        self.baselines = baselines
+        self.baseline_fns = list(baseline_fns)
+        self.start_date = start_date
+        self.excess = excess_mortality.deaths - baselines
+        self.all_time_weeks = excess_mortality.x_date >= start_date
+        self.all_time_cumulative_excess = numpy.cumsum(self.excess[:, self.all_time_weeks], axis=1)
+
+    def __len__(self):
+        return len(self.baseline_fns)
+
+    def baseline_bands(self, percentiles=BOOTSTRAP_PERCENTILES):
+        """(percentile x week) matrix of the baseline."""
+        return numpy.percentile(self.baselines, percentiles, axis=0)
+
+    def excess_bands(self, percentiles=BOOTSTRAP_PERCENTILES):
+        """(percentile x week) matrix of the weekly excess deaths."""
+        return numpy.percentile(self.excess, percentiles, axis=0)
+
+    def all_time_cumulative_excess_bands(self, percentiles=BOOTSTRAP_PERCENTILES):
+        """(percentile x week) matrix of the cumulative excess deaths, for the weeks from start_date on."""
+        return numpy.percentile(self.all_time_cumulative_excess, percentiles, axis=0)
+
+    def param_bands(self, percentiles=BOOTSTRAP_PERCENTILES):
+        """Percentiles of the cosine time offsets and of the amplitudes."""
+        t_offs = numpy.array([baseline_fn.t_offs for baseline_fn in self.baseline_fns])
+        a = numpy.array([baseline_fn.a for baseline_fn in self.baseline_fns])
+        return numpy.percentile(t_offs, percentiles), numpy.percentile(a, percentiles)
+
+def bootstrap_acm_baseline_method2(acm_raw_x_date, acm_raw_y, all_cause_mortality_estimate,
+                                   replicates=BOOTSTRAP_REPLICATES, block_weeks=BOOTSTRAP_BLOCK_WEEKS, seed=BOOTSTRAP_SEED, max_workers=None,
+                                   config=DEFAULT_BASELINE_CONFIG):
+    """
+    Fit the method 2 baseline to weekly deaths *acm_raw_y* on the dates
+    *acm_raw_x_date* (datetime.date), and refit it to *replicates* series
+    where the residuals of the baseline part are resampled with
+    get_seasonal_block_bootstrap_indices(). The replicates are fitted with
+    fit_series_baselines. Returns a BaselineBootstrap.
+    """
+    acm_raw_x_date = numpy.array(acm_raw_x_date, dtype=object)
+    week_x_date = acm_raw_x_date.astype("datetime64[D]")
+    acm_raw_x = map_datetime_to_x(week_x_date)
+    acm_raw_y = numpy.asarray(acm_raw_y, dtype=numpy.float64)
+    baseline_fn = fit_acm_baseline_method2(acm_raw_x_date, acm_raw_y, all_cause_mortality_estimate, config).baseline_fn
+    excess_mortality = ExcessMortality(acm_raw_x, acm_raw_x_date, acm_raw_y, baseline_fn(acm_raw_x))
+    baseline_part = numpy.flatnonzero((week_x_date >= numpy.datetime64(config.start_date)) & (week_x_date < numpy.datetime64(config.cutoff_date)))
+    fitted_y = excess_mortality.baseline[baseline_part]
+    residuals = acm_raw_y[baseline_part] - fitted_y
+    indices = get_seasonal_block_bootstrap_indices(numpy.random.default_rng(seed), len(baseline_part), replicates, block_weeks)
+    resampled_y = numpy.repeat(acm_raw_y[:, None], replicates, axis=1)
+    resampled_y[baseline_part] = fitted_y[:, None] + residuals[indices].T
+    baselines, baseline_fns, _ = fit_series_baselines(week_x_date, resampled_y, all_cause_mortality_estimate, max_workers, config)
+    return BaselineBootstrap(excess_mortality, baselines, baseline_fns, config.start_date)
+
+def print_baseline_bootstrap_params(baseline_bootstrap):
+    (t_offs_low, t_offs_high), (a_low, a_high) = baseline_bootstrap.param_bands()
+    print("Bootstrap %g-%g%% interval of %d replicates:" % (BOOTSTRAP_PERCENTILES + (len(baseline_bootstrap),)))
+    print("Cosine time offset %.2f - %.2f days" % (t_offs_low, t_offs_high))
+    print("Cosine amplitude factor: %.4f - %.4f" % (a_low, a_high))
+
+BACKTEST_FIRST_CUTOFF_DATE = datetime.date(2012, 1, 1)
+BACKTEST_CUTOFF_INTERVAL = dateutil.relativedelta.relativedelta(months=3)
+BACKTEST_HORIZON_WEEKS = 52
+EXCESS_PERIOD_START_DATE = datetime.date(2020, 1, 1)
+EXCESS_PERIOD_END_DATE = datetime.date(2023, 1, 1)
+
+# Scores of the baseline fitted to the weeks before *cutoff_date*: the fitted
+# seasonal term, the root mean square error of the fitted weeks, the mean,
+# mean absolute, root mean square and mean absolute percentage error of the
+# BACKTEST_HORIZON_WEEKS weeks from the cutoff date on, and the excess deaths
+# from EXCESS_PERIOD_START_DATE to EXCESS_PERIOD_END_DATE
+BacktestScore = collections.namedtuple("BacktestScore", ["cutoff_date", "t_offs", "a", "fit_rmse",
+                                                         "bias", "mae", "rmse", "mape", "period_excess"])
+
+def get_backtest_cutoff_dates(week_x_date, first_cutoff_date=BACKTEST_FIRST_CUTOFF_DATE, cutoff_interval=BACKTEST_CUTOFF_INTERVAL,
+                              horizon_weeks=BACKTEST_HORIZON_WEEKS):
+    """Cutoff dates from *first_cutoff_date* on which are followed by at least *horizon_weeks* of the weeks *week_x_date*."""
+    week_x_date = numpy.asarray(week_x_date, dtype="datetime64[D]")
+    cutoff_dates = []
+    cutoff_date = first_cutoff_date
+    while week_x_date.searchsorted(numpy.datetime64(cutoff_date)) + horizon_weeks <= len(week_x_date):
+        cutoff_dates.append(cutoff_date)
+        cutoff_date += cutoff_interval
+    return cutoff_dates
+
+def backtest_cutoff_dates(acm_raw_x_date, acm_raw_y, cutoff_dates, horizon_weeks, config):
+    """
+    Fit the method 2 baseline for each of *cutoff_dates* in order and score
+    it, starting each fit from the baseline of the previous cutoff date.
+    Also the process pool task of backtest_acm_baseline_method2.
+    """
+    week_x_date = numpy.asarray(acm_raw_x_date, dtype="datetime64[D]")
+    week_x = map_datetime_to_x(week_x_date)
+    acm_raw_y = numpy.asarray(acm_raw_y, dtype=numpy.float64)
+    excess_weeks = (week_x_date >= numpy.datetime64(EXCESS_PERIOD_START_DATE)) & (week_x_date < numpy.datetime64(EXCESS_PERIOD_END_DATE))
+    scores = []
+    baseline_fn = None
+    for cutoff_date in cutoff_dates:
+        baseline_fn = fit_acm_baseline_method2(acm_raw_x_date, acm_raw_y, None, config._replace(cutoff_date=cutoff_date),
+                                               initial_baseline_fn=baseline_fn).baseline_fn
+        fit_start, cutoff = week_x_date.searchsorted([numpy.datetime64(config.start_date), numpy.datetime64(cutoff_date)])
+        fit_errors = acm_raw_y[fit_start:cutoff] - baseline_fn(week_x[fit_start:cutoff])
+        horizon_y = acm_raw_y[cutoff:cutoff+horizon_weeks]
+        errors = horizon_y - baseline_fn(week_x[cutoff:cutoff+horizon_weeks])
+        scores.append(BacktestScore(cutoff_date, baseline_fn.t_offs, baseline_fn.a, math.sqrt(numpy.mean(fit_errors**2)),
+                                    numpy.mean(errors), numpy.mean(numpy.abs(errors)), math.sqrt(numpy.mean(errors**2)),
+                                    100 * numpy.mean(numpy.abs(errors) / horizon_y),
+                                    numpy.sum(acm_raw_y[excess_weeks] - baseline_fn(week_x[excess_weeks]))))
+    return scores
+
+def backtest_acm_baseline_method2(acm_raw_x_date, acm_raw_y, cutoff_dates=None, horizon_weeks=BACKTEST_HORIZON_WEEKS, max_workers=None,
+                                  config=DEFAULT_BASELINE_CONFIG):
+    """
+    Rolling-origin backtest of the method 2 baseline: fit it to the weeks
+    before each of *cutoff_dates* (by default get_backtest_cutoff_dates())
+    and score the following *horizon_weeks* weeks. The cutoff dates are split
+    into one contiguous chain per process pool worker, and within a chain
+    each fit starts from the previous one. Returns a list of BacktestScore.
+    """
+    acm_raw_x_date = numpy.array(acm_raw_x_date, dtype=object)
+    if cutoff_dates is None:
+        cutoff_dates = get_backtest_cutoff_dates(acm_raw_x_date, horizon_weeks=horizon_weeks)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if max_workers <= 1 or len(cutoff_dates) <= 1:
+        return backtest_cutoff_dates(acm_raw_x_date, acm_raw_y, cutoff_dates, horizon_weeks, config)
+    chain_bounds = numpy.linspace(0, len(cutoff_dates), min(max_workers, len(cutoff_dates)) + 1).astype(int).tolist()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(chain_bounds) - 1) as executor:
+        futures = [executor.submit(backtest_cutoff_dates, acm_raw_x_date, acm_raw_y, cutoff_dates[chain_start:chain_end], horizon_weeks, config)
+                   for chain_start, chain_end in zip(chain_bounds[:-1], chain_bounds[1:])]
+        return [score for future in futures for score in future.result()]
+
+# Grids of settings swept in main(), by model of BASELINE_MODELS. Each setting is a BaselineConfig
+# field with the list of values to try. *smoothing_weeks* only changes the smoothed fit error, so
+# configs which differ only in it share one fit.
+BASELINE_SWEEP_GRIDS = (
+    ("method1", {"start_date": [datetime.date(2006, 1, 1), BASELINE_START_DATE, datetime.date(2010, 1, 1)],
+                 "interval": [datetime.timedelta(days=365*2), BASELINE_INTERVAL, datetime.timedelta(days=365*4)]}),
+    ("method2", {"start_date": [datetime.date(2006, 1, 1), BASELINE_START_DATE, datetime.date(2010, 1, 1)],
+                 "anchor_window": [datetime.timedelta(days=365*2), BASELINE_ANCHOR_WINDOW, datetime.timedelta(days=365*4)],
+                 "smoothing_weeks": [5, BASELINE_SMOOTHING_WEEKS, 9],
+                 "estimation_past_years": [None, 5, ESTIMATION_PAST_YEARS],
+                 "robust_loss": [None] + list(ROBUST_WEIGHT_FUNCTIONS)}),
+)
+
+# Result of one configuration of a sweep: the method and its configuration,
+# the fitted seasonal term, the root mean square error of the fitted weeks
+# against the deaths and against their moving average, the sum of excess
+# deaths over the fitted weeks, and the excess deaths from
+# EXCESS_PERIOD_START_DATE to EXCESS_PERIOD_END_DATE
+SweepResult = collections.namedtuple("SweepResult", ("method",) + BaselineConfig._fields +
+                                     ("t_offs", "a", "fit_rmse", "smoothed_fit_rmse", "fit_excess", "period_excess"))
+
+def get_baseline_config_grid(settings, base_config=DEFAULT_BASELINE_CONFIG):
+    """
+    BaselineConfig of every combination of the values in *settings*, a dict
+    of value lists keyed by BaselineConfig field, with the other fields from
+    *base_config*.
+    """
+    fields = list(settings)
+    return [base_config._replace(**dict(zip(fields, values))) for values in itertools.product(*(settings[field] for field in fields))]
+
+def get_sweep_fit_key(config):
+    """*config* without the fields which only change how a fit is scored, so configs with the same key share one fit."""
+    return config._replace(smoothing_weeks=None)
+
+def sweep_config_chain(acm_raw_x_date, acm_raw_y, method, configs):
+    """
+    Fit and score the baseline of *method* with each of *configs*, fitting
+    configs with the same get_sweep_fit_key() once. Also the process pool
+    task of sweep_baseline_configs.
+    """
+    week_x_date = numpy.asarray(acm_raw_x_date, dtype="datetime64[D]")
+    week_x = map_datetime_to_x(week_x_date)
+    acm_raw_y = numpy.asarray(acm_raw_y, dtype=numpy.float64)
+    excess_weeks = (week_x_date >= numpy.datetime64(EXCESS_PERIOD_START_DATE)) & (week_x_date < numpy.datetime64(EXCESS_PERIOD_END_DATE))
+    baseline_fns = {}
+    smoothed_ys = {}
+    results = []
+    for config in configs:
+        fit_key = get_sweep_fit_key(config)
+        if fit_key not in baseline_fns:
+            baseline_fns[fit_key] = BASELINE_MODELS[method](config).fit(acm_raw_x_date, acm_raw_y).baseline_fn
+        baseline_fn = baseline_fns[fit_key]
+        if config.smoothing_weeks not in smoothed_ys:
+            smoothed_ys[config.smoothing_weeks] = calculate_variable_window_moving_average(acm_raw_y, config.smoothing_weeks)
+        smoothed_y = smoothed_ys[config.smoothing_weeks]
+        fit_start, cutoff = week_x_date.searchsorted([numpy.datetime64(config.start_date), numpy.datetime64(config.cutoff_date)])
+        fit_baseline = baseline_fn(week_x[fit_start:cutoff])
+        fit_errors = acm_raw_y[fit_start:cutoff] - fit_baseline
+        results.append(SweepResult(method, *config, baseline_fn.t_offs, baseline_fn.a, math.sqrt(numpy.mean(fit_errors**2)),
+                                   math.sqrt(numpy.mean((smoothed_y[fit_start:cutoff] - fit_baseline)**2)), numpy.sum(fit_errors),
+                                   numpy.sum(acm_raw_y[excess_weeks] - baseline_fn(week_x[excess_weeks]))))
+    return results
+
+def test_sweep_config_chain():
+    x_date = numpy.arange(numpy.datetime64("2010-01-04"), numpy.datetime64("2016-01-04"), 7).astype(object)
+    x = numpy.array([(x_date_item - T0_DATE).days for x_date_item in x_date.tolist()])
+    y = 1000 + 0.01 * x + 80 * numpy.cos(2 * math.pi * (x - 30) / DAYS_IN_YEAR_EXACT) + 20 * numpy.sin(x / 10)
+    base_config = DEFAULT_BASELINE_CONFIG._replace(start_date=datetime.date(2010, 1, 1), cutoff_date=datetime.date(2016, 1, 1))
+    configs = get_baseline_config_grid({"smoothing_weeks": [3, 9], "anchor_window": [datetime.timedelta(days=365*2)]}, base_config)
+    results = sweep_config_chain(x_date, y, "method2", configs)
+    assert [result.smoothing_weeks for result in results] == [3, 9]
+    assert results[0].t_offs == results[1].t_offs and results[0].fit_rmse == results[1].fit_rmse
+    assert results[0].smoothed_fit_rmse != results[1].smoothed_fit_rmse
+test_sweep_config_chain()
+
+def sweep_baseline_configs(acm_raw_x_date, acm_raw_y, method, configs, max_workers=None):
+    """
+    Fit the baseline of *method* (a key of BASELINE_MODELS) to weekly
+    deaths *acm_raw_y* on the dates *acm_raw_x_date* with each of *configs*,
+    and return a list of SweepResult in the order of *configs*. Configs which
+    share a fit are grouped, and the groups are split into one chain per
+    process pool worker.
+    """
+    acm_raw_x_date = numpy.array(acm_raw_x_date, dtype=object)
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    fit_groups = {}
+    for index, config in enumerate(configs):
+        fit_groups.setdefault(get_sweep_fit_key(config), []).append(index)
+    fit_groups = list(fit_groups.values())
+    if max_workers <= 1 or len(fit_groups) <= 1:
+        return sweep_config_chain(acm_raw_x_date, acm_raw_y, method, configs)
+    chain_bounds = numpy.linspace(0, len(fit_groups), min(max_workers, len(fit_groups)) + 1).astype(int).tolist()
+    chain_indices = [[index for fit_group in fit_groups[chain_start:chain_end] for index in fit_group]
+                     for chain_start, chain_end in zip(chain_bounds[:-1], chain_bounds[1:])]
+    results = [None] * len(configs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(chain_indices)) as executor:
+        futures = [executor.submit(sweep_config_chain, acm_raw_x_date, acm_raw_y, method, [configs[index] for index in indices])
+                   for indices in chain_indices]
+        for indices, future in zip(chain_indices, futures):
+            for index, result in zip(indices, future.result()):
+                results[index] = result
+    return results
+
 def calculate_life_expectancy_fn(country_life_expectancy):
     life_expectancy_x = []
     life_expectancy_x_date = []
@@ -1114,7 +3306,7 @@ def combine_deaths_by_month(finland_deaths_by_month_since_1945, finland_deaths_a
                 })
     return result
 
-def split_acm_by_cutoff_date(acm_averaged_x, acm_averaged_x_date, acm_averaged_y):
+def split_acm_by_cutoff_date(acm_averaged_x, acm_averaged_x_date, acm_averaged_y, config=DEFAULT_BASELINE_CONFIG):
     baseline_part_x_list = []
     baseline_part_x_date_list = []
     baseline_part_y_list = []
@@ -1122,7 +3314,7 @@ def split_acm_by_cutoff_date(acm_averaged_x, acm_averaged_x_date, acm_averaged_y
     nonbaseline_part_x_date_list = []
     nonbaseline_part_y_list = []
     for x, d, y in zip(acm_averaged_x, acm_averaged_x_date, acm_averaged_y):
-        if d < BASELINE_CUTOFF_DATE:
+        if d < config.cutoff_date:
             baseline_part_x_list.append(x)
             baseline_part_x_date_list.append(d)
             baseline_part_y_list.append(y)
@@ -1147,12 +3339,95 @@ def output_dataseries(output_filename, headings, *data_columns):
         write_line(headings)
         for tupl in zip(*data_columns):
             write_line(tupl)
+
+def test_calculate_acm_baseline():
+    import tempfile
+    import contextlib
+    x_date = numpy.arange(numpy.datetime64("2010-01-04"), numpy.datetime64("2016-01-04"), 7).astype(object)
+    x = numpy.array([(x_date_item - T0_DATE).days for x_date_item in x_date.tolist()])
+    y = numpy.round(1000 + 0.01 * x + 80 * numpy.cos(2 * math.pi * (x - 30) / DAYS_IN_YEAR_EXACT))
+    config = DEFAULT_BASELINE_CONFIG._replace(start_date=datetime.date(2010, 1, 1), cutoff_date=datetime.date(2015, 1, 1))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for model_name in BASELINE_MODELS:
+            output_filename = os.path.join(temp_dir, model_name + ".csv")
+            with contextlib.redirect_stdout(io.StringIO()) as printed:
+                *_, (_, baseline_fn), excess_mortality = calculate_acm_baseline(list(zip(x_date.tolist(), y.tolist())), None, model_name, config,
+                                                                                None, output_filename)
+            assert baseline_fn.describe() and printed.getvalue().endswith("total deaths\n"), "Invalid printout of %s" % (model_name,)
+            assert numpy.abs(excess_mortality.excess).max() < 0.05 * y.min(), "Invalid excess of %s" % (model_name,)
+            with open(output_filename, encoding="utf-8") as output_file:
+                assert len(output_file.readlines()) == len(x) + 1
+test_calculate_acm_baseline()
             
-def get_model_yearly_mortality(baseline_fn, year):
-    a = (datetime.date(year, 1, 1) - T0_DATE).days
-    b = (datetime.date(year+1, 1, 1) - T0_DATE).days
-    y, err = scipy.integrate.quad(baseline_fn, a, b)
-    return round(y/7)
+def output_category_excess_mortality(output_filename, category_baselines):
+    week_index = category_baselines.week_index
+    week_labels = ["%dW%02d" % (x_date.isocalendar()[0], x_date.isocalendar()[1]) for x_date in week_index.dates.tolist()]
+    output_dataseries(output_filename,
+                      ["excess_mortality_x", "excess_mortality_x_date", "excess_mortality_week"] + category_baselines.categories,
+                      week_index.x, week_index.dates, week_labels, *category_baselines.excess)
+
+def output_baseline_bootstrap(output_filename, all_time_output_filename, baseline_bootstrap):
+    excess_mortality = baseline_bootstrap.excess_mortality
+    percentile_labels = ["p%g" % (percentile,) for percentile in BOOTSTRAP_PERCENTILES]
+    output_dataseries(output_filename,
+                      ["baseline_fn_x", "baseline_fn_x_date", "baseline_fn_y"] + ["baseline_fn_y_" + label for label in percentile_labels] +
+                      ["excess_mortality_y"] + ["excess_mortality_y_" + label for label in percentile_labels],
+                      excess_mortality.x, excess_mortality.x_date, excess_mortality.baseline, *baseline_bootstrap.baseline_bands(),
+                      excess_mortality.excess, *baseline_bootstrap.excess_bands())
+    all_time_excess_mortality = excess_mortality.since(baseline_bootstrap.start_date)
+    output_dataseries(all_time_output_filename,
+                      ["cumulative_excess_mortality_x", "cumulative_excess_mortality_x_date", "cumulative_excess_mortality_y"] +
+                      ["cumulative_excess_mortality_y_" + label for label in percentile_labels],
+                      all_time_excess_mortality.x, all_time_excess_mortality.x_date, all_time_excess_mortality.cumulative_excess,
+                      *baseline_bootstrap.all_time_cumulative_excess_bands())
+
+def output_baseline_backtest(output_filename, backtest_scores):
+    output_dataseries(output_filename, list(BacktestScore._fields), *zip(*backtest_scores))
+
+def output_baseline_sweep(output_filename, sweep_results):
+    def format_setting(value):
+        if value is None:
+            return ""
+        elif isinstance(value, datetime.timedelta):
+            return value.days
+        return value
+    output_dataseries(output_filename, list(SweepResult._fields),
+                      *([format_setting(value) for value in column] for column in zip(*sweep_results)))
+
+def output_quasi_poisson_zscores(output_filename, week_index, categories, quasi_poisson_fit):
+    week_labels = ["%dW%02d" % (x_date.isocalendar()[0], x_date.isocalendar()[1]) for x_date in week_index.dates.tolist()]
+    output_dataseries(output_filename,
+                      ["zscore_x", "zscore_x_date", "zscore_week"] + list(categories),
+                      week_index.x, week_index.dates, week_labels, *quasi_poisson_fit.zscores)
+
+def output_baseline_model_comparison(output_filename, acm_raw_x, acm_raw_x_date, acm_raw_y, baseline_models):
+    """Write the weekly baselines of the fitted *baseline_models*, a dict keyed by model name, side by side."""
+    output_dataseries(output_filename,
+                      ["x", "x_date", "deaths"] + ["baseline_" + model_name for model_name in baseline_models],
+                      acm_raw_x, acm_raw_x_date, acm_raw_y, *(model.predict(acm_raw_x) for model in baseline_models.values()))
+
+def output_category_weights(output_filename, category_baselines):
+    week_index = category_baselines.week_index
+    week_labels = ["%dW%02d" % (x_date.isocalendar()[0], x_date.isocalendar()[1]) for x_date in week_index.dates.tolist()]
+    output_dataseries(output_filename,
+                      ["weight_x", "weight_x_date", "weight_week"] + category_baselines.categories,
+                      week_index.x, week_index.dates, week_labels, *category_baselines.weights)
+
+def output_region_excess_mortality(output_filename, region_excess_mortality):
+    """Write the (region x category x week) cubes of *region_excess_mortality* into one .npz file."""
+    weights = {} if region_excess_mortality.weights is None else {"weights": region_excess_mortality.weights}
+    numpy.savez_compressed(output_filename,
+                           regions=numpy.array(region_excess_mortality.regions),
+                           categories=numpy.array(region_excess_mortality.categories),
+                           week_x_date=region_excess_mortality.week_index.x_date,
+                           deaths=region_excess_mortality.deaths,
+                           baselines=region_excess_mortality.baselines,
+                           excess=region_excess_mortality.excess,
+                           **weights)
+    print("Wrote %s" % (output_filename,))
+
+def get_model_yearly_mortality(baseline_fn, years):
+    return [round(deaths) for deaths in baseline_fn.yearly_totals(years).tolist()]
 
 def plot_deaths_forecast_vs_model(deaths_forecast, baseline_fn):
     plot_x_list = []
@@ -1173,10 +3448,11 @@ def plot_deaths_forecast_vs_model(deaths_forecast, baseline_fn):
     plot_fc2019_inactive_list = []
     plot_fc2021_inactive_list = []
     forecast_years = (2021, 2019, 2018, 2015, 2012, 2009, 2007)
-    for year_values in sorted(deaths_forecast, key=lambda x: x["year"]):
+    deaths_forecast = sorted(deaths_forecast, key=lambda x: x["year"])
+    model_deaths_by_year = get_model_yearly_mortality(baseline_fn, [year_values["year"] for year_values in deaths_forecast])
+    for year_values, model_deaths in zip(deaths_forecast, model_deaths_by_year):
         year = year_values["year"]
         plot_x_list.append(year)
-        model_deaths = round(get_model_yearly_mortality(baseline_fn, year))
         plot_model_list.append(model_deaths)
         if year == 2021:
             deaths_actual = 57343
@@ -1417,7 +3693,7 @@ def plot_monthly_deaths_per_100k(deaths_and_population_by_month, covid_data):
     #plt.show(block=True)
     plt.close(fig)
     
-def plot_weekly_deaths_per_age_per_1M(population_by_year_and_age, acm_by_category):
+def plot_weekly_deaths_per_age_per_1M(population_by_age, weekly_mortality):
     age_buckets = [
         {
             "name": "0-19 -vuotiaat",
@@ -1486,53 +3762,32 @@ def plot_weekly_deaths_per_age_per_1M(population_by_year_and_age, acm_by_categor
             "age_end": None,
         },
     ]
+    week_x_dates = weekly_mortality.week_index.dates.tolist()
+    # week dates are Thursdays, so their calendar year is also the ISO year
+    week_years = weekly_mortality.week_x_date.astype("datetime64[Y]").astype(numpy.int64) + 1970
+    week_numbers = [x_date.isocalendar()[1] for x_date in week_x_dates]
+    # the latest population is used for the weeks after it
+    week_has_population = population_by_age.contains(week_years)
+    population_years = numpy.where(week_has_population, week_years, population_by_age.years[-1])
+    assert (numpy.abs(population_years - week_years) <= 1).all()
     for age_bucket in age_buckets:
-        bucket_deaths_timeseries = []
-        for age_category_index, age_category in enumerate(age_bucket["age_categories"]):
-            for timeseries_index, (x_date, deaths) in enumerate(acm_by_category[age_category]):
-                if age_category_index == 0:
-                    bucket_deaths_timeseries.append([x_date, deaths])
-                else:
-                    item = bucket_deaths_timeseries[timeseries_index]
-                    assert x_date == item[0]
-                    item[1] += deaths
+        bucket_deaths = weekly_mortality.columns(age_bucket["age_categories"]).sum(axis=1)
+        bucket_population = population_by_age.band(population_years, age_bucket["age_start"], age_bucket["age_end"])
+        assert (bucket_population > 0).all()
+        bucket_mortality = (bucket_deaths / (bucket_population / 1000000.0)).tolist()
+        for x_date, year, has_population, deaths, population, mortality in zip(week_x_dates, week_years.tolist(), week_has_population.tolist(),
+                                                                                bucket_deaths.tolist(), bucket_population.tolist(), bucket_mortality):
+            if not has_population:
+                print("Warning: year %d not in population data" % (year,))
+            print("%s\t%d\t%d\t%f" % (x_date, deaths, population, mortality))
         age_bucket["time_series"] = { 
-            "x": [],
-            "deaths_by_1M_cohort": [],
+            "x": week_x_dates,
+            "deaths_by_1M_cohort": bucket_mortality,
         }
-        for x_date, deaths in bucket_deaths_timeseries:
-            year = x_date.year
-            population = 0
-            if year not in population_by_year_and_age:
-                population_year_key = max(population_by_year_and_age.keys())
-                print("Warning: year %d not in population_by_year_and_age" % (year,))
-                assert abs(population_year_key - year) <= 1
-            else:
-                population_year_key = year
-            for age_key, age_item in population_by_year_and_age[population_year_key].items():
-                if isinstance(age_key, int):
-                    if age_bucket["age_start"] <= age_key and (age_bucket["age_end"] is None or age_key <= age_bucket["age_end"]):
-                        population += age_item[0]
-            assert population > 0
-            mortality = deaths / (population / 1000000.0)
-            print("%s\t%d\t%d\t%f" % (x_date, deaths, population, mortality))
-            age_bucket["time_series"]["x"].append(x_date)
-            age_bucket["time_series"]["deaths_by_1M_cohort"].append(mortality)
         year_series = {}
-        for x_date, deaths in bucket_deaths_timeseries:
-            year, week, _ = x_date.isocalendar()
+        for year, week, mortality in zip(week_years.tolist(), week_numbers, bucket_mortality):
             if year < 2000:
                 continue
-            population = 0
-            if year not in population_by_year_and_age:
-                population_year_key = max(population_by_year_and_age.keys())
-            else:
-                population_year_key = year
-            for age_key, age_item in population_by_year_and_age[population_year_key].items():
-                if isinstance(age_key, int):
-                    if age_bucket["age_start"] <= age_key and (age_bucket["age_end"] is None or age_key <= age_bucket["age_end"]):
-                        population += age_item[0]
-            mortality = deaths / (population / 1000000.0)
             if year not in year_series:
                 year_series[year] = {
                     "x": [],
@@ -1694,7 +3949,10 @@ BASELINE_NONFITTING_LINE_PROPS = {
 
 CUTOFF_ARROW_LENGTH = datetime.timedelta(days=3*365)
 
-def plot_model_cutoff(fig, ax, xpos=BASELINE_CUTOFF_DATE, ypos=0.14):
+def plot_model_cutoff(fig, ax, xpos=None, ypos=0.14, config=DEFAULT_BASELINE_CONFIG):
+    """Mark the cutoff of the baseline fit at *xpos*, by default config.cutoff_date."""
+    if xpos is None:
+        xpos = config.cutoff_date
     # https://matplotlib.org/stable/gallery/pyplots/annotate_transform.html#sphx-glr-gallery-pyplots-annotate-transform-py
     def _optional_dateconvert(d):
         if isinstance(d, datetime.date):
@@ -1735,7 +3993,7 @@ def plot_acm_baseline_trend(acm_raw_x, acm_raw_x_date, acm_raw_y,
                              acm_averaged_x, acm_averaged_x_date, acm_averaged_y,
                              baseline_average_x, baseline_average_x_date, baseline_average_y,
                              acm_estimate_x, acm_estimate_x_date, acm_estimate_y,
-                             baseline_trend_fn, auto_limits):
+                             baseline_trend_fn, auto_limits, config=DEFAULT_BASELINE_CONFIG):
     fig, ax = plt.subplots(1, 1, figsize=(PAPER_WIDTH_IN, BASELINE_PLOT_HEIGHT))
     #ax.plot(deaths_x, deaths_y, color="red", linewidth=DEFAULT_LINEWIDTH, linestyle="-")
     #ax.scatter(deaths_x, deaths_y, color="red", s=0.5)
@@ -1746,7 +4004,7 @@ def plot_acm_baseline_trend(acm_raw_x, acm_raw_x_date, acm_raw_y,
     (
         baseline_part_x, baseline_part_x_date, baseline_part_y,
         nonbaseline_part_x, nonbaseline_part_x_date, nonbaseline_part_y,
-    ) = split_acm_by_cutoff_date(acm_averaged_x, acm_averaged_x_date, acm_averaged_y)
+    ) = split_acm_by_cutoff_date(acm_averaged_x, acm_averaged_x_date, acm_averaged_y, config)
     ax.plot(baseline_part_x_date, baseline_part_y, zorder=1, **BASELINE_FITTING_LINE_PROPS)
     ax.plot(nonbaseline_part_x_date, nonbaseline_part_y, zorder=1, **BASELINE_NONFITTING_LINE_PROPS)
     #ax.plot(baseline_average_x_date, baseline_average_y, color="olivedrab", linewidth=1, linestyle="-", zorder=2)
@@ -1777,7 +4035,7 @@ def plot_acm_baseline_trend(acm_raw_x, acm_raw_x_date, acm_raw_y,
     for label in ax.get_xticklabels():
         label.set_horizontalalignment('center')
     fig.subplots_adjust(left=0.04, right=0.99, top=0.975, bottom=0.21)
-    plot_model_cutoff(fig, ax)
+    plot_model_cutoff(fig, ax, config=config)
     save_fig(fig, "figures/baseline_trend")
     #plt.show(block=True)
     plt.close(fig)
@@ -1786,7 +4044,7 @@ def plot_acm_baseline_fn(acm_raw_x, acm_raw_x_date, acm_raw_y,
                          acm_averaged_x, acm_averaged_x_date, acm_averaged_y,
                          baseline_average_x, baseline_average_x_date, baseline_average_y,
                          acm_estimate_x, acm_estimate_x_date, acm_estimate_y,
-                         baseline_fn, auto_limits):
+                         baseline_fn, auto_limits, config=DEFAULT_BASELINE_CONFIG):
     fig, ax = plt.subplots(1, 1, figsize=(PAPER_WIDTH_IN, BASELINE_PLOT_HEIGHT))
     #plt.xlim(min(acm_raw_x_date), max(acm_raw_x_date))
     plt.xlim(BASELINE_PLOT_START_DATE, BASELINE_PLOT_END_DATE)
@@ -1795,7 +4053,7 @@ def plot_acm_baseline_fn(acm_raw_x, acm_raw_x_date, acm_raw_y,
     (
         baseline_part_x, baseline_part_x_date, baseline_part_y,
         nonbaseline_part_x, nonbaseline_part_x_date, nonbaseline_part_y,
-    ) = split_acm_by_cutoff_date(acm_averaged_x, acm_averaged_x_date, acm_averaged_y)
+    ) = split_acm_by_cutoff_date(acm_averaged_x, acm_averaged_x_date, acm_averaged_y, config)
     ax.plot(baseline_part_x_date, baseline_part_y, zorder=1, **BASELINE_FITTING_LINE_PROPS)
     ax.plot(nonbaseline_part_x_date, nonbaseline_part_y, zorder=1, **BASELINE_NONFITTING_LINE_PROPS)
 
@@ -1817,7 +4075,7 @@ def plot_acm_baseline_fn(acm_raw_x, acm_raw_x_date, acm_raw_y,
     for label in ax.get_xticklabels():
         label.set_horizontalalignment('center')
     fig.subplots_adjust(left=0.04, right=0.99, top=0.975, bottom=0.21)
-    plot_model_cutoff(fig, ax)
+    plot_model_cutoff(fig, ax, config=config)
     save_fig(fig, "figures/baseline_fn")
     #plt.show(block=True)
     plt.close(fig)
@@ -1826,7 +4084,7 @@ def plot_acm_baseline_trend_and_fn(acm_raw_x, acm_raw_x_date, acm_raw_y,
                                     acm_averaged_x, acm_averaged_x_date, acm_averaged_y,
                                     baseline_average_x, baseline_average_x_date, baseline_average_y,
                                     acm_estimate_x, acm_estimate_x_date, acm_estimate_y,
-                                    baseline_trend_fn, baseline_fn, auto_limits):
+                                    baseline_trend_fn, baseline_fn, auto_limits, config=DEFAULT_BASELINE_CONFIG):
     fig, ax = plt.subplots(1, 1, figsize=(PAPER_WIDTH_IN, BASELINE_PLOT_HEIGHT))
     #ax.plot(deaths_x, deaths_y, color="red", linewidth=DEFAULT_LINEWIDTH, linestyle="-")
     #plt.scatter(deaths_x, deaths_y, color="red", s=0.5)
@@ -1837,7 +4095,7 @@ def plot_acm_baseline_trend_and_fn(acm_raw_x, acm_raw_x_date, acm_raw_y,
     (
         baseline_part_x, baseline_part_x_date, baseline_part_y,
         nonbaseline_part_x, nonbaseline_part_x_date, nonbaseline_part_y,
-    ) = split_acm_by_cutoff_date(acm_averaged_x, acm_averaged_x_date, acm_averaged_y)
+    ) = split_acm_by_cutoff_date(acm_averaged_x, acm_averaged_x_date, acm_averaged_y, config)
     ax.plot(baseline_part_x_date, baseline_part_y, zorder=1, **BASELINE_FITTING_LINE_PROPS)
     ax.plot(nonbaseline_part_x_date, nonbaseline_part_y, zorder=1, **BASELINE_NONFITTING_LINE_PROPS)
     #ax.plot(baseline_average_x_date, baseline_average_y, color="olivedrab", linewidth=1, linestyle="-", zorder=2)
@@ -1891,7 +4149,7 @@ def plot_acm_baseline_trend_and_fn(acm_raw_x, acm_raw_x_date, acm_raw_y,
     #plt.scatter(baseline_fn_x_date, baseline_fn_y, color="orange", s=3.0)
 
     fig.subplots_adjust(left=0.04, right=0.995, top=0.965, bottom=0.11)
-    plot_model_cutoff(fig, ax, ypos=0.11)
+    plot_model_cutoff(fig, ax, ypos=0.11, config=config)
     save_fig(fig, "figures/baseline_trend_and_fn")
     #plt.show(block=True)
     plt.close(fig)
@@ -1900,7 +4158,7 @@ def plot_combined_baseline_subplots(acm_raw_x, acm_raw_x_date, acm_raw_y,
                                     acm_averaged_x, acm_averaged_x_date, acm_averaged_y,
                                     baseline_average_x, baseline_average_x_date, baseline_average_y,
                                     acm_estimate_x, acm_estimate_x_date, acm_estimate_y,
-                                    baseline_trend_fn, baseline_fn, auto_limits):
+                                    baseline_trend_fn, baseline_fn, auto_limits, config=DEFAULT_BASELINE_CONFIG):
     fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(PAPER_WIDTH_IN, 2.0))
     #ax1.plot(deaths_x, deaths_y, color="red", linewidth=DEFAULT_LINEWIDTH, linestyle="-")
     #ax1.scatter(deaths_x, deaths_y, color="red", s=0.5)
@@ -1911,7 +4169,7 @@ def plot_combined_baseline_subplots(acm_raw_x, acm_raw_x_date, acm_raw_y,
     (
         baseline_part_x, baseline_part_x_date, baseline_part_y,
         nonbaseline_part_x, nonbaseline_part_x_date, nonbaseline_part_y,
-    ) = split_acm_by_cutoff_date(acm_averaged_x, acm_averaged_x_date, acm_averaged_y)
+    ) = split_acm_by_cutoff_date(acm_averaged_x, acm_averaged_x_date, acm_averaged_y, config)
     acm_avg_line_params = {
         "linewidth": DEFAULT_LINEWIDTH,
         "linestyle": "solid",
@@ -1997,13 +4255,14 @@ def plot_combined_baseline_subplots(acm_raw_x, acm_raw_x_date, acm_raw_y,
              verticalalignment="center", horizontalalignment="center", 
              fontsize=7, transform=fig.transFigure)
     fig.subplots_adjust(left=0.055, right=0.99, top=0.985, bottom=0.12, wspace=0, hspace=0.26)
-    plot_model_cutoff(fig, ax1)
-    plot_model_cutoff(fig, ax2)
+    plot_model_cutoff(fig, ax1, config=config)
+    plot_model_cutoff(fig, ax2, config=config)
     save_fig(fig, "figures/combined_baseline_plots")
     #plt.show(block=True)
     plt.close(fig)
 
-def plot_excess_mortality(excess_mortality_x, excess_mortality_x_date, excess_mortality_y):
+def plot_excess_mortality(excess_mortality, config=DEFAULT_BASELINE_CONFIG):
+    excess_mortality_x, excess_mortality_x_date, excess_mortality_y = excess_mortality.x, excess_mortality.x_date, excess_mortality.excess
     fig, ax = plt.subplots(1, 1, figsize=(PAPER_WIDTH_IN, BASELINE_PLOT_HEIGHT))
     ax.set_xlim(BASELINE_PLOT_START_DATE, BASELINE_PLOT_END_DATE)
     ax.set_ylim(-180, 280)
@@ -2063,7 +4322,7 @@ def plot_excess_mortality(excess_mortality_x, excess_mortality_x_date, excess_mo
     for label in yticklabels[len(yticklabels)//2:]:
         xy = label.get_position()
         label.set_horizontalalignment('left')
-    plot_model_cutoff(fig, ax)
+    plot_model_cutoff(fig, ax, config=config)
     save_fig(fig, "figures/excess_mortality_raw")
     #plt.show(block=True)
     plt.close(fig)
@@ -2119,19 +4378,19 @@ def plot_excess_mortality(excess_mortality_x, excess_mortality_x_date, excess_mo
     ax2_histy = fig2.add_axes(hist_rect, sharey=ax2)
     ax2_histy.xaxis.set_ticklabels([])
     ax2_histy.hist(excess_mortality_avg_y, bins=bins, density=True, orientation='horizontal')
-    plot_model_cutoff(fig, ax2)
+    plot_model_cutoff(fig, ax2, config=config)
     save_fig(fig2, "figures/excess_mortality")
     #plt.show(block=True)
     plt.close(fig2)
 
-def plot_yearly_cumulative_mortality(all_cause_mortality, baseline_fn, covid_data, start_week):
-    acm_lookup = dict(((date, deaths) for date, deaths in all_cause_mortality))
+def plot_yearly_cumulative_mortality(excess_mortality, covid_data, start_week, config=DEFAULT_BASELINE_CONFIG):
+    excess_lookup = dict(zip(excess_mortality.x_date.tolist(), excess_mortality.excess.tolist()))
     covid_data_lookup = dict(((x[0], x) for x in covid_data))
     fig, ax = plt.subplots(1, 1, figsize=(COLUMN_WIDTH_IN, 2.3))
     plt.ylim(-1800, 5000)
     plt.xlim(1, 52)
     week_labels = []
-    for year_idx, year in enumerate(range(BASELINE_START_DATE.year, 2023)):
+    for year_idx, year in enumerate(range(config.start_date.year, 2023)):
         cumulative_deaths_x_list = []
         cumulative_deaths = 0
         cumulative_deaths_ex_covid = 0
@@ -2150,13 +4409,10 @@ def plot_yearly_cumulative_mortality(all_cause_mortality, baseline_fn, covid_dat
             if year_idx == 0:
                 week_labels.append(str(week))
             x_date = get_date_from_isoweek(year+year_incr, week)
-            deaths = acm_lookup.get(x_date)
-            if deaths is None:
+            excess_deaths = excess_lookup.get(x_date)
+            if excess_deaths is None:
                 continue
             cumulative_deaths_x_list.append(week_index + 1)
-            x = (x_date - T0_DATE).days
-            baseline_deaths = baseline_fn(numpy.array([x]))[0]
-            excess_deaths = deaths - baseline_deaths
             cumulative_deaths += excess_deaths
             cumulative_deaths_y_list.append(cumulative_deaths)
             covid_data_item = covid_data_lookup.get(x_date)
@@ -2233,24 +4489,11 @@ def plot_yearly_cumulative_mortality(all_cause_mortality, baseline_fn, covid_dat
     #plt.show(block=True)
     plt.close(fig)
 
-def plot_all_time_cumulative_excess_mortality(all_cause_mortality, baseline_fn):
-    cumulative_excess_mortality_x_list = []
-    cumulative_excess_mortality_x_date_list = []
-    cumulative_excess_mortality_y_list = []
-    cumulative_deaths = 0
-    for x_date, deaths in all_cause_mortality:
-        if x_date < BASELINE_START_DATE:
-            continue
-        x = (x_date - T0_DATE).days
-        cumulative_excess_mortality_x_list.append(x)
-        cumulative_excess_mortality_x_date_list.append(x_date)
-        baseline_deaths = baseline_fn(numpy.array([x]))[0]
-        excess_deaths = deaths - baseline_deaths
-        cumulative_deaths += excess_deaths
-        cumulative_excess_mortality_y_list.append(cumulative_deaths)
-    cumulative_excess_mortality_x = numpy.array(cumulative_excess_mortality_x_list)
-    cumulative_excess_mortality_x_date = numpy.array(cumulative_excess_mortality_x_date_list)
-    cumulative_excess_mortality_y = numpy.array(cumulative_excess_mortality_y_list)
+def plot_all_time_cumulative_excess_mortality(excess_mortality, baseline_bootstrap=None, config=DEFAULT_BASELINE_CONFIG):
+    baseline_part_excess_mortality = excess_mortality.since(config.start_date)
+    cumulative_excess_mortality_x = baseline_part_excess_mortality.x
+    cumulative_excess_mortality_x_date = baseline_part_excess_mortality.x_date
+    cumulative_excess_mortality_y = baseline_part_excess_mortality.cumulative_excess
     output_dataseries("data_output/all_time_cumulative_excess_mortality.csv", 
                       ["cumulative_excess_mortality_x", "cumulative_excess_mortality_x_date", "cumulative_excess_mortality_y"],
                       cumulative_excess_mortality_x, cumulative_excess_mortality_x_date, cumulative_excess_mortality_y)
@@ -2266,11 +4509,15 @@ def plot_all_time_cumulative_excess_mortality(all_cause_mortality, baseline_fn):
     ax.tick_params(axis="x", pad=0.5, labelsize=7, labelrotation=60)
     for label in ax.get_xticklabels():
         label.set_horizontalalignment('center')
+    if baseline_bootstrap is not None:
+        cumulative_excess_mortality_low, cumulative_excess_mortality_high = baseline_bootstrap.all_time_cumulative_excess_bands()
+        ax.fill_between(cumulative_excess_mortality_x_date, cumulative_excess_mortality_low, cumulative_excess_mortality_high,
+                        color="C1", alpha=0.25, linewidth=0)
     ax.plot(cumulative_excess_mortality_x_date, cumulative_excess_mortality_y, color="C1", linewidth=0.5, linestyle="-")
     ax.plot(cumulative_excess_mortality_x_date[-1], cumulative_excess_mortality_y[-1], 'o', ms=20, markerfacecolor='#ffaaaa', markeredgewidth=0, alpha=0.4)
     #plt.scatter(baseline_fn_x_date, baseline_fn_y, color="orange", s=3.0)
     fig.subplots_adjust(bottom=0.11, top=0.975, left=0.095, right=0.985)
-    plot_model_cutoff(fig, ax, ypos=0.09)
+    plot_model_cutoff(fig, ax, ypos=0.09, config=config)
     save_fig(fig, "figures/all_time_cumulative_excess_mortality")
     #plt.show(block=True)
 
@@ -2286,8 +4533,31 @@ def plot_all_time_cumulative_excess_mortality(all_cause_mortality, baseline_fn):
 
     plt.close(fig)
 
-def plot_covid_cases_and_deaths(covid_data, excess_mortality_x_date, excess_mortality_y):
-    excess_mortality_lookup = dict([(x, y) for x, y in zip(excess_mortality_x_date, excess_mortality_y)])
+def plot_baseline_backtest(backtest_scores):
+    cutoff_dates = [score.cutoff_date for score in backtest_scores]
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(COLUMN_WIDTH_IN, 2.6), sharex=True)
+    ax1.axhline(linewidth=0.5, color="black")
+    ax1.plot(cutoff_dates, [score.rmse for score in backtest_scores], color="C0", linewidth=DEFAULT_LINEWIDTH, marker="o", ms=1.5, label="RMSE")
+    ax1.plot(cutoff_dates, [score.bias for score in backtest_scores], color="C1", linewidth=DEFAULT_LINEWIDTH, marker="o", ms=1.5, label="Keskivirhe")
+    ax1.legend(loc="upper left", fontsize=7, frameon=True, fancybox=False, facecolor="white", framealpha=1.0, edgecolor="0.5")
+    ax2.axhline(linewidth=0.5, color="black")
+    ax2.plot(cutoff_dates, [score.period_excess for score in backtest_scores], color="C1", linewidth=DEFAULT_LINEWIDTH, marker="o", ms=1.5)
+    ax2.xaxis.set_major_locator(matplotlib.dates.YearLocator())
+    ax2.xaxis.set_major_formatter(matplotlib.dates.DateFormatter("%Y"))
+    ax2.tick_params(axis="x", pad=0.5, labelsize=7, labelrotation=60)
+    ax_ylabel_transform = matplotlib.transforms.blended_transform_factory(fig.transFigure, ax1.transAxes)
+    ax1.text(0.04, 0.5, "Ennustevirhe\n%d vk" % (BACKTEST_HORIZON_WEEKS,), transform=ax_ylabel_transform, fontsize=7, rotation=90,
+             horizontalalignment="center", verticalalignment="center")
+    ax_ylabel_transform = matplotlib.transforms.blended_transform_factory(fig.transFigure, ax2.transAxes)
+    ax2.text(0.04, 0.5, "Ylikuolleisuus\n%d-%d" % (EXCESS_PERIOD_START_DATE.year, EXCESS_PERIOD_END_DATE.year - 1), transform=ax_ylabel_transform,
+             fontsize=7, rotation=90, horizontalalignment="center", verticalalignment="center")
+    fig.text(0.575, 0.005, "Mallin katkaisupäivä", fontsize=7, horizontalalignment="center", verticalalignment="bottom")
+    fig.subplots_adjust(bottom=0.15, top=0.98, left=0.17, right=0.98, hspace=0.08)
+    save_fig(fig, "figures/baseline_backtest")
+    plt.close(fig)
+
+def plot_covid_cases_and_deaths(covid_data, excess_mortality):
+    excess_mortality_lookup = dict(zip(excess_mortality.x_date.tolist(), excess_mortality.excess.tolist()))
     covid_x_list = []
     covid_x_date_list = []
     covid_deaths_y_list = []
@@ -2468,11 +4738,11 @@ def plot_euromomo_zscores(country_euromomo_data, output_file_name, output_cumula
     ax4.axhline(xmax=hline_xmax, linewidth=0.6, color="C3", linestyle="dotted")
     yline_transform = matplotlib.transforms.blended_transform_factory(ax4.transAxes, ax4.transData)
     ax4.text(hline_xmax+0.01, 0, "Tasapaino", 
-             transform=yline_transform, fontsize=5, color="C3", rotation="-45", rotation_mode="anchor",
+             transform=yline_transform, fontsize=5, color="C3", rotation=-45, rotation_mode="anchor",
              horizontalalignment="left", verticalalignment="center")
     ax4.axhline(y=pre_2021_cumulative_max, xmax=hline_xmax, linewidth=0.6, color="C3", linestyle="dotted")
     ax4.text(hline_xmax+0.01, pre_2021_cumulative_max, "<2021 maksimi", 
-             transform=yline_transform, fontsize=5, color="C3", rotation="-45", rotation_mode="anchor",
+             transform=yline_transform, fontsize=5, color="C3", rotation=-45, rotation_mode="anchor",
              horizontalalignment="left", verticalalignment="center")
     ax4.xaxis.set_minor_locator(WeekNumberLocator([20, 40]))
     ax4.xaxis.set_minor_formatter(WeekNumberFormatter())
@@ -2618,7 +4888,8 @@ def plot_highlighted_euromomo_zscores(country_euromomo_data):
     save_fig(fig, "figures/euromomo_zscores_highlighted")
     plt.close(fig)
 
-def plot_euromomo_vs_model_cumulative(excess_mortality_x, excess_mortality_x_date, excess_mortality_y, country_euromomo_data):
+def plot_euromomo_vs_model_cumulative(excess_mortality, country_euromomo_data):
+    excess_mortality_x, excess_mortality_x_date, excess_mortality_y = excess_mortality.x, excess_mortality.x_date, excess_mortality.excess
     zscore_x_list = []
     zscore_x_date_list = []
     zscore_y_list = []
@@ -2707,10 +4978,8 @@ def plot_euromomo_vs_model_cumulative(excess_mortality_x, excess_mortality_x_dat
     save_fig(fig2, "figures/euromomo_vs_model_cumulative")
     plt.close(fig2)
 
-def plot_euromomo_correlation(excess_mortality_x, excess_mortality_x_date, excess_mortality_y, country_euromomo_data):
-    excess_mortality_lookup = {}
-    for x_date, excess_mortality in zip(excess_mortality_x_date, excess_mortality_y):
-        excess_mortality_lookup[x_date] = excess_mortality
+def plot_euromomo_correlation(excess_mortality, country_euromomo_data):
+    excess_mortality_lookup = dict(zip(excess_mortality.x_date.tolist(), excess_mortality.excess.tolist()))
     correlation_x_list = []
     correlation_x_date_list = []
     correlation_excess_mortality_list = []
@@ -2722,11 +4991,11 @@ def plot_euromomo_correlation(excess_mortality_x, excess_mortality_x_date, exces
             continue
         if x_date not in excess_mortality_lookup:
             continue
-        excess_mortality = excess_mortality_lookup[x_date]
+        excess_deaths = excess_mortality_lookup[x_date]
         x = (x_date - T0_DATE).days
         correlation_x_list.append(x)
         correlation_x_date_list.append(x_date)
-        correlation_excess_mortality_list.append(excess_mortality)
+        correlation_excess_mortality_list.append(excess_deaths)
         correlation_zscore_list.append(zscore)
         year = x_date.year
         if year in year_correllation_lookup:
@@ -2737,7 +5006,7 @@ def plot_euromomo_correlation(excess_mortality_x, excess_mortality_x_date, exces
             year_correllation_lookup[year] = year_item
         year_item[2].append(x)
         year_item[3].append(x_date)
-        year_item[4].append(excess_mortality)
+        year_item[4].append(excess_deaths)
         year_item[5].append(zscore)
     correlation_x = numpy.array(correlation_x_list)
     correlation_x_date = numpy.array(correlation_x_date_list)
@@ -2928,7 +5197,7 @@ def test_get_life_expectancy_buckets():
     assert result == expected, "Invalid result: %s, expected %s" % (repr(result), repr(expected))
 test_get_life_expectancy_buckets()
 
-def plot_population_normalization(country_both_life_expectancy_fn, country_male_life_expectancy_fn, country_female_life_expectancy_fn, country_population_by_year_and_age, baseline_trend_fn):
+def plot_population_normalization(country_both_life_expectancy_fn, country_male_life_expectancy_fn, country_female_life_expectancy_fn, country_population_by_age, baseline_trend_fn):
     raise NotImplementedError()
     normalization_x_list = []
     normalization_x_date_list = []
@@ -2938,7 +5207,7 @@ def plot_population_normalization(country_both_life_expectancy_fn, country_male_
     male_life_expectancy_y_list = []
     female_life_expectancy_y_list = []
     for year in range(1990, 2020):
-        population_by_age = country_population_by_year_and_age[year]
+        population_by_age = country_population_by_age.age_populations(year).tolist()
         x_date = datetime.date(year, 1, 1)
         x = (x_date - T0_DATE).days
         normalization_x_list.append(x)
@@ -2976,14 +5245,14 @@ def plot_population_normalization(country_both_life_expectancy_fn, country_male_
 
         male_age_bucket = int(male_life_expectancy)
         male_sum2 = 0
-        for age, (_, male_population, _) in population_by_age.items():
+        for age, (_, male_population, _) in enumerate(population_by_age):
             if age == male_age_bucket:
                 male_sum2 += (1.0 - (male_life_expectancy - male_age_bucket)) * male_population
             elif age > male_age_bucket:
                 male_sum2 += male_population
         female_age_bucket = int(female_life_expectancy)
         female_sum2 = 0
-        for age, (_, _, female_population) in population_by_age.items():
+        for age, (_, _, female_population) in enumerate(population_by_age):
             if age == female_age_bucket:
                 female_sum2 += (1.0 - (female_life_expectancy - female_age_bucket)) * female_population
             elif age > female_age_bucket:
@@ -3040,124 +5309,263 @@ def get_estimate_point(target_date, yearly_mortality):
     days_in_year = (datetime.date(target_date.year, 12, 31) - datetime.date(target_date.year, 1, 1)).days + 1
     return target_date, yearly_mortality/(days_in_year/7)
 
-def main():
-    with open("Finland/Finland weekly ACM.csv", "rt", encoding="iso-8859-1") as csv_file:
-        finland_acm, finland_acm_by_category = parse_finland_acm_csv(csv_file, trim_weeks_from_end=2)
-    # source: Tilastokeskus Väestöennuste 2019 and 2021
-    # https://pxnet2.stat.fi/PXWeb/pxweb/fi/StatFin/StatFin__vrm__vaenn/statfin_vaenn_pxt_139e.px/table/tableViewLayout1/
-    finland_acm_estimate = [#get_estimate_point(datetime.date(2020, 7, 1), 54054),    # VE2019
-                            get_estimate_point(datetime.date(2021, 7, 1), 55987),     # VE2021
-                            get_estimate_point(datetime.date(2024, 7, 1), 56605),     # VE2021
-                            ]
-
-    with open("Finland/Finland population and deaths by month.csv", "rt", encoding="iso-8859-1") as csv_file:
-        finland_deaths_and_population_by_month = parse_finland_deaths_and_population_by_month_csv(csv_file, trim_months_from_end=0)
-        assert len(finland_deaths_and_population_by_month) > 50
-    with open("Finland/Finland deaths by month.csv", "rt", encoding="iso-8859-1") as csv_file:
-        finland_deaths_by_month_since_1945 = parse_finland_deaths_by_month_csv(csv_file)
-        assert len(finland_deaths_by_month_since_1945) > 50
-    #with open("Finland population by year.csv", "rt", encoding="iso-8859-1") as csv_file:
-    #    finland_population_by_year = parse_finland_population_by_month_csv(csv_file)
-    #    assert len(finland_population_by_year) > 50
-    with open("Finland/Finland verified covid deaths.csv", "rt", encoding="utf-8") as csv_file:
-        finland_covid_data = parse_finland_thl_verified_covid_data_csv(csv_file)
-        assert len(finland_covid_data) > 50
-    with open("Finland/Finland Population by age.csv", "rt", encoding="iso-8859-1") as csv_file:
-        finland_population_by_year_and_age = parse_finland_tilastokeskus_population_csv(csv_file)
-        assert len(finland_population_by_year_and_age) > 10
-        assert len(finland_population_by_year_and_age[2010]) > 50
-    with open("Finland/Finland deaths forecast.csv", "rt", encoding="iso-8859-1") as csv_file:
-        finland_deaths_forecast = parse_finland_deaths_forecast_csv(csv_file)
-        assert len(finland_deaths_forecast) > 10
-    with open("EuroMoMo/Euromomo all countries z-scores 2022-11-05.csv", "rt", encoding="utf-8") as csv_file:
-        euromomo_data = parse_euromomo_zscores_csv(csv_file)
-        assert len(euromomo_data) > 50
-        finland_euromomo_data = [(d, item["Finland"]) for d, item in euromomo_data if item.get("Finland") is not None]
+class MainAnalysis:
+    """
+    Results shared by several outputs of main(), computed from *datasets*
+    with the baseline settings *config* on first access, so that an output
+    only loads the datasets and runs the fits it needs.
+    """
+    def __init__(self, datasets, config=DEFAULT_BASELINE_CONFIG):
+        self.datasets = datasets
+        self.config = config
+
+    @functools.cached_property
+    def target(self):
+        """Weekly deaths analyzed by the baseline outputs, and whether their plots use automatic limits."""
+        finland_weekly_mortality = self.datasets["finland_weekly_mortality"]
+        if True:
+            return finland_weekly_mortality.as_tuples("total"), False
+        else:
+            return finland_weekly_mortality.as_tuples("65-"), True
+
+    @functools.cached_property
+    def acm_baseline(self):
+        """Result of calculate_acm_baseline for the target deaths."""
+        target_acm, _ = self.target
+        # source: Tilastokeskus Väestöennuste 2019 and 2021
+        # https://pxnet2.stat.fi/PXWeb/pxweb/fi/StatFin/StatFin__vrm__vaenn/statfin_vaenn_pxt_139e.px/table/tableViewLayout1/
+        finland_acm_estimate = [#get_estimate_point(datetime.date(2020, 7, 1), 54054),    # VE2019
+                                get_estimate_point(datetime.date(2021, 7, 1), 55987),     # VE2021
+                                get_estimate_point(datetime.date(2024, 7, 1), 56605),     # VE2021
+                                ]
+        print_top_acm_table(target_acm)
+        return calculate_acm_baseline(target_acm, None, BASELINE_MODEL_NAME, self.config)
+
+    @property
+    def acm_raw(self):
+        """Weekly x, dates and deaths of the target deaths."""
+        return self.acm_baseline[0]
+
+    @property
+    def baseline_fn(self):
+        return self.acm_baseline[4][1]
+
+    @property
+    def excess_mortality(self):
+        return self.acm_baseline[5]
+
+    @functools.cached_property
+    def baseline_bootstrap(self):
+        _, acm_raw_x_date, acm_raw_y = self.acm_raw
+        return bootstrap_acm_baseline_method2(acm_raw_x_date, acm_raw_y, None, config=self.config)
+
+    @functools.cached_property
+    def finland_euromomo_data(self):
+        return self.datasets["euromomo_zscores"].as_tuples("Finland")
+
+def output_main_baseline(analysis):
+    """Baseline of the target deaths, its excess mortality and their plots."""
     # Source: Worldometer - Finland Demographics - Life Expectancy in Finland
     # https://www.worldometers.info/demographics/finland-demographics/#life-exp
     finland_life_expectancy = list(zip([1950,   1955,   1960,   1965,   1970,   1975,   1980,   1985,   1990,   1995,   2000,   2005,   2010,   2015,   2020],
                                        [66.4,   68.19,  69.07,  69.72,  70.94,  72.72,  74.33,  74.79,  75.84,  77.14,  78.4,   79.54,  80.7,   81.64,  82.48],  # Both sexes
                                        [63.02,  64.76,  65.44,  65.82,  66.63,  68.26,  70.04,  70.65,  71.94,  73.43,  74.93,  76.12,  77.67,  78.75,  79.82],  # Males
                                        [69.59,  71.43,  72.55,  73.50,  75.15,  77.04,  78.39,  78.75,  79.58,  80.70,  81.74,  82.91,  83.67,  84.52,  85.14])) # Females
-    os.makedirs("figures", exist_ok=True)
-    os.makedirs("figures/EuroMoMo", exist_ok=True)
-    os.makedirs("data_output", exist_ok=True)
-
-    if True:
-        target_acm = finland_acm
-        auto_limits = False
-    else:
-        target_acm = finland_acm_by_category["65-"]
-        auto_limits = True
-        
-    print_top_acm_table(target_acm)
+    _, auto_limits = analysis.target
     (
         (acm_raw_x, acm_raw_x_date, acm_raw_y),
         (acm_averaged_x, acm_averaged_x_date, acm_averaged_y),
         (baseline_average_x, baseline_average_x_date, baseline_average_y),
         (acm_estimate_x, acm_estimate_x_date, acm_estimate_y),
         (baseline_trend_fn, baseline_fn),
-        (excess_mortality_x, excess_mortality_x_date, excess_mortality_y)
-    ) = calculate_acm_baseline_method2(target_acm, None)
+        excess_mortality
+    ) = analysis.acm_baseline
     (finland_both_life_expectancy_fn, 
      finland_male_life_expectancy_fn, 
      finland_female_life_expectancy_fn) = calculate_life_expectancy_fn(finland_life_expectancy)
-    finland_deaths_and_population_by_month_extended = combine_deaths_by_month(finland_deaths_by_month_since_1945, finland_deaths_and_population_by_month, min_year=1990)
     print("Year\tEstimated yearly mortality")
-    for year in range(1990, 2025+1):
-        print("%d\t%d" % (year, round(get_model_yearly_mortality(baseline_fn, year))))
-    plot_deaths_forecast_vs_model(finland_deaths_forecast, baseline_fn)
-    plot_monthly_deaths_per_100k(finland_deaths_and_population_by_month, finland_covid_data)
-    plot_weekly_deaths_per_age_per_1M(finland_population_by_year_and_age, finland_acm_by_category)
+    for year, model_deaths in zip(range(1990, 2025+1), get_model_yearly_mortality(baseline_fn, numpy.arange(1990, 2025+1))):
+        print("%d\t%d" % (year, model_deaths))
     plot_raw_acm(acm_raw_x, acm_raw_x_date, acm_raw_y, auto_limits)
     plot_acm_baseline_trend(acm_raw_x, acm_raw_x_date, acm_raw_y,
                              acm_averaged_x_date, acm_averaged_x_date, acm_averaged_y,
                              baseline_average_x, baseline_average_x_date, baseline_average_y,
                              acm_estimate_x, acm_estimate_x_date, acm_estimate_y,
-                             baseline_trend_fn, auto_limits)
+                             baseline_trend_fn, auto_limits, analysis.config)
     plot_acm_baseline_fn(acm_raw_x, acm_raw_x_date, acm_raw_y,
                          acm_averaged_x_date, acm_averaged_x_date, acm_averaged_y,
                          baseline_average_x, baseline_average_x_date, baseline_average_y,
                          acm_estimate_x, acm_estimate_x_date, acm_estimate_y,
-                         baseline_fn, auto_limits)
+                         baseline_fn, auto_limits, analysis.config)
     plot_acm_baseline_trend_and_fn(acm_raw_x, acm_raw_x_date, acm_raw_y,
                                    acm_averaged_x_date, acm_averaged_x_date, acm_averaged_y,
                                    baseline_average_x, baseline_average_x_date, baseline_average_y,
                                    acm_estimate_x, acm_estimate_x_date, acm_estimate_y,
-                                   baseline_trend_fn, baseline_fn, auto_limits)
+                                   baseline_trend_fn, baseline_fn, auto_limits, analysis.config)
     plot_combined_baseline_subplots(acm_raw_x, acm_raw_x_date, acm_raw_y,
                                     acm_averaged_x_date, acm_averaged_x_date, acm_averaged_y,
                                     baseline_average_x, baseline_average_x_date, baseline_average_y,
                                     acm_estimate_x, acm_estimate_x_date, acm_estimate_y,
-                                    baseline_trend_fn, baseline_fn, auto_limits)
-    plot_excess_mortality(excess_mortality_x, excess_mortality_x_date, excess_mortality_y)
+                                    baseline_trend_fn, baseline_fn, auto_limits, analysis.config)
+    plot_excess_mortality(excess_mortality, analysis.config)
     # yearly cumulative mortality from newyear
-    plot_yearly_cumulative_mortality(target_acm, baseline_fn, finland_covid_data, start_week=1)
+    finland_covid_data = analysis.datasets["finland_covid_data"]
+    plot_yearly_cumulative_mortality(excess_mortality, finland_covid_data, start_week=1, config=analysis.config)
     # yearly cumulative mortality from spring
-    plot_yearly_cumulative_mortality(target_acm, baseline_fn, finland_covid_data, start_week=16)
-    plot_all_time_cumulative_excess_mortality(target_acm, baseline_fn)
-    plot_covid_cases_and_deaths(finland_covid_data, excess_mortality_x_date, excess_mortality_y)
+    plot_yearly_cumulative_mortality(excess_mortality, finland_covid_data, start_week=16, config=analysis.config)
+    plot_all_time_cumulative_excess_mortality(excess_mortality, config=analysis.config)
+    #plot_population_normalization(finland_both_life_expectancy_fn, finland_male_life_expectancy_fn, finland_female_life_expectancy_fn, analysis.datasets["finland_population_by_age"], baseline_trend_fn)
+
+def output_main_models(analysis):
+    """Yearly baselines of every model of BASELINE_MODELS."""
+    acm_raw_x, acm_raw_x_date, acm_raw_y = analysis.acm_raw
+    baseline_models = {model_name: fit_baseline_model(model_name, acm_raw_x_date, acm_raw_y, config=analysis.config) for model_name in BASELINE_MODELS}
+    print("Model\t" + "\t".join(("Baseline %d" % (year,) for year in range(2020, 2023))))
+    for model_name, model in baseline_models.items():
+        print("%s\t%s" % (model_name, "\t".join(("%d" % (deaths,) for deaths in get_model_yearly_mortality(model.baseline_fn, numpy.arange(2020, 2023))))))
+    output_baseline_model_comparison("data_output/baseline_model_comparison.csv", acm_raw_x, acm_raw_x_date, acm_raw_y, baseline_models)
+
+def output_main_bootstrap(analysis):
+    """Bootstrap bands of the method 2 baseline and of the all-time cumulative excess mortality."""
+    baseline_bootstrap = analysis.baseline_bootstrap
+    print_baseline_bootstrap_params(baseline_bootstrap)
+    output_baseline_bootstrap("data_output/baseline_fn_bootstrap.csv", "data_output/all_time_cumulative_excess_mortality_bootstrap.csv",
+                              baseline_bootstrap)
+    plot_all_time_cumulative_excess_mortality(analysis.excess_mortality, baseline_bootstrap, analysis.config)
+
+def output_main_backtest(analysis):
+    """Rolling-origin backtest of the method 2 baseline."""
+    _, acm_raw_x_date, acm_raw_y = analysis.acm_raw
+    baseline_backtest_scores = backtest_acm_baseline_method2(acm_raw_x_date, acm_raw_y, config=analysis.config)
+    output_baseline_backtest("data_output/baseline_backtest.csv", baseline_backtest_scores)
+    plot_baseline_backtest(baseline_backtest_scores)
+
+def output_main_sweep(analysis):
+    """Sweep of the settings of BASELINE_SWEEP_GRIDS."""
+    _, acm_raw_x_date, acm_raw_y = analysis.acm_raw
+    baseline_sweep_results = []
+    for method, settings in BASELINE_SWEEP_GRIDS:
+        baseline_sweep_results += sweep_baseline_configs(acm_raw_x_date, acm_raw_y, method, get_baseline_config_grid(settings, analysis.config))
+    output_baseline_sweep("data_output/baseline_sweep.csv", baseline_sweep_results)
+
+def output_main_forecast(analysis):
+    plot_deaths_forecast_vs_model(analysis.datasets["finland_deaths_forecast"], analysis.baseline_fn)
+
+def output_main_monthly(analysis):
+    datasets = analysis.datasets
+    plot_monthly_deaths_per_100k(datasets["finland_deaths_and_population_by_month"], datasets["finland_covid_data"])
+    finland_deaths_and_population_by_month_extended = combine_deaths_by_month(datasets["finland_deaths_by_month_since_1945"],
+                                                                              datasets["finland_deaths_and_population_by_month"], min_year=1990)
+    plot_processcontrol_deaths_by_halfyears(finland_deaths_and_population_by_month_extended)
+
+def output_main_ages(analysis):
+    plot_weekly_deaths_per_age_per_1M(analysis.datasets["finland_population_by_age"], analysis.datasets["finland_weekly_mortality"])
+
+def output_main_categories(analysis):
+    """Baselines and quasi-Poisson z-scores of every age and sex category."""
+    finland_weekly_mortality = analysis.datasets["finland_weekly_mortality"]
+    category_baselines = fit_category_baselines(finland_weekly_mortality, get_finland_acm_by_category_keys())
+    output_category_excess_mortality("data_output/excess_mortality_by_category.csv", category_baselines)
+    if category_baselines.weights is not None:
+        output_category_weights("data_output/baseline_weights_by_category.csv", category_baselines)
+    category_quasi_poisson = fit_quasi_poisson_baselines(finland_weekly_mortality.week_x_date,
+                                                         finland_weekly_mortality.columns(category_baselines.categories))
+    print("Category\tQuasi-Poisson dispersion")
+    for category, dispersion in zip(category_baselines.categories, category_quasi_poisson.dispersion.tolist()):
+        print("%s\t%.2f" % (category, dispersion))
+    output_quasi_poisson_zscores("data_output/quasi_poisson_zscores_by_category.csv", finland_weekly_mortality.week_index,
+                                 category_baselines.categories, category_quasi_poisson)
+
+def output_main_regions(analysis):
+    """Method 2 and Serfling baselines of every age band of every maakunta."""
+    region_totals = FinlandRegionTotals()
+    def iter_maakunta_chunks(chunks):
+        for chunk in chunks:
+            region_totals.add(chunk)
+            maakunta_regions = get_finland_maakunta_regions(chunk)
+            if maakunta_regions:
+                yield chunk.select(maakunta_regions)
+    # the regional file is streamed, so that it is parsed while the previous regions are fitted
+    with open(FINLAND_REGION_MORTALITY_FILE, "rt", encoding="iso-8859-1") as csv_file:
+        chunks = iter_finland_region_mortality_csv(csv_file, FINLAND_REGION_MORTALITY_TRIM_WEEKS, REGIONS_PER_CHUNK)
+        region_excess_mortality, region_serfling_excess_mortality = fit_region_chunk_baselines(iter_maakunta_chunks(chunks),
+                                                                                               ("method2", "serfling"))
+    region_totals.validate()
+    output_region_excess_mortality("data_output/excess_mortality_by_region.npz", region_excess_mortality)
+    output_region_excess_mortality("data_output/excess_mortality_by_region_serfling.npz", region_serfling_excess_mortality)
+
+def output_main_covid(analysis):
+    plot_covid_cases_and_deaths(analysis.datasets["finland_covid_data"], analysis.excess_mortality)
+
+def output_main_euromomo(analysis):
+    """EuroMoMo z-scores of Finland and their comparison with the baseline."""
+    finland_euromomo_data = analysis.finland_euromomo_data
     plot_euromomo_zscores(finland_euromomo_data,
                           "figures/euromomo_zscores",
                           "figures/euromomo_zscores_cumulative",
                           "figures/euromomo_zscores_combined")
     plot_highlighted_euromomo_zscores(finland_euromomo_data)
-    plot_euromomo_vs_model_cumulative(excess_mortality_x, excess_mortality_x_date, excess_mortality_y, finland_euromomo_data)
-    plot_euromomo_correlation(excess_mortality_x, excess_mortality_x_date, excess_mortality_y, finland_euromomo_data)
-    plot_processcontrol_deaths_by_halfyears(finland_deaths_and_population_by_month_extended)
-    #plot_population_normalization(finland_both_life_expectancy_fn, finland_male_life_expectancy_fn, finland_female_life_expectancy_fn, finland_population_by_year_and_age, baseline_trend_fn)
-    sys.exit(0)
-    all_euromomo_countries = set()
-    for _, item in euromomo_data:
-        all_euromomo_countries.update(item.keys())
-    for country in sorted(all_euromomo_countries):
-        country_euromomo_data = [(d, item[country]) for d, item in euromomo_data if item.get(country)]
+    plot_euromomo_vs_model_cumulative(analysis.excess_mortality, finland_euromomo_data)
+    plot_euromomo_correlation(analysis.excess_mortality, finland_euromomo_data)
+
+def output_main_euromomo_countries(analysis):
+    """EuroMoMo z-scores of every country."""
+    euromomo_zscores = analysis.datasets["euromomo_zscores"]
+    for country in sorted(euromomo_zscores.countries.tolist()):
+        country_euromomo_data = euromomo_zscores.as_tuples(country)
         plot_euromomo_zscores(country_euromomo_data, 
                               "figures/EuroMoMo/%s zscores" % (country,), 
                               "figures/EuroMoMo/%s zscores cumulative" % (country,),
                               "figures/EuroMoMo/%s zscores combined" % (country,))
+
+def output_main_euromomo_revisions(analysis):
+    """Number of cells which each downloaded vintage of the EuroMoMo tables revised."""
+    for dataset_name in ("euromomo_zscore_vintages", "euromomo_pooled_zscore_vintages", "euromomo_pooled_numbers_vintages"):
+        vintages = analysis.datasets[dataset_name]
+        revised_cells = [vintages.revised_cells(vintage_index) for vintage_index in range(len(vintages))]
+        print("Vintage\t%s revised cells" % (dataset_name,))
+        for vintage, vintage_revised_cells in zip(vintages.vintages, revised_cells):
+            print("%s\t%d" % (vintage, vintage_revised_cells))
+        output_dataseries("data_output/%s_revisions.csv" % (dataset_name,), ["vintage", "revised_cells"], vintages.vintages, revised_cells)
+
+# Outputs of main() by name, run in this order. Each function takes a MainAnalysis.
+MAIN_OUTPUTS = {
+    "baseline": output_main_baseline,
+    "models": output_main_models,
+    "bootstrap": output_main_bootstrap,
+    "backtest": output_main_backtest,
+    "sweep": output_main_sweep,
+    "forecast": output_main_forecast,
+    "monthly": output_main_monthly,
+    "ages": output_main_ages,
+    "categories": output_main_categories,
+    "regions": output_main_regions,
+    "covid": output_main_covid,
+    "euromomo": output_main_euromomo,
+    "euromomo_countries": output_main_euromomo_countries,
+    "euromomo_revisions": output_main_euromomo_revisions,
+}
+# Outputs of main() when none are given on the command line
+DEFAULT_MAIN_OUTPUTS = ("baseline", "models", "bootstrap", "backtest", "sweep", "forecast", "monthly", "ages",
+                        "categories", "regions", "covid", "euromomo")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Analyze and plot all cause mortality.")
+    parser.add_argument("outputs", nargs="*", metavar="OUTPUT",
+                        help="outputs to produce, of %s; by default %s" % (", ".join(MAIN_OUTPUTS), ", ".join(DEFAULT_MAIN_OUTPUTS)))
+    args = parser.parse_args(argv)
+    unknown_outputs = [output for output in args.outputs if output not in MAIN_OUTPUTS]
+    if unknown_outputs:
+        parser.error("unknown outputs: %s" % (", ".join(unknown_outputs),))
+    requested_outputs = set(args.outputs or DEFAULT_MAIN_OUTPUTS)
+    os.makedirs("figures", exist_ok=True)
+    os.makedirs("figures/EuroMoMo", exist_ok=True)
+    os.makedirs("data_output", exist_ok=True)
+    analysis = MainAnalysis(DATASET_REGISTRY)
+    for output_name, output_fn in MAIN_OUTPUTS.items():
+        if output_name in requested_outputs:
+            output_fn(analysis)
     
 if __name__ == "__main__":
     init_latex()
     main()
-